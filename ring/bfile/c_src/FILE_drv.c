@@ -70,6 +70,7 @@
 #define XX_TELL             't'
 #define XX_TRUNCATE         'T'
 #define XX_FLUSH            'f'
+#define XX_SYNC             'F'
 #define XX_OEOF             'e'
 #define XX_ERROR            'E'
 #define XX_GETC             'g'
@@ -359,6 +360,20 @@ static void FILE_from_erlangv(ErlDrvData drv_data,  ErlIOVec* ev)
 	    driver_ok(desc->port);
 	break;
 
+    case XX_SYNC:
+	if (fflush(desc->fp) != 0) {
+	    driver_error(desc->port, errno);
+	    return;
+	}
+#ifndef WIN32
+	if (fsync(fileno(desc->fp)) != 0) {
+	    driver_error(desc->port, errno);
+	    return;
+	}
+#endif
+	driver_ok(desc->port);
+	break;
+
     case XX_OEOF:
 	if (feof(desc->fp))
 	    driver_ret32(desc->port, 1);
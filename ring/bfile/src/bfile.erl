@@ -22,6 +22,7 @@
 	 ftell/1,
 	 ftruncate/1,
 	 fflush/1,
+	 fsync/1,
 	 frewind/1,
 	 fgetc/1,
 	 fungetc/2,
@@ -41,6 +42,7 @@
 -define(TELL,             $t).
 -define(TRUNCATE,         $T).
 -define(FLUSH,            $f).
+-define(SYNC,             $F).
 -define(OEOF,             $e).
 -define(ERROR,            $E).
 -define(GETC,             $g).
@@ -160,6 +162,12 @@ fflush({bfile, Fd}) ->
     erlang_port_command(Fd, [?FLUSH]),
     recp(Fd).
 
+%% Flushes the buffer and syncs the file to disk
+%% ok | {error, Reason}
+fsync({bfile, Fd}) ->
+    erlang_port_command(Fd, [?SYNC]),
+    recp(Fd).
+
 %% ok | {error, Reason}
 frewind(BFd) ->
     fseek(BFd, 0, seek_set).
@@ -0,0 +1,35 @@
+-module(bloomfilter).
+-export([new/2, member/2]).
+
+%%%
+%%% Bloom filter for 32-bit key hashes, as produced by ringo_index:dexhash().
+%%% The filter is an immutable bitstring of M bits, so it is built at once
+%%% from all the hashes of an iblock. With BitsPerKey bits per key and
+%%% K = BitsPerKey * ln 2 probes, the false positive rate is roughly
+%%% 0.6185^BitsPerKey, e.g. 1% with 10 bits per key.
+%%%
+%%% Probes are derived from the hash with double hashing (Kirsch and
+%%% Mitzenmacher): Probe_i = (H + i * H2) mod M. The key hashes are md5
+%%% prefixes, so they are uniformly distributed already.
+%%%
+
+new(Hashes, BitsPerKey) ->
+        M = lists:max([64, length(Hashes) * BitsPerKey]),
+        K = lists:max([1, round(BitsPerKey * 0.69)]),
+        Bits = lists:usort(lists:flatten([probes(H, M, K) || H <- Hashes])),
+        {bloom, M, K, set_bits(Bits, 0, M, [])}.
+
+member(Hash, {bloom, M, K, Bits}) ->
+        lists:all(fun(P) ->
+                <<_:P, B:1, _/bits>> = Bits, B == 1
+        end, probes(Hash, M, K)).
+
+probes(H, M, K) ->
+        H2 = erlang:phash2(H) bor 1,
+        [(H + I * H2) rem M || I <- lists:seq(0, K - 1)].
+
+% Bits is a sorted list of bit positions to set
+set_bits([], Prev, M, L) ->
+        list_to_bitstring(lists:reverse([<<0:(M - Prev)>>|L]));
+set_bits([P|R], Prev, M, L) ->
+        set_bits(R, P + 1, M, [<<0:(P - Prev), 1:1>>|L]).
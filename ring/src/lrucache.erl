@@ -7,11 +7,15 @@
 %%% via a dictionary. The LRU item is always the head and can be retrieved
 %%% with get_lru(). Accessing an item moves it to to the tail (update()).
 %%%
-%%% This implementation is based on the dict module to avoid copying
-%%% of large binary keys, as would happen with ets.
+%%% The links are kept in an ets table of {Key, Newer, Older} tuples, which
+%%% is updated in place, so both update() and get_lru() take constant time
+%%% and don't allocate. Binary keys larger than 64 bytes are reference-counted
+%%% in ets, so they aren't copied either. Since the table is mutable, only the
+%%% latest cache returned by update() or get_lru() is valid. The table is
+%%% owned by the process that called new().
 %%%
 
-new() -> {gb_trees:empty(), nil, nil}.
+new() -> {ets:new(lrucache, [set]), nil, nil}.
 
 is_empty({_, nil, nil}) -> true;
 is_empty(_) -> false.
@@ -20,41 +24,43 @@ is_empty(_) -> false.
 get_lru({_, nil, _}) -> nil;
 
 % one key
-get_lru({_, H, H}) -> {H, new()};
+get_lru({D, H, H}) ->
+        ets:delete(D, H),
+        {H, {D, nil, nil}};
 
-% normal case 
+% normal case
 get_lru({D, H, T}) ->
-        {Prev, _} = gb_trees:get(H, D),
-        {Prev0, _} = gb_trees:get(Prev, D),
-        {H, {gb_trees:enter(Prev, {Prev0, nil},
-                gb_trees:delete(H, D)), Prev, T}}.
-                
+        [{_, Newer, _}] = ets:lookup(D, H),
+        ets:update_element(D, Newer, {3, nil}),
+        ets:delete(D, H),
+        {H, {D, Newer, T}}.
+
 update(Key, {D, _, _} = LRU) ->
-        update(Key, gb_trees:lookup(Key, D), LRU).
+        update(Key, ets:lookup(D, Key), LRU).
 
 % first key in the cache
-update(Key, none, {D, nil, nil}) ->
-        {gb_trees:enter(Key, {nil, nil}, D), Key, Key};
+update(Key, [], {D, nil, nil}) ->
+        ets:insert(D, {Key, nil, nil}),
+        {D, Key, Key};
 
-% new key 
-update(Key, none, LRU) -> add_tail(Key, LRU);
+% new key
+update(Key, [], LRU) -> add_tail(Key, LRU);
 
 % update tail
-update(_, {value, {nil, _}}, LRU) -> LRU;
+update(_, [{_, nil, _}], LRU) -> LRU;
 
 % update head
-update(Key, {value, {Prev, nil}}, {D, _, T}) ->
-        {Prev0, _} = gb_trees:get(Prev, D),
-        add_tail(Key, {gb_trees:enter(Prev, {Prev0, nil}, D), Key, T});
+update(Key, [{_, Newer, nil}], {D, _, T}) ->
+        ets:update_element(D, Newer, {3, nil}),
+        add_tail(Key, {D, Newer, T});
 
 % existing key in the middle
-update(Key, {value, {Prev, Next}}, {D, H, T}) ->
-        {Prev0, _} = gb_trees:get(Prev, D),
-        {_, Next0} = gb_trees:get(Next, D),
-        D0 = gb_trees:enter(Prev, {Prev0, Next}, D),
-        add_tail(Key, {gb_trees:enter(Next, {Prev, Next0}, D0), H, T}).
-        
+update(Key, [{_, Newer, Older}], {D, H, T}) ->
+        ets:update_element(D, Newer, {3, Older}),
+        ets:update_element(D, Older, {2, Newer}),
+        add_tail(Key, {D, H, T}).
+
 add_tail(Key, {D, H, T}) ->
-        {nil, Next} = gb_trees:get(T, D),
-        D0 = gb_trees:enter(T, {Key, Next}, D),
-        {gb_trees:enter(Key, {nil, T}, D0), H, Key}. 
+        ets:update_element(D, T, {2, Key}),
+        ets:insert(D, {Key, nil, T}),
+        {D, H, Key}.
@@ -58,6 +58,13 @@
 -define(GLOBAL_RESYNC_INTERVAL, 600000). 
 -define(STATS_WINDOW_LEN, 5).
 
+% group commit
+-define(GROUP_COMMIT_MAX, 100).
+-define(GROUP_COMMIT_DELAY, 0).
+
+% streamed put: maximum time to wait for the next part of a value
+-define(UPLOAD_TIMEOUT, 60000).
+
 % replication
 -define(MAX_TRIES, 3).
 -define(REPL_TIMEOUT, 2000).
@@ -89,6 +96,11 @@ init([Home, DomainID, IsOwner, Prev, Next]) ->
 
         ChunkLimit = ringo_util:get_param(
                 "DOMAIN_CHUNK_MAX", ?DOMAIN_CHUNK_MAX),
+        BatchMax = ringo_util:get_param(
+                "GROUP_COMMIT_MAX", ?GROUP_COMMIT_MAX),
+        BatchDelay = ringo_util:get_param(
+                "GROUP_COMMIT_DELAY", ?GROUP_COMMIT_DELAY),
+        BatchSync = ringo_util:get_param("GROUP_COMMIT_FSYNC", 0) == 1,
 
         ReplHost = {ringo_util:get_param("RINGOHOST", net_adm:localhost()),
                         node(), self()},
@@ -114,7 +126,11 @@ init([Home, DomainID, IsOwner, Prev, Next]) ->
                      prevnode = Prev,
                      nextnode = Next,
                      extproc = ExtProc,
-                     index = none
+                     index = none,
+                     batch = none,
+                     batch_max = BatchMax,
+                     batch_delay = BatchDelay,
+                     batch_sync = BatchSync
                 },
 
         Domain = case catch open_domain(D0) of
@@ -238,6 +254,15 @@ handle_cast({new_domain, _, _, From, _}, D) ->
 %%% Put
 %%%
 
+% Group commit: Puts and replicated puts that are waiting in the mailbox are
+% handled together, and their entries are written to the DB with a single
+% write and flush. See group_commit below.
+handle_cast({put, _, _, _, _} = P, #domain{batch = none} = D) ->
+        group_commit(P, D);
+
+handle_cast({repl_put, _, _, _, _, _} = R, #domain{batch = none} = D) ->
+        group_commit(R, D);
+
 
 % DB not open: There may be two reasons for this:
 %
@@ -269,40 +294,13 @@ handle_cast({put, _, _, _, _} = P, #domain{index = none, home = Home,
 
 % normal case
 handle_cast({put, Key, Value, Flags, From}, #domain{owner = true, 
-        index = Index, full = Full, id = DomainID, info = InfoPack, db = DB,
-        prevnode = Prev} = D) when Full == false; Flags == [iblock] ->
+        full = Full, id = DomainID} = D) when Full == false; Flags == [iblock] ->
 
         EntryID = random:uniform(4294967295),
-        {E, _} = Entry = ringo_writer:make_entry(EntryID, Key, Value, Flags),
-        From ! {ringo_reply, DomainID, {ok, {node(), EntryID}}},
-       
-        {ok, Pos} = bfile:ftell(DB),
-        NewD = do_write(Entry, D),
-
-        % Don't index index blocks
-        if Flags =/= [iblock] ->
-                gen_server:cast(Index, {put, Key, Pos, Pos + iolist_size(E)});
-        true -> ok
-        end,
-
-        % See replicate_proc for different replication policies. Currently
-        % performing replication in another process is unsafe, since it 
-        % de-serializes the order in which entries hit replicas, which in
-        % turn may confuse resyncing process (ringo_reader can only detect
-        % duplicate EntryIDs that are consequent).
-        
-        % Currently the safest approach,
-        % in resyncing point of view, is to do opportunistic replication (no
-        % re-sends) in a serialized manner (i.e. no spawning).
-        Nrepl = proplists:get_value(nrepl, InfoPack),
-        DServer = self(),
-        replicate({DServer, DomainID, EntryID, Entry, Nrepl},
-                D#domain.this, Prev, 0),
-
-        %spawn(fun() -> replicate_proc(
-        %        {DServer, DomainID, EntryID, Entry, Nrepl}, 0)
-        %end),
-        {noreply, NewD};
+        Entry = ringo_writer:make_entry(EntryID, Key, Value, Flags),
+        NewD = owner_write(Key, EntryID, Entry, Flags, D),
+        {noreply, put_reply(From, {ringo_reply, DomainID,
+                {ok, {node(), EntryID}}}, NewD)};
 
 % chunk full
 handle_cast({put, _, _, _, From},
@@ -319,6 +317,109 @@ handle_cast({put, _, _, _, From},
 handle_cast({put, _, _, _, _}, #domain{owner = false} = D) ->
         {noreply, D};
         
+%%%
+%%% Streamed put
+%%%
+
+% A large value is streamed from the gateway to an external file, instead of
+% being sent in the put message. The domain starts a writer process, see
+% ringo_writer:receive_external, and replies {upload, Writer} to the
+% gateway, which sends the value to the writer in parts. When the file is
+% complete, the writer sends put_streamed back to the domain, which writes
+% the entry and replies as for a normal put. The entry is replicated without
+% the value, so replicas fetch the external file from the owner, as in
+% resyncing.
+%
+% The cases follow those of put above. Redirected streamed puts are written
+% by the node that accepts them, as in redir_put.
+
+handle_cast({put_stream, _, _, _, _} = P, #domain{db = none,
+        id = DomainID, owner = true, prevnode = Prev} = D) ->
+
+        gen_server:cast({ringo_node, Prev}, {{domain, DomainID},
+                {redir_put, node(), 1, P}}),
+        {noreply, D};
+
+handle_cast({put_stream, _, _, _, _} = P, #domain{index = none, home = Home,
+        owner = true, dbname = DBName, info = InfoPack} = D) ->
+
+        {ok, S} = ringo_indexdomain:start_link(self(), Home, DBName, InfoPack),
+        handle_cast(P, D#domain{index = S});
+
+handle_cast({put_stream, Key, Size, Flags, From}, #domain{owner = true,
+        full = false} = D) ->
+
+        put_stream(Key, Size, Flags, From, node(), D),
+        {noreply, D};
+
+handle_cast({put_stream, _, _, _, From},
+        #domain{id = DomainID, owner = true, full = true} = D) ->
+
+        Chunk = proplists:get_value(chunk, D#domain.info),
+        Flags = lists:sublist(D#domain.info, 3),
+        From ! {ringo_reply, DomainID, {error, domain_full, Chunk, Flags}},
+        {noreply, D};
+
+handle_cast({put_stream, _, _, _, _}, #domain{owner = false} = D) ->
+        {noreply, D};
+
+handle_cast({put_streamed, Key, EntryID, CRC, ExtFile, Size, Flags, From,
+        Owner}, #domain{id = DomainID, owner = IsOwner} = D) ->
+
+        Entry = ringo_writer:make_external_entry(EntryID, Key, CRC, ExtFile,
+                Flags),
+        % The external file is on disk already
+        D0 = D#domain{size = D#domain.size + Size},
+        NewD = if IsOwner, Owner == node() ->
+                owner_write(Key, EntryID, Entry, Flags, D0);
+        true ->
+                do_write(Entry, D0)
+        end,
+        {noreply, put_reply(From, {ringo_reply, DomainID,
+                {ok, {Owner, EntryID}}}, NewD)};
+
+
+%%%
+%%% Put many
+%%%
+
+% Put_many is a batch of put requests for the same domain. It is handled
+% similarly to the corresponding put cases above. Items are written in order
+% until the domain becomes full. In this case the reply contains results for
+% the items written so far, and the gateway sends the rest to the next chunk.
+
+handle_cast({put_many, _, _, _} = P, #domain{db = none,
+        id = DomainID, owner = true, prevnode = Prev} = D) ->
+        
+        gen_server:cast({ringo_node, Prev}, {{domain, DomainID},
+                {redir_put, node(), 1, P}}),
+        {noreply, D};
+
+handle_cast({put_many, _, _, _} = P, #domain{index = none, home = Home, 
+        owner = true, dbname = DBName, info = InfoPack} = D) ->
+
+        {ok, S} = ringo_indexdomain:start_link(self(), Home, DBName, InfoPack),
+        handle_cast(P, D#domain{index = S});
+
+handle_cast({put_many, Items, Flags, From}, #domain{owner = true,
+        full = false, id = DomainID} = D) ->
+        
+        {Reply, NewD} = put_many(Items, Flags, fun(Key, EntryID, Entry, Dx) ->
+                owner_write(Key, EntryID, Entry, Flags, Dx)
+        end, node(), D, []),
+        From ! {ringo_reply, DomainID, Reply},
+        {noreply, NewD};
+
+handle_cast({put_many, _, _, From},
+        #domain{id = DomainID, owner = true, full = true} = D) ->
+
+        Chunk = proplists:get_value(chunk, D#domain.info),
+        Flags = lists:sublist(D#domain.info, 3),
+        From ! {ringo_reply, DomainID, {error, domain_full, Chunk, Flags}}, 
+        {noreply, D};
+
+handle_cast({put_many, _, _, _}, #domain{owner = false} = D) ->
+        {noreply, D};
 
 %%%
 %%% Redirected put
@@ -331,6 +432,18 @@ handle_cast({redir_put, Owner, N, {put, _, _, _, From}},
         From ! {ringo_reply, DomainID, {error, invalid_domain}},
         {noreply, D};
 
+handle_cast({redir_put, Owner, N, {put_many, _, _, From}},
+        #domain{id = DomainID} = D) when Owner == node(); N > ?MAX_RING_SIZE ->
+
+        From ! {ringo_reply, DomainID, {error, invalid_domain}},
+        {noreply, D};
+
+handle_cast({redir_put, Owner, N, {put_stream, _, _, _, From}},
+        #domain{id = DomainID} = D) when Owner == node(); N > ?MAX_RING_SIZE ->
+
+        From ! {ringo_reply, DomainID, {error, invalid_domain}},
+        {noreply, D};
+
 % no domain on this node, forward
 handle_cast({redir_put, Owner, N, P},
         #domain{db = none, id = DomainID, prevnode = Prev} = D) ->
@@ -347,10 +460,31 @@ handle_cast({redir_put, Owner, _, {put, Key, Value, Flags, From}},
         From ! {ringo_reply, DomainID, {ok, {Owner, EntryID}}},
         {noreply, do_write(Entry, D)};
 
+handle_cast({redir_put, Owner, _, {put_many, Items, Flags, From}},
+        #domain{id = DomainID, full = false} = D) ->
+        
+        {Reply, NewD} = put_many(Items, Flags, fun(_, _, Entry, Dx) ->
+                do_write(Entry, Dx)
+        end, Owner, D, []),
+        From ! {ringo_reply, DomainID, Reply},
+        {noreply, NewD};
+
+handle_cast({redir_put, Owner, _, {put_stream, Key, Size, Flags, From}},
+        #domain{full = false} = D) ->
+
+        put_stream(Key, Size, Flags, From, Owner, D),
+        {noreply, D};
+
 % domain full, notify the sender
-handle_cast({redir_put, _, _, {put, _, _, _, From}},
+handle_cast({redir_put, _, _, P},
         #domain{id = DomainID, full = true} = D) ->
         
+        From = case P of
+                {put, _, _, _, F} -> F;
+                {put_many, _, _, F} -> F;
+                {put_stream, _, _, _, F} -> F
+        end,
+        
         % Make sure that the Flags list matches with the InfoPack definition
         % above
         Flags = lists:sublist(D#domain.info, 3),
@@ -379,24 +513,22 @@ handle_cast({get, Key, From}, #domain{owner = true, id = DomainID, db = DB,
                 {get, Key, From, M, node(), 1}}),
         {noreply, D};
 
-% Index not open: Now it's time to open it.
-handle_cast({get, _, _} = P, #domain{index = none, home = Home,
-        dbname = DBName, info = InfoPack} = D) ->
-        {ok, S} = ringo_indexdomain:start_link(self(), Home, DBName, InfoPack),
-        handle_cast(P, D#domain{index = S});
-
 % Normal case
-handle_cast({get, Key, From}, #domain{index = Index, info = Info} = D) ->
+handle_cast({get, Key, From}, D) ->
         %error_logger:info_report({"normal get", Key}),
-        if D#domain.full == true ->
-                Chunk = proplists:get_value(chunk, Info),
-                %error_logger:info_report({"Full", Key, Chunk}),
-                From ! {ringo_get, full, Chunk};
-        true -> ok
-        end,
-        gen_server:cast(Index, {get, Key, From}),
+        {noreply, local_get(Key, From, D)};
+
+% Replica get: The gateway chose this node to serve the get from its local
+% copy of the chunk (see Replica reads in handle_data). If the chunk doesn't
+% exist on this node, reply invalid_domain right away, so that the gateway
+% tries the next replica, instead of redirecting the request around the ring.
+handle_cast({get_replica, _, From}, #domain{db = none} = D) ->
+        From ! {ringo_get, invalid_domain},
         {noreply, D};
 
+handle_cast({get_replica, Key, From}, D) ->
+        {noreply, local_get(Key, From, D)};
+
 % Redirected get: Came back to the originator, or stuck in an infinite loop.
 % This is a normal outcome for the following unlikely scenario: Previous chunk
 % became full due to resyncing, which means that this chunk hasn't been created
@@ -453,7 +585,7 @@ handle_cast({repl_put, _, _, _, ODomain, _} = R, #domain{db = none} = D) ->
 
 % normal case
 handle_cast({repl_put, EntryID, Entry, {_, _, _OPid} = Owner, ODomain, N},
-        #domain{id = DomainID, prevnode = Prev} = D) ->
+        #domain{id = DomainID, prevnode = Prev, extproc = Ext} = D) ->
 
         if N > 1 ->
                 gen_server:cast({ringo_node, Prev}, {{domain, DomainID},
@@ -465,6 +597,17 @@ handle_cast({repl_put, EntryID, Entry, {_, _, _OPid} = Owner, ODomain, N},
         % will go unnoticed. On the other hand, write errors would probably
         % repeat with re-sent replicas, so the benefit is not clear.
         %OPid ! {repl_reply, {ok, EntryID}},
+        % Values of streamed puts are not sent with the entry, see Streamed
+        % put above
+        case Entry of
+                {E, {}} ->
+                        case ringo_reader:is_external(E) of
+                                true -> Ext ! {fetch, {ODomain,
+                                        iolist_to_binary(E)}};
+                                false -> ok
+                        end;
+                _ -> ok
+        end,
         {noreply, do_write(Entry, D)};
 
 %%%
@@ -614,7 +757,8 @@ handle_cast(update_domain_size, #domain{home = Home} = D) ->
         InfoFile = filename:join(Home, "info"),
         D0 = case file:read_file_info(InfoFile) of
                 {ok, NfoStats} -> D#domain{size = 
-                        domain_size(Home) - NfoStats#file_info.size};
+                        domain_size(Home) - NfoStats#file_info.size -
+                                ringo_sync:checkpoint_size(Home)};
                 _ -> D
         end,
         {noreply, D0};
@@ -630,7 +774,11 @@ handle_cast({get_status, From}, D) ->
                  {max_repl_entries, D#domain.max_repl_entries},
                  {size, D#domain.size},
                  {full, D#domain.full},
-                 {owner, D#domain.owner}] ++ ets:tab2list(D#domain.stats)},
+                 {owner, D#domain.owner}] ++ ets:tab2list(D#domain.stats) ++
+                 case ringo_valuecache:enabled() of
+                        true -> ringo_valuecache:stats();
+                        false -> []
+                 end},
         {noreply, D};
 
 handle_cast({kill_domain, Reason}, D) ->
@@ -718,11 +866,11 @@ open_db(#domain{home = Home, dbname = DBName} = D) ->
         {ok, DB} = bfile:fopen(DBName, "a"),
         {ok, Nfo} = file:script(InfoFile),
         % Domain directory should not contain anything else besides the DB file,
-        % external values including iblocks, and the info file and possible an
-        % empty closed-file. Everything except the info files is counted to the
-        % domain size.
-        D#domain{db = DB, size = domain_size(Home) - NfoStats#file_info.size,
-                 full = Full, info = Nfo}.
+        % external values including iblocks, and the info file, the sync
+        % checkpoint and possible an empty closed-file. Everything except the
+        % info and checkpoint files is counted to the domain size.
+        D#domain{db = DB, size = domain_size(Home) - NfoStats#file_info.size -
+                 ringo_sync:checkpoint_size(Home), full = Full, info = Nfo}.
 
 domain_size(Home) ->
         [Size, _] = string:tokens(os:cmd(["du -b ", Home, " |tail -1"]), "\t"),
@@ -773,6 +921,84 @@ replicate({DServer, DomainID, EntryID, Entry, Nrepl} = _R, Me, Prev, _Tries) ->
 %                replicate(R, Prev, Tries + 1)
 %        end.
 
+% Writes a new entry on the owner node, indexes it and replicates it.
+owner_write(Key, EntryID, {E, _} = Entry, Flags, #domain{
+        id = DomainID, info = InfoPack, prevnode = Prev} = D) ->
+
+        {Pos, D1} = write_pos(D),
+        D2 = do_write(Entry, D1),
+
+        % Don't index index blocks
+        NewD = if Flags =/= [iblock] ->
+                notify_index({put, Key, Pos, Pos + iolist_size(E)}, D2);
+        true -> D2
+        end,
+
+        % See replicate_proc for different replication policies. Currently
+        % performing replication in another process is unsafe, since it 
+        % de-serializes the order in which entries hit replicas, which in
+        % turn may confuse resyncing process (ringo_reader can only detect
+        % duplicate EntryIDs that are consequent).
+        
+        % Currently the safest approach,
+        % in resyncing point of view, is to do opportunistic replication (no
+        % re-sends) in a serialized manner (i.e. no spawning).
+        Nrepl = proplists:get_value(nrepl, InfoPack),
+        DServer = self(),
+        replicate({DServer, DomainID, EntryID, Entry, Nrepl},
+                D#domain.this, Prev, 0),
+
+        %spawn(fun() -> replicate_proc(
+        %        {DServer, DomainID, EntryID, Entry, Nrepl}, 0)
+        %end),
+        NewD.
+
+% Starts a writer for a streamed put, see Streamed put above. Owner is the
+% node that is reported to the client as the one that accepted the put.
+put_stream(Key, Size, Flags, From, Owner, #domain{id = DomainID,
+        home = Home} = D) ->
+        EntryID = random:uniform(4294967295),
+        Domain = self(),
+        Writer = spawn(fun() ->
+                case catch ringo_writer:receive_external(Home, EntryID, Size,
+                                From, ?UPLOAD_TIMEOUT) of
+                        {ok, CRC, ExtFile} ->
+                                gen_server:cast(Domain, {put_streamed, Key,
+                                        EntryID, CRC, ExtFile, Size, Flags,
+                                        From, Owner});
+                        Error ->
+                                error_logger:warning_report(
+                                        {"Streamed put failed", Error}),
+                                From ! {ringo_reply, DomainID,
+                                        {error, upload_failed}}
+                end
+        end),
+        From ! {ringo_reply, DomainID, {upload, Writer}}.
+
+% Writes Items, a list of {Key, Value} pairs, with WriteFun until the domain
+% becomes full. Returns {many, Replies}, or {many, Replies, DomainFull} if
+% some items were left unwritten, in which case the sender should put the
+% rest (lists:nthtail(length(Replies), Items)) to the next chunk.
+put_many([], _, _, _, D, Replies) ->
+        {{many, lists:reverse(Replies)}, D};
+
+put_many(_, _, _, _, #domain{full = true} = D, Replies) ->
+        Flags = lists:sublist(D#domain.info, 3),
+        Chunk = proplists:get_value(chunk, D#domain.info),
+        {{many, lists:reverse(Replies), {error, domain_full, Chunk, Flags}}, D};
+
+put_many([{Key, Value}|Items], Flags, WriteFun, Node, D, Replies) ->
+        EntryID = random:uniform(4294967295),
+        case ringo_writer:make_entry(EntryID, Key, Value, Flags) of
+                invalid_request ->
+                        put_many(Items, Flags, WriteFun, Node, D,
+                                [{error, invalid_request}|Replies]);
+                Entry ->
+                        NewD = WriteFun(Key, EntryID, Entry, D),
+                        put_many(Items, Flags, WriteFun, Node, NewD,
+                                [{ok, {Node, EntryID}}|Replies])
+        end.
+
 open_or_clone(Req, From, D) ->
         case catch open_domain(D) of 
                 NewD when is_record(NewD, domain) -> handle_cast(Req, NewD);
@@ -781,6 +1007,22 @@ open_or_clone(Req, From, D) ->
                      handle_cast(Req, NewD)
         end.
 
+% Gets are served by the index process, which is opened on the first get
+local_get(Key, From, #domain{index = none, home = Home, dbname = DBName,
+        info = InfoPack} = D) ->
+        {ok, S} = ringo_indexdomain:start_link(self(), Home, DBName, InfoPack),
+        local_get(Key, From, D#domain{index = S});
+
+local_get(Key, From, #domain{index = Index, info = Info} = D) ->
+        if D#domain.full == true ->
+                Chunk = proplists:get_value(chunk, Info),
+                %error_logger:info_report({"Full", Key, Chunk}),
+                From ! {ringo_get, full, Chunk};
+        true -> ok
+        end,
+        gen_server:cast(Index, {get, Key, From}),
+        D.
+
 % Should we prevent replica or sync entries to be added if the resulting
 % chunk would exceed the maximum size? If yes, spontaneously corrupted entries
 % can't be fixed. If no, a chunk may grow infinitely large. In this case, it is
@@ -790,9 +1032,32 @@ open_or_clone(Req, From, D) ->
 % We trust that any function that calls do_write has checked fullness of the
 % domain already. If the domain is full and do_write() is called anyway, we 
 % believe that the caller has a good reason for that and perform write normally.
-do_write({E, Ext} = Entry, #domain{db = DB, home = Home} = D) ->
+do_write(Entry, #domain{batch = open} = D) ->
+        {_, NewD} = write_pos(D),
+        do_write(Entry, NewD);
+
+do_write({E, Ext} = Entry, #domain{batch = {Pos, Buf, Notify},
+        home = Home} = D) ->
+        case Ext of
+                {} -> ok;
+                {ExtFile, Value} ->
+                        ringo_writer:write_external(Home, ExtFile, Value)
+        end,
+        NewD = D#domain{batch = {Pos + iolist_size(E), [E|Buf], Notify}},
+        % Entries must be on disk before the closed file appears
+        S = ringo_writer:entry_size(Entry) + D#domain.size,
+        if S > D#domain.domain_chunk_max ->
+                update_size(Entry, commit_batch(NewD));
+        true ->
+                update_size(Entry, NewD)
+        end;
+
+do_write(Entry, #domain{db = DB, home = Home} = D) ->
         ringo_writer:write_entry(Home, DB, Entry),
         bfile:fflush(DB),
+        update_size(Entry, D).
+
+update_size({E, Ext}, #domain{home = Home} = D) ->
         S = if Ext == {} ->
                 iolist_size(E);
         true ->
@@ -808,6 +1073,108 @@ do_write({E, Ext} = Entry, #domain{db = DB, home = Home} = D) ->
                         num_entries = D#domain.num_entries + 1}
         end.   
 
+%%%
+%%% Group commit
+%%%
+
+% Group_commit handles the put or repl_put request P, and then further puts
+% and repl_puts from the mailbox, up to batch_max requests in total. If
+% batch_delay is positive, it waits for at most batch_delay milliseconds for
+% more requests to arrive. Otherwise only the requests that are already in
+% the mailbox are handled.
+%
+% While a batch is open, do_write buffers entries instead of writing them,
+% and index updates are delayed until the entries have been flushed, so that
+% the index never points to entries that can't be read yet. Replies to puts
+% are delayed likewise, so a put is acknowledged only after its entry has
+% been flushed, or fsynced if batch_sync is set. Replication messages are
+% sent as usual. The batch is always committed before any other request is
+% handled, so other requests see the DB as without group commit.
+%
+% Note that this takes requests directly from the gen_server mailbox, which
+% relies on the gen_server message formats. Only the message at the head of
+% the mailbox is taken, so that puts never overtake earlier gets or syncs. If
+% it isn't a put, the batch is committed and the message is handled as
+% gen_server would handle it.
+group_commit(P, #domain{batch_delay = Delay} = D) ->
+        {noreply, D1} = handle_cast(P, D#domain{batch = open}),
+        {D2, Next} = drain_puts(D1, 1, now(), Delay),
+        D3 = (commit_batch(D2))#domain{batch = none},
+        case Next of
+                none -> {noreply, D3};
+                {'$gen_cast', Msg} -> handle_cast(Msg, D3);
+                {'$gen_call', From, Req} ->
+                        case handle_call(Req, From, D3) of
+                                {reply, Reply, D4} ->
+                                        gen_server:reply(From, Reply),
+                                        {noreply, D4};
+                                Other -> Other
+                        end;
+                % System messages (sys module) can't be handled in a
+                % callback. They don't touch the DB, so their order doesn't
+                % matter.
+                {system, _, _} ->
+                        self() ! Next,
+                        {noreply, D3};
+                _ -> handle_info(Next, D3)
+        end.
+
+drain_puts(#domain{batch_max = Max} = D, N, _, _) when N >= Max -> {D, none};
+drain_puts(D, N, Started, Delay) ->
+        Timeout = lists:max([0,
+                Delay - timer:now_diff(now(), Started) div 1000]),
+        receive
+                {'$gen_cast', {put, _, _, _, _} = P} ->
+                        {noreply, NewD} = handle_cast(P, D),
+                        drain_puts(NewD, N + 1, Started, Delay);
+                {'$gen_cast', {repl_put, _, _, _, _, _} = R} ->
+                        {noreply, NewD} = handle_cast(R, D),
+                        drain_puts(NewD, N + 1, Started, Delay);
+                Msg ->
+                        {D, Msg}
+        after Timeout ->
+                {D, none}
+        end.
+
+% Returns the position where the next entry will be written
+write_pos(#domain{batch = none, db = DB} = D) ->
+        {ok, Pos} = bfile:ftell(DB),
+        {Pos, D};
+write_pos(#domain{batch = open, db = DB} = D) ->
+        {ok, Pos} = bfile:ftell(DB),
+        {Pos, D#domain{batch = {Pos, [], []}}};
+write_pos(#domain{batch = {Pos, _, _}} = D) ->
+        {Pos, D}.
+
+notify_index(Msg, #domain{batch = {Pos, Buf, Notify}, index = Index} = D) ->
+        D#domain{batch = {Pos, Buf, [{cast, Index, Msg}|Notify]}};
+notify_index(Msg, #domain{index = Index} = D) ->
+        gen_server:cast(Index, Msg),
+        D.
+
+% Must be called after the entry has been written with do_write. If the batch
+% was committed by the write, the reply can be sent right away.
+put_reply(From, Msg, #domain{batch = {Pos, Buf, Notify}} = D) ->
+        D#domain{batch = {Pos, Buf, [{send, From, Msg}|Notify]}};
+put_reply(From, Msg, D) ->
+        From ! Msg,
+        D.
+
+commit_batch(#domain{batch = {_, Buf, Notify}, db = DB,
+        batch_sync = Sync} = D) ->
+        ok = bfile:fwrite(DB, lists:reverse(Buf)),
+        if Sync ->
+                ok = bfile:fsync(DB);
+        true ->
+                ok = bfile:fflush(DB)
+        end,
+        lists:foreach(fun
+                ({cast, Index, Msg}) -> gen_server:cast(Index, Msg);
+                ({send, From, Msg}) -> From ! Msg
+        end, lists:reverse(Notify)),
+        D#domain{batch = open};
+commit_batch(D) -> D.
+
 close_domain(true, _) -> ok;
 close_domain(_, Home) ->
         CFile = filename:join(Home, "closed"),
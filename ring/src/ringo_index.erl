@@ -1,6 +1,9 @@
 -module(ringo_index).
--export([build_index/3, fetch_entry/4, new_dex/0, add_item/3, serialize/1]).
+-export([build_index/3, fetch_entry/4, fetch_link/3, new_dex/0, add_item/3]).
+-export([delete_dex/1, dex_keys/1]).
+-export([serialize/1]).
 -export([deserialize/1, dexhash/1, find_key/2, find_key/3, decode_poslist/1]).
+-export([key_hashes/1]).
 
 -include("ringo_store.hrl").
 
@@ -15,13 +18,22 @@ build_index(DBName, StartPos, Num) ->
         end, {0, new_dex(), 0}, DBName, true, StartPos).
 
 fetch_entry(DB, Home, Key, Offset) ->
-        case ringo_reader:read_entry(DB, Offset) of
-                % key matches -- a valid external entry
-                {Time, _, Flags, Key, V, _} when ?FLAG_UP(Flags, ?EXT_FLAG) ->
+        case fetch_link(DB, Key, Offset) of
+                {Time, Key, {external, V}} ->
                         case ringo_reader:read_external(Home, V) of
                                 {ok, Value} -> {Time, Key, Value};
                                 _ -> invalid_entry
                         end;
+                R -> R
+        end.
+
+% Same as fetch_entry, but external values are not read. Instead, their links
+% are returned as {external, Link}.
+fetch_link(DB, Key, Offset) ->
+        case ringo_reader:read_entry(DB, Offset) of
+                % key matches -- a valid external entry
+                {Time, _, Flags, Key, V, _} when ?FLAG_UP(Flags, ?EXT_FLAG) ->
+                        {Time, Key, {external, V}};
                 % key matches -- a valid internal entry
                 {Time, _, _, Key, Value, _} -> {Time, Key, Value};
                 % entry corrupted -- should not happen 
@@ -30,30 +42,41 @@ fetch_entry(DB, Home, Key, Offset) ->
                 _ -> ignore
         end.
 
-new_dex() -> gb_trees:empty().
+% The active (non-serialized) index is an ets table of {Hash, LastPos, PosList}
+% tuples, where PosList is an elias-gamma coded delta list of positions, as
+% in the serialized index. The table is updated in place, so add_item returns
+% the same Dex that it was given. The table is owned by the calling process
+% and it must be freed with delete_dex once the index has been serialized.
+new_dex() -> ets:new(dex, [set]).
+
+delete_dex(Dex) -> ets:delete(Dex).
+
+% sorted list of key hashes in the active index
+dex_keys(Dex) -> lists:sort([K || {K, _, _} <- ets:tab2list(Dex)]).
 
 dexhash(Key) ->
         <<Hash:32, _/binary>> = erlang:md5(Key), Hash.
 
 add_item(Dex, Key, Pos) ->
         Hash = dexhash(Key),
-        gb_trees:enter(Hash, add_pos(gb_trees:lookup(Hash, Dex), Pos), Dex).
+        ets:insert(Dex, add_pos(Hash, ets:lookup(Dex, Hash), Pos)),
+        Dex.
 
-add_pos(none, Pos) ->
-        {Pos, <<Pos:32>>};
+add_pos(Hash, [], Pos) ->
+        {Hash, Pos, <<Pos:32>>};
 
-add_pos({value, {PrevPos, Lst}}, Pos) ->
-        {Pos, <<Lst/bits, (elias_encode(Pos - PrevPos))/bits>>}.
+add_pos(Hash, [{_, PrevPos, Lst}], Pos) ->
+        {Hash, Pos, <<Lst/bits, (elias_encode(Pos - PrevPos))/bits>>}.
 
 serialize(Dex) ->
-        L = gb_trees:to_list(Dex),
+        L = lists:sort(ets:tab2list(Dex)),
         {Single, Multi} = lists:partition(fun
-                ({_, {_, <<_:32>>}}) -> true;
+                ({_, _, <<_:32>>}) -> true;
                 (_) -> false
         end, L),
         SingleSeg = bin_util:encode_kvsegment(
-                [{K, V} || {K, {_, <<V:32>>}} <- Single]),
-        {KeysOffs, _} = lists:mapfoldl(fun({K, {_, V}}, Offs) ->
+                [{K, V} || {K, _, <<V:32>>} <- Single]),
+        {KeysOffs, _} = lists:mapfoldl(fun({K, _, V}, Offs) ->
                 % We mark end of the offset list with an elias-encoded value 1.
                 % This is safe, since real offsets are always at least 40 bytes,
                 % because of entry headers etc.
@@ -73,21 +96,17 @@ deserialize(Dex) ->
                 Offsets:OffsetSize/binary>> = Dex,
         {SingleSeg, MultiSeg, Offsets}.
 
+% list of key hashes in a serialized index
+key_hashes(Dex) ->
+        {SingleSeg, MultiSeg, _} = deserialize(Dex),
+        [K || {K, _} <- bin_util:decode_kvsegment(SingleSeg) ++
+                bin_util:decode_kvsegment(MultiSeg)].
+
 find_key(Key, Dex) -> find_key(Key, Dex, true).
 
 find_key(Key, Dex, DoDecode) when is_binary(Key) ->
         find_key(dexhash(Key), Dex, DoDecode);
 
-% non-serialized index. NB: Make sure that when-clause matches with the actual
-% data structure used by the active index -- gb_trees is a tuple.
-find_key(Key, Dex, DoDecode) when is_tuple(Dex) ->
-        case gb_trees:lookup(Key, Dex) of
-                none -> {Key, []};
-                {value, {_, Lst}} when DoDecode == true ->
-                        {Key, decode_poslist(Lst)};
-                {value, {_, Lst}} -> {Key, Lst}
-        end;
-
 % serialized index
 find_key(Key, Dex, DoDecode) when is_binary(Dex) ->
         <<SingleSegSize:32, MultiSegSize:32, OffsetSize:32,
@@ -108,6 +127,15 @@ find_key(Key, Dex, DoDecode) when is_binary(Dex) ->
                 end;
         DoDecode == true -> {Key, [R]};
         true -> {Key, <<R:32>>}
+        end;
+
+% non-serialized index, i.e. an ets table
+find_key(Key, Dex, DoDecode) ->
+        case ets:lookup(Dex, Key) of
+                [] -> {Key, []};
+                [{_, _, Lst}] when DoDecode == true ->
+                        {Key, decode_poslist(Lst)};
+                [{_, _, Lst}] -> {Key, Lst}
         end.
 
 decode_poslist(<<P:32, B/bits>>) -> decode_poslist(B, [P]).
@@ -3,6 +3,9 @@
 
 -define(IBLOCK_SIZE, 10000).
 -define(KEYCACHE_LIMIT, 16 * 1024).
+-define(BLOOM_BITS_PER_KEY, 10).
+-define(DOWNLOAD_WINDOW, 8).
+-define(DOWNLOAD_TIMEOUT, 60000).
 
 % - cur_iblock is the currently active index (iblock), as returned by 
 %    ringo_index:new_dex()
@@ -11,8 +14,13 @@
 %   current index
 % - cur_offs is the end offset in the DB to the latest entry in the
 %   current index
+% - iblocks is a list of {IblockFile, Filter} pairs, where Filter is a
+%   bloomfilter of the keys in the iblock in keycache mode, none otherwise
+% - cache_size is the total size of the entries in the keycache, as
+%   computed by entry_size()
 -record(index, {cur_iblock, cur_size, cur_start, cur_offs, iblocks, db,
-        cache_type, cache, domain, home, dbname, cache_limit}).
+        cache_type, cache, cache_size, domain, home, dbname, cache_limit,
+        valuecache}).
 
 -export([start_link/4, init/1, handle_call/3, handle_cast/2, handle_info/2, 
          terminate/2, code_change/3]).
@@ -31,8 +39,11 @@
 % nature of the application the LRU assumption holds for keys, keycache
 % should be a viable alternative. The crucial point is that it should
 % take less memory than the iblock cache, which seems to be a difficult
-% goal to achieve, given that we have to maintain *two* gb_trees, one for
-% the cache proper and for the LRU structure.
+% goal to achieve, given that we have to maintain *two* structures, one for
+% the cache proper and for the LRU structure. Both are ets tables that are
+% updated in place, so a lookup doesn't allocate new tree nodes, and the
+% total size of the cache is tracked in cache_size instead of re-computing
+% it on every miss.
 
 start_link(Domain, Home, DBName, Options) ->
         S = case gen_server:start_link(ringo_indexdomain, 
@@ -49,7 +60,8 @@ init([Domain, Home, DBName, Options]) ->
                 proplists:get_value(keycache, Options, false),
                 proplists:get_value(noindex, Options, false)} of
                         {_, true} -> {none, none};
-                        {true, false} -> {key, {gb_trees:empty(), lrucache:new()}};
+                        {true, false} -> {key, {ets:new(keycache, [set]),
+                                lrucache:new()}};
                         {false, false} -> {iblock, []}
                 end,
         CacheLimit = ringo_util:get_param("KEYCACHE_LIMIT", ?KEYCACHE_LIMIT),
@@ -62,6 +74,8 @@ init([Domain, Home, DBName, Options]) ->
                    cache_type = CacheType,
                    cache_limit = CacheLimit,
                    cache = Cache,
+                   cache_size = 0,
+                   valuecache = ringo_valuecache:enabled(),
                    domain = Domain,
                    db = DB,
                    home = Home,
@@ -72,24 +86,26 @@ init([Domain, Home, DBName, Options]) ->
 handle_call(_, _, D) -> {reply, error, D}.
 
 handle_cast({get, Key, From}, #index{cache_type = iblock, db = DB,
-        cache = Cache, cur_iblock = Current, home = Home} = D) ->
+        cache = Cache, cur_iblock = Current, home = Home,
+        valuecache = VCache} = D) ->
         
         Hash = ringo_index:dexhash(Key),
         Offsets = lists:flatten([begin
                 {_, L} = ringo_index:find_key(Hash, Iblock), L
         end || Iblock <- lists:reverse([Current|Cache])]),
-        send_entries(Offsets, From, DB, Home, Key),
+        send_entries(Offsets, From, DB, Home, Key, VCache),
         {noreply, D};
 
 handle_cast({get, Key, From}, #index{cache_type = key,
-        home = Home, db = DB, cur_iblock = Current} = D) ->
+        home = Home, db = DB, cur_iblock = Current,
+        valuecache = VCache} = D) ->
         
         Hash = ringo_index:dexhash(Key),
         {Lst, D0} = keycache_get(Key, D),
         {_, CL} = ringo_index:find_key(Hash, Current, false),
         Offsets = lists:flatten([ringo_index:decode_poslist(P) ||
                 P <- Lst ++ [CL], is_bitstring(P)]),
-        send_entries(Offsets, From, DB, Home, Key),
+        send_entries(Offsets, From, DB, Home, Key, VCache),
         {noreply, D0};
 
 handle_cast({get, _, _}, #index{cache_type = none,
@@ -143,7 +159,9 @@ handle_cast(initialize, #index{home = Home} = D) ->
         {noreply, index_iblock(D0, ?IBLOCK_SIZE)}.
 
 index_iblock(D, N) when N < ?IBLOCK_SIZE -> D;
-index_iblock(#index{dbname = DBName, cur_offs = StartPos} = D, _) ->
+index_iblock(#index{dbname = DBName, cur_offs = StartPos,
+        cur_iblock = Current} = D, _) ->
+        ringo_index:delete_dex(Current),
         {N, Dex, EndPos} = ringo_index:build_index(DBName, StartPos,
                 ?IBLOCK_SIZE),
         D0 = save_iblock(D#index{cur_iblock = Dex, cur_start = StartPos,
@@ -158,19 +176,138 @@ handle_info({ringo_reply, _, _}, D) ->
 %%% Send entries, one by one, to the requester
 %%%
 
-send_entries(Offsets, From, DB, Home, Key) ->
+send_entries(Offsets, From, DB, Home, Key, false) ->
         % Offsets should be in increasing order to benefit most from read-ahead
         % buffering and page caching.
-        lists:foreach(fun(Offset) ->
-                case ringo_index:fetch_entry(DB, Home, Key, Offset) of
+        Replies = lists:foldl(fun(Offset, L) ->
+                case ringo_index:fetch_link(DB, Key, Offset) of
+                        {_Time, _Key, {external, Link}} ->
+                                [{external, Link}|L];
                         {_Time, _Key, Value} ->
-                                From ! {ringo_get, {entry, Value}};
+                                [{entry, Value}|L];
                         % ignore corruped entries -- might not be wise
-                        invalid_entry -> ok;
-                        ignore -> ok
+                        invalid_entry -> L;
+                        ignore -> L
                 end
-        end, Offsets),
-        From ! {ringo_get, done}.
+        end, [], Offsets),
+        send_replies(From, Home, lists:reverse(Replies));
+
+% Same as above, but values are served from the node's value cache if
+% possible. Values that are read from disk are offered to the cache, see
+% ringo_valuecache for the admission policy. The cached key is compared to
+% Key to ignore hash collisions, as fetch_link does.
+send_entries(Offsets, From, DB, Home, Key, true) ->
+        Replies = lists:foldl(fun(Offset, L) ->
+                case ringo_valuecache:lookup(self(), Offset) of
+                        {ok, Key, {external, Value}} -> [{value, Value}|L];
+                        {ok, Key, Value} -> [{entry, Value}|L];
+                        {ok, _, _} -> L;
+                        none -> fetch_and_cache(DB, Home, Key, Offset) ++ L
+                end
+        end, [], Offsets),
+        send_replies(From, Home, lists:reverse(Replies)).
+
+fetch_and_cache(DB, Home, Key, Offset) ->
+        case ringo_index:fetch_link(DB, Key, Offset) of
+                {_Time, _Key, {external, Link}} ->
+                        Max = ringo_valuecache:item_max(),
+                        case ringo_reader:external_size(Home, Link) of
+                                {ok, Size} when Size =< Max ->
+                                        cache_external(Home, Key, Offset,
+                                                Link);
+                                _ -> [{external, Link}]
+                        end;
+                {_Time, _Key, Value} ->
+                        ringo_valuecache:insert(self(), Offset, Key, Value),
+                        [{entry, Value}];
+                invalid_entry -> [];
+                ignore -> []
+        end.
+
+% Small external values are read as a whole and sent in one part
+cache_external(Home, Key, Offset, Link) ->
+        case ringo_reader:read_external(Home, Link) of
+                {ok, Value} ->
+                        ringo_valuecache:insert(self(), Offset, Key,
+                                {external, Value}),
+                        [{value, Value}];
+                _ -> []
+        end.
+
+% Replies is a list of {entry, Value} for internal values, {value, Value}
+% for small external values, and {external, Link} for external values that
+% are read from disk while they are sent.
+%
+% External values are sent in parts, which the requester acknowledges as it
+% consumes them, like a streamed put (see ringo_writer:receive_external).
+% Replies that contain external values are thus sent by a separate process,
+% so the index isn't blocked by a slow requester.
+send_replies(From, Home, Replies) ->
+        case [E || {entry, _} = E <- Replies] of
+                Replies ->
+                        [From ! {ringo_get, E} || E <- Replies],
+                        From ! {ringo_get, done};
+                _ ->
+                        spawn(fun() ->
+                                erlang:monitor(process, From),
+                                stream_replies(From, Home, Replies)
+                        end)
+        end.
+
+stream_replies(From, _Home, []) ->
+        From ! {ringo_get, done};
+
+stream_replies(From, Home, [{entry, _} = E|Replies]) ->
+        From ! {ringo_get, E},
+        stream_replies(From, Home, Replies);
+
+stream_replies(From, Home, [{value, Value}|Replies]) ->
+        From ! {ringo_get, {entry_head, self(), size(Value)}},
+        wait_acks(From, send_part(From, Value, 0)),
+        stream_replies(From, Home, Replies);
+
+stream_replies(From, Home, [{external, Link}|Replies]) ->
+        case send_external(From, Home, Link) of
+                {ok, InFlight} -> wait_acks(From, InFlight);
+                _ -> ok
+        end,
+        stream_replies(From, Home, Replies).
+
+% External values may be large, so they are sent in parts. The header tells
+% the size of the value, so the requester knows when the value ends. Parts
+% are tagged with the sender's pid, which lets the requester tell them apart
+% from parts sent by other domains at the same time, and tells where to send
+% the acknowledgements.
+send_external(From, Home, Link) ->
+        ringo_reader:stream_external(Home, Link, fun
+                ({size, Size}, InFlight) ->
+                        From ! {ringo_get, {entry_head, self(), Size}},
+                        InFlight;
+                ({data, B}, InFlight) ->
+                        send_part(From, B, InFlight)
+        end, 0).
+
+% At most DOWNLOAD_WINDOW parts are unacknowledged at any time. Returns the
+% number of unacknowledged parts.
+send_part(From, B, InFlight) when InFlight >= ?DOWNLOAD_WINDOW ->
+        wait_acks(From, 1),
+        send_part(From, B, InFlight - 1);
+send_part(From, B, InFlight) ->
+        From ! {ringo_get, {entry_part, self(), B}},
+        InFlight + 1.
+
+% All the parts of a value are acknowledged before the next reply is sent,
+% so that the requester can leave the parts in its mailbox until it is ready
+% to consume them. If the requester goes away or stops consuming, the rest of
+% the replies are dropped.
+wait_acks(_From, 0) -> ok;
+wait_acks(From, N) ->
+        receive
+                {entry_ack, _} -> wait_acks(From, N - 1);
+                {'DOWN', _, process, From, _} -> exit(normal)
+        after ?DOWNLOAD_TIMEOUT ->
+                exit(normal)
+        end.
 
 %%%
 %%% Iblock becomes full
@@ -185,84 +322,97 @@ save_iblock(#index{cur_iblock = Iblock, cur_start = Start,
         save_iblock(Key, iolist_to_binary(ringo_index:serialize(Iblock)), D).
         
 save_iblock(Key0, SIblock, #index{domain = Domain, cur_offs = End,
-        iblocks = Iblocks} = D) ->
+        iblocks = Iblocks, cur_iblock = Current} = D) ->
 
         Key = iolist_to_binary(Key0),
         error_logger:info_report({"handling iblock", Key, "end", End}),
         gen_server:cast(Domain, {put, Key, SIblock, [iblock], self()}),
         D0 = update_cache(SIblock, D),
         error_logger:info_report({"Iblock full! ok"}),
+        ringo_index:delete_dex(Current),
         D0#index{cur_start = End, cur_iblock = ringo_index:new_dex(),
-                 cur_size = 0, iblocks = Iblocks ++ [Key]}.
+                 cur_size = 0,
+                 iblocks = Iblocks ++ [{Key, iblock_filter(SIblock, D)}]}.
+
+% In keycache mode, a cache miss would have to read every iblock from disk
+% to find the key. A Bloom filter is kept in memory for each iblock, so that
+% only iblocks that may contain the key are read. Filters take about
+% BLOOM_BITS_PER_KEY bits per key and are re-built from the iblocks when the
+% index is initialized, which reads them anyway.
+iblock_filter(SIblock, #index{cache_type = key}) ->
+        bloomfilter:new(ringo_index:key_hashes(SIblock), ?BLOOM_BITS_PER_KEY);
+iblock_filter(_, _) -> none.
 
 update_cache(SIblock, #index{cache_type = iblock, cache = Cache} = D) ->
         D#index{cache = [SIblock|Cache]};
 
-update_cache(SIblock, #index{cache_type = key, cache = {Cache, LRU}} = D) ->
-        error_logger:info_report({"Ipdate cache"}),
-        NC = lists:foldl(fun({Key, {Sze, V} = X}, C) ->
-                {_, L} = ringo_index:find_key(Key, SIblock, false),
-                if L == [] ->
-                        gb_trees:insert(Key, X, C);
-                true ->  
-                        gb_trees:insert(Key, {Sze + size(L), V ++ [L]}, C)
+update_cache(SIblock, #index{cache_type = key, cache = {Cache, _},
+        cache_size = CacheSze} = D) ->
+        error_logger:info_report({"Update cache"}),
+        {Updates, Delta} = ets:foldl(fun({Key, Sze, V}, {L0, S}) ->
+                case ringo_index:find_key(Key, SIblock, false) of
+                        {_, []} -> {L0, S};
+                        {_, L} -> {[{Key, Sze + size(L), V ++ [L]}|L0],
+                                S + size(L)}
                 end
-        end, gb_trees:empty(), gb_trees:to_list(Cache)),
-        D#index{cache = {NC, LRU}}.
+        end, {[], 0}, Cache),
+        ets:insert(Cache, Updates),
+        D#index{cache_size = CacheSze + Delta}.
        
 %%%
 %%% Keycache
 %%%
 
 keycache_get(Key, #index{cache = {Cache, _}} = D) ->
-        update_keycache(Key, gb_trees:lookup(Key, Cache), D).
+        update_keycache(Key, ets:lookup(Cache, Key), D).
 
 % cache hit
-update_keycache(Key, {value, {_, Lst}}, #index{cache = {Cache, LRU}} = D) ->
+update_keycache(Key, [{_, _, Lst}], #index{cache = {Cache, LRU}} = D) ->
         {Lst, D#index{cache = {Cache, lrucache:update(Key, LRU)}}};
 
 % cache miss
-update_keycache(Key, none, #index{home = Home, iblocks = Iblocks,
-        cache = {Cache, _}} = D) ->
-
-        Sze = gb_fold(fun(S, _, {Sze, _}) -> S + Sze end, 0, 
-                gb_trees:iterator(Cache)),
+update_keycache(Key, [], #index{home = Home, iblocks = Iblocks} = D) ->
         KeyOffsets = keycache_newentry(Key, Iblocks, Home),
         EntrySize = entry_size(Key, KeyOffsets),
-        D0 = keycache_evict(Sze, EntrySize, D),
-        {Cache0, LRU0} = D0#index.cache,
-        CacheValue = {EntrySize, KeyOffsets}, 
-        update_keycache(Key, {value, CacheValue}, D0#index{cache = 
-                {gb_trees:insert(Key, CacheValue, Cache0), LRU0}}).
+        #index{cache = {Cache, _}, cache_size = Sze} = D0 =
+                keycache_evict(EntrySize, D),
+        CacheValue = {Key, EntrySize, KeyOffsets},
+        ets:insert(Cache, CacheValue),
+        update_keycache(Key, [CacheValue], D0#index{
+                cache_size = Sze + EntrySize}).
 
 keycache_newentry(Key, Iblocks, Home) ->
         Hash = ringo_index:dexhash(Key),
-        lists:map(fun(IblockFile) ->
-                Path = filename:join(Home, binary_to_list(IblockFile)),
-                case ringo_reader:read_file(Path) of
-                        {ok, Iblock} -> {_, L} = ringo_index:find_key(
-                                Hash, Iblock, false), L;
-                        _ -> []
+        lists:map(fun({IblockFile, Filter}) ->
+                case bloomfilter:member(Hash, Filter) of
+                        false -> [];
+                        true -> keycache_readentry(Hash, IblockFile, Home)
                 end
         end, Iblocks).
 
-keycache_evict(CacheSze, EntrySze, #index{cache_limit = Limit} = D)
-        when CacheSze + EntrySze < Limit -> D;
+keycache_readentry(Hash, IblockFile, Home) ->
+        Path = filename:join(Home, binary_to_list(IblockFile)),
+        case ringo_reader:read_file(Path) of
+                {ok, Iblock} -> {_, L} = ringo_index:find_key(
+                        Hash, Iblock, false), L;
+                _ -> []
+        end.
+
+keycache_evict(EntrySze, #index{cache_size = CacheSze,
+        cache_limit = Limit} = D) when CacheSze + EntrySze < Limit -> D;
 
-keycache_evict(CacheSze, EntrySze, #index{cache = {Cache, LRU}} = D) ->
+keycache_evict(EntrySze, #index{cache = {Cache, LRU},
+        cache_size = CacheSze} = D) ->
         X = lrucache:get_lru(LRU),
         if X == nil -> D;
         true ->
-                {Key, LRU0} = X, 
-                {Sze, _} = gb_trees:get(Key, Cache),
-                keycache_evict(CacheSze - Sze, EntrySze, D#index{cache =
-                        {gb_trees:delete(Key, Cache), LRU0}})
+                {Key, LRU0} = X,
+                [{_, Sze, _}] = ets:lookup(Cache, Key),
+                ets:delete(Cache, Key),
+                keycache_evict(EntrySze, D#index{cache = {Cache, LRU0},
+                        cache_size = CacheSze - Sze})
         end.
 
-gb_fold(F, S, Iter) -> gb_fold0(F, S, gb_trees:next(Iter)).
-gb_fold0(_, S, none) -> S;
-gb_fold0(F, S, {K, V, Iter0}) -> gb_fold0(F, F(S, K, V), gb_trees:next(Iter0)).
-
 % Calculate cache size. 64 is an approximate cost in bytes  to upkeep a key
 % in the cache
 entry_size(K, V) -> entry_size0(size(K) + 64, V).
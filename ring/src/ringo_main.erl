@@ -41,7 +41,9 @@ init([Home, Id]) ->
         error_logger:info_report([{"RINGO NODE", Id, "BOOTS"}]),
         bfile:load_driver(),
         {ok, {{one_for_one, ?MAX_R, ?MAX_T},
-                 [{ringo_node, {ringo_node, start_link, [Home, Id]},
+                 [{ringo_valuecache, {ringo_valuecache, start_link, []},
+                        permanent, 10, worker, [ringo_valuecache]},
+                  {ringo_node, {ringo_node, start_link, [Home, Id]},
                         permanent, 10, worker, dynamic}]
         }}.
 
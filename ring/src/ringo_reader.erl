@@ -1,8 +1,12 @@
 -module(ringo_reader).
 
--export([fold/3, fold/5, read_entry/2, is_external/1, decode/1]).
--export([read_external/2, parse_flags/1, read_file/1]).
+-export([fold/3, fold/5, fold/6, read_entry/2, is_external/1, decode/1]).
+-export([read_external/2, stream_external/4, external_size/2, parse_flags/1,
+         read_file/1]).
 -include("ringo_store.hrl").
+-include_lib("kernel/include/file.hrl").
+
+-define(EXT_CHUNK, 65536).
 
 -define(NI, :32/little).
 -record(iter, {db, f, prev, prev_head, acc, skipbad}).
@@ -30,13 +34,18 @@ fold(F, Acc0, DBName) ->
         fold(F, Acc0, DBName, false, 0).
 
 fold(F, Acc0, DBName, WithPos, StartPos) ->
+        fold(F, Acc0, DBName, WithPos, StartPos, {0, 0}).
+
+% Prev is the EntryID of the entry preceding StartPos, so that a duplicate of
+% it at StartPos is skipped, as if the fold had started from the beginning.
+fold(F, Acc0, DBName, WithPos, StartPos, Prev) ->
         {ok, DB} = bfile:fopen(DBName, "r"),
         if StartPos > 0 ->
                 ok = bfile:fseek(DB, StartPos, seek_set);
         true -> ok
         end,
         try
-                read_item(#iter{db = DB, f = F, prev = {0, 0}, skipbad = true,
+                read_item(#iter{db = DB, f = F, prev = Prev, skipbad = true,
                         prev_head = StartPos, acc = Acc0}, WithPos)
         catch
                 {eof, #iter{acc = Acc}} ->
@@ -159,6 +168,41 @@ read_external(Home, <<_CRC:32, ExtFile/binary>>) ->
         end.
 
 
+external_size(Home, <<_CRC:32, ExtFile/binary>>) ->
+        ExtPath = filename:join(Home, binary_to_list(ExtFile)),
+        case file:read_file_info(ExtPath) of
+                {ok, #file_info{size = Size}} -> {ok, Size};
+                {error, Reason} -> {io_error, Reason}
+        end.
+
+% Stream_external reads an external value in chunks of ?EXT_CHUNK bytes, so
+% that the value is never kept in memory as a whole. Fun is folded over
+% {size, Size} and then {data, Chunk} for each chunk, starting with Acc0.
+% Returns {ok, Acc} once the whole value has been read.
+stream_external(Home, <<_CRC:32, ExtFile/binary>>, Fun, Acc0) ->
+        ExtPath = filename:join(Home, binary_to_list(ExtFile)),
+        case file:read_file_info(ExtPath) of
+                {ok, #file_info{size = Size}} ->
+                        case bfile:fopen(ExtPath, "r") of
+                                {ok, F} ->
+                                        Acc = Fun({size, Size}, Acc0),
+                                        stream_file(F, Fun, Acc,
+                                                bfile:fread(F, ?EXT_CHUNK));
+                                {error, Reason} -> {io_error, Reason}
+                        end;
+                {error, Reason} -> {io_error, Reason}
+        end.
+
+stream_file(F, Fun, Acc, {ok, B}) ->
+        Acc0 = Fun({data, B}, Acc),
+        stream_file(F, Fun, Acc0, bfile:fread(F, ?EXT_CHUNK));
+
+stream_file(F, _, Acc, eof) ->
+        bfile:fclose(F), {ok, Acc};
+
+stream_file(F, _, _, Error) ->
+        bfile:fclose(F), {io_error, Error}.
+
 read_file(FName) ->
         case bfile:fopen(FName, "r") of
                 {ok, F} -> read_file(F, <<>>, bfile:fread(F, 65536));
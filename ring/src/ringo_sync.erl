@@ -1,12 +1,18 @@
 -module(ringo_sync).
 
--export([make_leaf_hashes_and_ids/1, make_leaf_hashes/1,
+-export([make_leaf_hashes_and_ids/1, make_leaf_hashes_and_ids/2,
+         new_checkpoint/0, read_checkpoint/1, write_checkpoint/3,
+         append_checkpoint/5, checkpoint_size/1,
+         make_leaf_hashes/1,
          make_leaf_hashes/3, build_merkle_tree/1,
          sync_id/2, sync_id_slot/1, update_leaf_ids/2, update_leaf_hashes/2,
          collect_leaves/2, in_leaves/2, diff_parents/3, count_entries/1,
          pick_children/3]).
 
 -include("ringo_store.hrl").
+-include_lib("kernel/include/file.hrl").
+
+-define(CHECKPOINT_VERSION, 1).
 %%%
 %%% 
 %%%
@@ -59,6 +65,137 @@ make_leaf_hashes(DBName, F, Acc0) ->
         end, Acc0, DBName),
         {LeafHashes, AccF}.
 
+%%%
+%%% Sync checkpoints
+%%%
+%%% Building the leaf hashes requires a scan over the whole DB. Since the DB
+%%% only grows by appending, the leaf hashes and IDs are saved to a checkpoint
+%%% file together with the position where the scan ended, and the next scan
+%%% continues from there. A checkpoint is a tuple
+%%%
+%%% {Offset, Prev, Hashes, LeafIDs}
+%%%
+%%% where Offset is the end of the last entry that was included, Prev its
+%%% EntryID, Hashes the sorted list of {Leaf, Hash} pairs and LeafIDs as
+%%% returned by make_leaf_hashes_and_ids/1. Scanning continues exactly as
+%%% ringo_reader:fold would have continued after the last entry, so the
+%%% results equal those of a full scan.
+%%%
+%%% Writing the whole checkpoint takes time linear in the size of the DB, so
+%%% it is done only on full scans and when the log below has grown larger
+%%% than the checkpoint. In between, each round that finds new entries
+%%% appends their SyncIDs to a log file, and rounds that find nothing write
+%%% nothing. The log is replayed on top of the checkpoint when it is read.
+%%% Each record contains the offset where it starts, so records that don't
+%%% continue the checkpoint, e.g. from before a crash, are ignored, as is a
+%%% partially written last record.
+%%%
+
+new_checkpoint() ->
+        {0, {0, 0}, [{I, 0} || I <- lists:seq(0, ?NUM_MERKLE_LEAVES - 1)],
+                dict:from_list([{I, <<>>} ||
+                        I <- lists:seq(0, ?NUM_MERKLE_LEAVES - 1)])}.
+
+% Same as make_leaf_hashes_and_ids/1, but only the entries after the
+% checkpoint are read. Returns {LeafHashes, LeafIDs, NewCheckpoint, Delta}
+% where Delta contains the SyncIDs of the new entries, for
+% append_checkpoint.
+make_leaf_hashes_and_ids(DBName, {Offset, Prev, Hashes, LeafIDs}) ->
+        LeafHashes = ets:new(leaves, []),
+        ets:insert(LeafHashes, Hashes),
+        {NOffset, NPrev, NLeafIDs, Delta} = ringo_reader:fold(
+                fun(_, _, _, {Time, EntryID}, Entry,
+                        {_, _, LLeafIDs, LDelta}, Pos) ->
+                        {Leaf, SyncID} = sync_id(EntryID, Time),
+                        update_leaf_hashes(LeafHashes, SyncID),
+                        Lst = dict:fetch(Leaf, LLeafIDs),
+                        {Pos + size(Entry), EntryID, dict:store(Leaf,
+                                <<Lst/binary, SyncID/binary>>, LLeafIDs),
+                                <<LDelta/binary, SyncID/binary>>}
+                end, {Offset, Prev, LeafIDs, <<>>}, DBName, true, Offset, Prev),
+        {LeafHashes, NLeafIDs, {NOffset, NPrev,
+                lists:sort(ets:tab2list(LeafHashes)), NLeafIDs}, Delta}.
+
+% Returns {Rounds, Checkpoint} for the DB, where Rounds is the number of
+% times the checkpoint has been updated since the last full scan. A new
+% checkpoint is returned if there's no valid checkpoint file, or if the DB
+% is smaller than the checkpoint, i.e. it has been replaced.
+read_checkpoint(DBName) ->
+        CFile = checkpoint_file(DBName, ?SYNC_CHECKPOINT),
+        case catch binary_to_term(element(2, file:read_file(CFile))) of
+                {?CHECKPOINT_VERSION, Rounds, C} ->
+                        {Rounds0, {Offset, _, _, _} = C0} =
+                                replay_log(DBName, Rounds, C),
+                        case file:read_file_info(DBName) of
+                                {ok, #file_info{size = S}} when S >= Offset ->
+                                        {Rounds0, C0};
+                                _ -> {0, new_checkpoint()}
+                        end;
+                _ -> {0, new_checkpoint()}
+        end.
+
+replay_log(DBName, Rounds, C) ->
+        case file:read_file(checkpoint_file(DBName, ?SYNC_CHECKPOINT_LOG)) of
+                {ok, Log} -> replay_log(Log, Rounds, C, ets:new(leaves, []));
+                _ -> {Rounds, C}
+        end.
+
+replay_log(<<Len:32, Rec:Len/binary, Rest/binary>>, Rounds,
+        {Offset, _, Hashes, LeafIDs} = C, LeafHashes) ->
+        case catch binary_to_term(Rec) of
+                {NRounds, Offset, NOffset, NPrev, Delta} ->
+                        ets:insert(LeafHashes, Hashes),
+                        NLeafIDs = lists:foldl(fun(SyncID, L) ->
+                                update_leaf_hashes(LeafHashes, SyncID),
+                                update_leaf_ids(L, SyncID)
+                        end, LeafIDs, [X || <<X:8/binary>> <= Delta]),
+                        replay_log(Rest, NRounds, {NOffset, NPrev,
+                                lists:sort(ets:tab2list(LeafHashes)),
+                                NLeafIDs}, LeafHashes);
+                _ ->
+                        ets:delete(LeafHashes),
+                        {Rounds, C}
+        end;
+replay_log(_, Rounds, C, LeafHashes) ->
+        ets:delete(LeafHashes),
+        {Rounds, C}.
+
+% Write first with a different name, rename then, so that a partially
+% written checkpoint is never read. The log is obsolete after this.
+write_checkpoint(DBName, Rounds, C) ->
+        CFile = checkpoint_file(DBName, ?SYNC_CHECKPOINT),
+        ok = file:write_file(CFile ++ ".partial",
+                term_to_binary({?CHECKPOINT_VERSION, Rounds, C})),
+        ok = file:rename(CFile ++ ".partial", CFile),
+        file:delete(checkpoint_file(DBName, ?SYNC_CHECKPOINT_LOG)),
+        ok.
+
+% Appends the entries that make_leaf_hashes_and_ids/2 found after the
+% checkpoint OldC to the log. NewC is written as a whole instead if the log
+% would become larger than the checkpoint.
+append_checkpoint(_DBName, _Rounds, _OldC, _NewC, <<>>) -> ok;
+append_checkpoint(DBName, Rounds, {Offset, _, _, _},
+        {NOffset, NPrev, _, _} = NewC, Delta) ->
+        CFile = checkpoint_file(DBName, ?SYNC_CHECKPOINT),
+        LogFile = checkpoint_file(DBName, ?SYNC_CHECKPOINT_LOG),
+        Rec = term_to_binary({Rounds, Offset, NOffset, NPrev, Delta}),
+        ok = file:write_file(LogFile, [<<(size(Rec)):32>>, Rec], [append]),
+        case {file:read_file_info(LogFile), file:read_file_info(CFile)} of
+                {{ok, #file_info{size = L}}, {ok, #file_info{size = S}}}
+                        when L =< S -> ok;
+                _ -> write_checkpoint(DBName, Rounds, NewC)
+        end.
+
+% Size of the checkpoint files in the domain directory Home
+checkpoint_size(Home) ->
+        lists:sum([case file:read_file_info(filename:join(Home, F)) of
+                {ok, #file_info{size = S}} -> S;
+                _ -> 0
+        end || F <- [?SYNC_CHECKPOINT, ?SYNC_CHECKPOINT_LOG]]).
+
+checkpoint_file(DBName, Name) ->
+        filename:join(filename:dirname(DBName), Name).
+
 count_entries(LeafIDs) ->
         dict:fold(fun(_Leaf, IDList, N) ->
                 N + size(IDList) div 8
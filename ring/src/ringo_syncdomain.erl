@@ -4,6 +4,10 @@
 
 -include("ringo_store.hrl").
 
+% Every Nth update of the sync tree scans the whole DB file, instead of only
+% the entries after the sync checkpoint
+-define(SYNC_VERIFY_ROUNDS, 24).
+
 % Premises about resync:
 %
 % - We can't know for sure on which nodes all replicas of this domain exist. Nodes may
@@ -81,7 +85,7 @@ update_sync_tree(This, DBName) ->
         error_logger:info_report({"update sync tree", DBName}),
         {ok, Inbox} = gen_server:call(This, {flush_syncbox, sync_inbox}),
         %error_logger:info_report({"INBOX", Inbox}),
-        {LeafHashes, LeafIDs} = ringo_sync:make_leaf_hashes_and_ids(DBName),
+        {LeafHashes, LeafIDs} = leaf_hashes_and_ids(DBName),
         NumEntries = ringo_sync:count_entries(LeafIDs),
         gen_server:cast(This, {update_num_entries, NumEntries}),
         %error_logger:info_report({"LeafIDs", LeafIDs}),
@@ -94,6 +98,44 @@ update_sync_tree(This, DBName) ->
         ets:delete(LeafHashesX),
         {Tree, LeafIDsX, NumEntries}.
 
+% leaf_hashes_and_ids scans only the entries that have been written after the
+% sync checkpoint of the previous round (see ringo_sync). Every
+% SYNC_VERIFY_ROUNDS rounds that find new entries, the whole DB is scanned
+% and the result is compared to the incremental one. Entries from the inbox
+% are not included in the checkpoint, as they are written to the DB and
+% scanned next time.
+
+leaf_hashes_and_ids(empty) ->
+        ringo_sync:make_leaf_hashes_and_ids(empty);
+
+leaf_hashes_and_ids(DBName) ->
+        {Rounds, C} = ringo_sync:read_checkpoint(DBName),
+        {LeafHashes, LeafIDs, NewC, Delta} =
+                ringo_sync:make_leaf_hashes_and_ids(DBName, C),
+        VerifyRounds = ringo_util:get_param("SYNC_VERIFY_ROUNDS",
+                ?SYNC_VERIFY_ROUNDS),
+        if Delta =/= <<>>, Rounds + 1 >= VerifyRounds ->
+                ets:delete(LeafHashes),
+                {FLeafHashes, FLeafIDs, FullC, _} =
+                        ringo_sync:make_leaf_hashes_and_ids(DBName,
+                                ringo_sync:new_checkpoint()),
+                % The DB may have grown in between
+                case {FullC, NewC} of
+                        {{Offset, _, Hashes, _}, {Offset, _, Hashes, _}} -> ok;
+                        {{Offset, _, _, _}, {Offset, _, _, _}} ->
+                                error_logger:warning_report(
+                                        {"Sync checkpoint doesn't match the DB",
+                                                DBName});
+                        _ -> ok
+                end,
+                ringo_sync:write_checkpoint(DBName, 0, FullC),
+                {FLeafHashes, FLeafIDs};
+        true ->
+                ringo_sync:append_checkpoint(DBName, Rounds + 1, C, NewC,
+                        Delta),
+                {LeafHashes, LeafIDs}
+        end.
+
 % flush_sync_inbox writes entries that have been sent to this replica
 % (or owner) to disk and updates the leaf hashes accordingly
 flush_sync_inbox(_, [], LeafHashes, LeafIDs) ->
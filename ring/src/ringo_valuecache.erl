@@ -0,0 +1,184 @@
+-module(ringo_valuecache).
+-behaviour(gen_server).
+
+-export([start_link/0, enabled/0, lookup/2, insert/4, item_max/0, stats/0]).
+-export([init/1, handle_call/3, handle_cast/2, handle_info/2,
+         terminate/2, code_change/3]).
+
+%%%
+%%% Value cache is shared by all domains on a node. It maps {Owner, Offset}
+%%% pairs, where Owner is the pid of a domain's index server, to {Key, Value}.
+%%% Entries in a DB are immutable and a new index server is started whenever
+%%% a domain is re-opened, so a cached value can't become stale.
+%%%
+%%% The cache is disabled by default. Set VALUECACHE_BYTES to enable it.
+%%% Values larger than VALUECACHE_ITEM_MAX bytes are never cached.
+%%%
+%%% Admission: A value is cached only when it is fetched for the second time
+%%% within a window of the last VALUECACHE_DOOR_MAX misses. Keys seen once are
+%%% kept in a doorkeeper table, which is cleared when it becomes full. This
+%%% prevents one-off scans from flushing hot values out of the cache.
+%%%
+%%% Eviction: Values are evicted in the CLOCK order. Each cached value has a
+%%% reference bit that is set on every hit. When the cache exceeds its
+%%% budget, the oldest value is evicted if its bit is not set, otherwise the
+%%% bit is cleared and the value moved to the tail of the queue.
+%%%
+%%% Lookups and admission are done by the callers directly on public ets
+%%% tables. Only inserts and evictions go through the server, which keeps
+%%% the CLOCK queue and the byte count. If the server is restarting, the
+%%% tables may be missing, in which case lookups miss and inserts are
+%%% dropped.
+%%%
+%%% The server monitors the owners of cached values. When an index server
+%%% terminates, its values can't be requested anymore, so they are purged.
+%%%
+
+-define(VALUECACHE_BYTES, 0).
+-define(VALUECACHE_ITEM_MAX, 64 * 1024).
+-define(VALUECACHE_DOOR_MAX, 100000).
+% approximate cost in bytes to upkeep a value in the cache
+-define(ITEM_OVERHEAD, 64).
+
+-record(cache, {budget, used, clock, owners}).
+
+start_link() ->
+        case gen_server:start_link({local, ringo_valuecache},
+                        ringo_valuecache, [], []) of
+                {ok, Server} -> {ok, Server};
+                {error, {already_started, Server}} -> {ok, Server}
+        end.
+
+init(_) ->
+        ets:new(valuecache, [named_table, public]),
+        ets:new(valuecache_door, [named_table, public]),
+        ets:new(valuecache_stats, [named_table, public]),
+        Budget = ringo_util:get_param("VALUECACHE_BYTES", ?VALUECACHE_BYTES),
+        ets:insert(valuecache_stats, [{budget, Budget}, {item_max,
+                ringo_util:get_param("VALUECACHE_ITEM_MAX",
+                        ?VALUECACHE_ITEM_MAX)},
+                {hits, 0}, {misses, 0}, {admitted, 0}, {evicted, 0},
+                {bytes, 0}]),
+        {ok, #cache{budget = Budget, used = 0, clock = queue:new(),
+                owners = gb_sets:empty()}}.
+
+enabled() ->
+        case catch ets:lookup(valuecache_stats, budget) of
+                [{_, Budget}] when Budget > 0 -> true;
+                _ -> false
+        end.
+
+% Returns 0 if the server isn't running, so nothing is cached
+item_max() ->
+        case catch ets:lookup(valuecache_stats, item_max) of
+                [{_, Max}] -> Max;
+                _ -> 0
+        end.
+
+% Returns {ok, Key, Value} or none
+lookup(Owner, Offset) ->
+        case catch ets:lookup(valuecache, {Owner, Offset}) of
+                [{K, Key, Value, RefBit}] ->
+                        if RefBit == 0 -> catch ets:update_element(valuecache,
+                                K, {4, 1});
+                        true -> ok
+                        end,
+                        catch ets:update_counter(valuecache_stats, hits, 1),
+                        {ok, Key, Value};
+                [] ->
+                        catch ets:update_counter(valuecache_stats, misses, 1),
+                        none;
+                _ ->
+                        none
+        end.
+
+% Value is a binary or {external, Binary}
+insert(Owner, Offset, Key, Value) ->
+        K = {Owner, Offset},
+        case catch ets:insert_new(valuecache_door, {K}) of
+                true ->
+                        case ets:info(valuecache_door, size) >
+                                ?VALUECACHE_DOOR_MAX of
+                                true -> ets:delete_all_objects(
+                                        valuecache_door);
+                                false -> ok
+                        end;
+                false ->
+                        ets:delete(valuecache_door, K),
+                        gen_server:cast(ringo_valuecache,
+                                {insert, K, Key, Value});
+                _ ->
+                        ok
+        end.
+
+stats() ->
+        [{_, Hits}] = ets:lookup(valuecache_stats, hits),
+        [{_, Misses}] = ets:lookup(valuecache_stats, misses),
+        [{list_to_atom("valuecache_" ++ atom_to_list(S)), V} ||
+                {S, V} <- lists:sort(ets:tab2list(valuecache_stats))] ++
+        [{valuecache_items, ets:info(valuecache, size)},
+         {valuecache_hit_rate, if Hits + Misses == 0 -> 0;
+                true -> Hits / (Hits + Misses) end}].
+
+handle_call(_, _, C) -> {reply, error, C}.
+
+handle_cast({insert, {Owner, _} = K, Key, Value},
+        #cache{clock = Clock, used = Used} = C) ->
+        case ets:insert_new(valuecache, {K, Key, Value, 0}) of
+                true ->
+                        ets:update_counter(valuecache_stats, admitted, 1),
+                        C0 = monitor_owner(Owner, C),
+                        {noreply, evict(C0#cache{clock = queue:in(K, Clock),
+                                used = Used + item_size(Key, Value)})};
+                false ->
+                        {noreply, C}
+        end.
+
+monitor_owner(Owner, #cache{owners = Owners} = C) ->
+        case gb_sets:is_member(Owner, Owners) of
+                true -> C;
+                false ->
+                        erlang:monitor(process, Owner),
+                        C#cache{owners = gb_sets:add(Owner, Owners)}
+        end.
+
+% Purged values are dropped from the CLOCK queue lazily, see evict
+purge_owner(Owner, #cache{used = Used, owners = Owners} = C) ->
+        Items = ets:match_object(valuecache, {{Owner, '_'}, '_', '_', '_'}),
+        ets:match_delete(valuecache, {{Owner, '_'}, '_', '_', '_'}),
+        ets:match_delete(valuecache_door, {{Owner, '_'}}),
+        Freed = lists:sum([item_size(Key, Value) ||
+                {_, Key, Value, _} <- Items]),
+        ets:insert(valuecache_stats, {bytes, Used - Freed}),
+        C#cache{used = Used - Freed, owners = gb_sets:delete(Owner, Owners)}.
+
+evict(#cache{budget = Budget, used = Used} = C) when Used =< Budget ->
+        ets:insert(valuecache_stats, {bytes, Used}),
+        C;
+
+evict(#cache{clock = Clock, used = Used} = C) ->
+        {{value, K}, Clock0} = queue:out(Clock),
+        case ets:lookup(valuecache, K) of
+                [{_, Key, Value, 0}] ->
+                        ets:delete(valuecache, K),
+                        ets:update_counter(valuecache_stats, evicted, 1),
+                        evict(C#cache{clock = Clock0,
+                                used = Used - item_size(Key, Value)});
+                [_] ->
+                        ets:update_element(valuecache, K, {4, 0}),
+                        evict(C#cache{clock = queue:in(K, Clock0)});
+                % purged
+                [] ->
+                        evict(C#cache{clock = Clock0})
+        end.
+
+item_size(Key, {external, Value}) -> item_size(Key, Value);
+item_size(Key, Value) -> size(Key) + size(Value) + ?ITEM_OVERHEAD.
+
+handle_info({'DOWN', _, process, Owner, _}, C) ->
+        {noreply, purge_owner(Owner, C)};
+
+handle_info(_, C) -> {noreply, C}.
+
+terminate(_Reason, _C) -> ok.
+code_change(_OldVsn, C, _Extra) -> {ok, C}.
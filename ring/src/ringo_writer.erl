@@ -1,7 +1,8 @@
 
 -module(ringo_writer).
 
--export([write_entry/3, make_entry/4, entry_size/1]).
+-export([write_entry/3, write_external/3, make_entry/4, entry_size/1]).
+-export([make_external_entry/5, receive_external/5]).
 
 -include("ringo_store.hrl").
 -include_lib("kernel/include/file.hrl").
@@ -13,12 +14,15 @@ write_entry(_Home, DB, {Entry, {}}) ->
         ok = bfile:fwrite(DB, Entry), ok;
 
 write_entry(Home, DB, {Entry, {ExtFile, Value}}) ->
+        ok = bfile:fwrite(DB, Entry),
+        write_external(Home, ExtFile, Value).
+
+write_external(Home, ExtFile, Value) ->
         % Write first with a different name, rename then. This ensures that
         % resyncing won't copy partial files. BUT: When async-threads are
         % enabled write_file probably doesn't block and there's no way to 
         % know when the bits have actually hit the disk, other than syncing
         % every time, hence renaming wouldn't help much.
-        ok = bfile:fwrite(DB, Entry),
         ExtPath = filename:join(Home, ExtFile ++ ".partial"),
         ExtPathReal = filename:join(Home, ExtFile),
         {ok, F} = bfile:fopen(ExtPath, "w"),
@@ -41,11 +45,10 @@ make_entry(EntryID, Key, Value, Flags)
         ExtFile = if Flags == [iblock] ->
                 binary_to_list(Key);
         true ->
-                io_lib:format("value-~.16b-~.16b", [EntryID, CRC])
+                external_name(EntryID, CRC)
         end,
-        Link = [<<CRC:32>>, ExtFile],
-        {encode(Key, list_to_binary(Link), EntryID, [external|Flags]),
-                {ExtFile, Value}};
+        {Entry, {}} = make_external_entry(EntryID, Key, CRC, ExtFile, Flags),
+        {Entry, {ExtFile, Value}};
 
 make_entry(_, Key, Value, _) ->
         error_logger:warning_report({"Invalid put request. Key",
@@ -53,6 +56,54 @@ make_entry(_, Key, Value, _) ->
                 trunc_io:fprint(Value, 500)}),
         invalid_request.
 
+% Makes an entry that links to ExtFile, which has been written already
+make_external_entry(EntryID, Key, CRC, ExtFile, Flags) ->
+        Link = [<<CRC:32>>, ExtFile],
+        {encode(Key, list_to_binary(Link), EntryID, [external|Flags]), {}}.
+
+external_name(EntryID, CRC) ->
+        lists:flatten(io_lib:format("value-~.16b-~.16b", [EntryID, CRC])).
+
+% Receive_external receives a value of Size bytes in parts from From and
+% writes it to an external file as it arrives, so the value is never kept
+% in memory as a whole. Each part is acknowledged, which lets the sender
+% limit the number of parts in flight. The file is renamed to its final
+% name, which contains the CRC of the value, once all the parts have been
+% written. Returns {ok, CRC, ExtFile}, or {error, Reason} if From goes away
+% or no part arrives in Timeout milliseconds.
+receive_external(Home, EntryID, Size, From, Timeout) ->
+        erlang:monitor(process, From),
+        TmpPath = filename:join(Home, lists:flatten(
+                io_lib:format("upload-~.16b.partial", [EntryID]))),
+        {ok, F} = bfile:fopen(TmpPath, "w"),
+        R = receive_parts(F, From, Size, erlang:crc32(<<>>), Timeout),
+        bfile:fclose(F),
+        case R of
+                {ok, CRC} ->
+                        ExtFile = external_name(EntryID, CRC),
+                        ok = file:rename(TmpPath, filename:join(Home, ExtFile)),
+                        {ok, CRC, ExtFile};
+                Error ->
+                        file:delete(TmpPath),
+                        Error
+        end.
+
+receive_parts(_, _, 0, CRC, _) -> {ok, CRC};
+receive_parts(F, From, Size, CRC, Timeout) ->
+        receive
+                {upload_part, From, B} when size(B) =< Size ->
+                        ok = bfile:fwrite(F, B),
+                        From ! {upload_ack, self()},
+                        receive_parts(F, From, Size - size(B),
+                                erlang:crc32(CRC, B), Timeout);
+                {upload_part, From, _} ->
+                        {error, too_large};
+                {'DOWN', _, process, From, _} ->
+                        {error, aborted}
+        after Timeout ->
+                {error, timeout}
+        end.
+
 encode(Key, Value, EntryID, FlagList) when is_binary(Key), is_binary(Value) ->
         Flags = lists:foldl(fun(X, F) ->
                 {value, {_, V}} = lists:keysearch(X, 1, ?FLAGS),
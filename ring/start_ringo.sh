@@ -22,7 +22,17 @@ then
 	exit 1
 fi
 
+# Each open domain uses a few private ets tables: the sync boxes and stats
+# of ringo_domain, and the active iblock, keycache and its LRU list of
+# ringo_indexdomain. The default limit of 1400 tables would allow only a
+# couple of hundred open domains per node.
+if [ -z $MAX_ETS_TABLES ]
+then
+	MAX_ETS_TABLES=100000
+fi
+
 echo "Launching Ringo node [$ID]"
-erl $SHELL -setcookie ringobingo +K true -smp on -pa $RINGO/bfile/ebin \
+erl $SHELL -setcookie ringobingo +K true +e $MAX_ETS_TABLES -smp on \
+    -pa $RINGO/bfile/ebin \
     -pa $RINGO/ebin -kernel error_logger "{file, \"ringo-$ID.log\"}"\
     -boot ringo -sname "ringo-$ID" -ringo ringo_home "\"$1\""
@@ -12,7 +12,7 @@ erlc -I src/ -o test test/*.erl
 
 SRC="src/ringo_writer.erl src/ringo_reader.erl\
      src/trunc_io.erl src/ringo_sync.erl src/lrucache.erl\
-     src/ringo_index.erl src/bin_util.erl"
+     src/ringo_index.erl src/bin_util.erl src/bloomfilter.erl"
 
 if [[ -z $BEAM ]]; then
 	echo "Compiling tests.. (Hipe)"
@@ -87,6 +87,13 @@ echo "*** DB access test ***"
 run test_index indexuse_test 10000000
 echo "*** LRU cache test ***"
 run test_index lrucache_test
+echo "*** Bloom filter test ***"
+run test_index bloomfilter_test 10000000
+fi
+
+if [[ -z $1 || $1 == "client" ]]; then
+echo "*** RingoMulti test ***"
+PYTHONPATH=../../ringogw/py python test_ringogw.py
 fi
 
 cd ..
@@ -0,0 +1,205 @@
+
+# Benchmarks for a local test ring. Rings are started with the harness in
+# system_test.py, so the same requirements apply (start_ringo.sh in PATH and a
+# running ringogw).
+#
+# Each workload measures latencies of individual requests. Results contain
+# the throughput and p50/p99/p999 latencies (in ms) for each operation, and
+# they are saved as JSON. If a baseline file is given, results are compared
+# to it and the run fails if any operation is slower than the baseline by
+# more than the given tolerance.
+#
+# Usage: python benchmark.py ringogw-host [-o results.json] [-b baseline.json]
+#               [-t tolerance] [workload ...]
+
+import os, sys, time, json, tempfile, optparse
+import ringogw
+import system_test
+from system_test import _test_ring, _wait_until
+
+class Latencies:
+        def __init__(self):
+                self.times = []
+                self.started = self.finished = time.time()
+
+        def measure(self, fun, *args, **kwargs):
+                t = time.time()
+                ret = fun(*args, **kwargs)
+                self.finished = time.time()
+                self.times.append(self.finished - t)
+                return ret
+
+        def percentile(self, q):
+                times = sorted(self.times)
+                return times[min(len(times) - 1, int(q * len(times)))] * 1000
+
+        def stats(self):
+                elapsed = self.finished - self.started
+                return {"n": len(self.times),
+                        "throughput": len(self.times) / max(elapsed, 1e-6),
+                        "mean": sum(self.times) * 1000 / len(self.times),
+                        "p50": self.percentile(0.5),
+                        "p99": self.percentile(0.99),
+                        "p999": self.percentile(0.999)}
+
+def ring(n):
+        system_test.reset_ring()
+        if not _test_ring(n):
+                raise Exception("Ring didn't converge")
+
+def put_keys(name, keys, values = 1, lat = None):
+        if lat == None:
+                lat = Latencies()
+        for key in keys:
+                for i in range(values):
+                        lat.measure(ringo.put, name, key,
+                                "%s-value-%d" % (key, i), retries = 10)
+        return lat
+
+def get_keys(name, keys, **kwargs):
+        lat = Latencies()
+        for key in keys:
+                lat.measure(ringo.get, name, key, retries = 10, **kwargs)
+        return lat
+
+#
+# Workloads
+#
+# Each workload returns a dictionary that maps operation names to their
+# Latencies.
+
+def bench_put():
+        ring(5)
+        ringo.create("bench_put", 3)
+        return {"put": put_keys("bench_put",
+                ["key-%d" % i for i in range(20000)])}
+
+def bench_singleget():
+        ring(5)
+        ringo.create("bench_singleget", 3)
+        keys = ["key-%d" % i for i in range(10000)]
+        put_keys("bench_singleget", keys)
+        return {"single_get": get_keys("bench_singleget", keys,
+                single = True)}
+
+def bench_multiget():
+        ring(5)
+        ringo.create("bench_multiget", 3)
+        keys = ["key-%d" % i for i in range(100)]
+        put_keys("bench_multiget", keys, values = 100)
+        return {"multi_get": get_keys("bench_multiget", keys * 10)}
+
+def bench_chunkrollover():
+        chunk_size = 500 * 1024
+        orig_max = os.environ['DOMAIN_CHUNK_MAX']
+        os.environ['DOMAIN_CHUNK_MAX'] = str(chunk_size)
+        try:
+                ring(1)
+        finally:
+                os.environ['DOMAIN_CHUNK_MAX'] = orig_max
+        node, domainid = ringo.create("bench_chunks", 3)
+        keys = ["key-%d" % i for i in range(100000)]
+        res = {"put": put_keys("bench_chunks", keys)}
+        if not _wait_until("/mon/domains/node?name=" + node,
+                        lambda x: x[0] == 200 and len(x[1]) > 1, 30):
+                raise Exception("Chunk wasn't rolled over")
+        res["single_get"] = get_keys("bench_chunks", keys[::100],
+                single = True)
+        return res
+
+def bench_largevalues():
+        ring(5)
+        ringo.create("bench_large", 3)
+        src = tempfile.TemporaryFile()
+        src.write(os.urandom(8 * 1024**2))
+        put = Latencies()
+        for i in range(20):
+                src.seek(0)
+                put.measure(ringo.put_file, "bench_large", "key-%d" % i, src,
+                        retries = 10)
+        get = Latencies()
+        for i in range(20):
+                dst = tempfile.TemporaryFile()
+                get.measure(ringo.get_to_file, "bench_large", "key-%d" % i,
+                        dst, retries = 10)
+        return {"put": put, "get": get}
+
+def _bench_cache(**kwargs):
+        ring(1)
+        ringo.create("bench_cache", 3, **kwargs)
+        keys = ["key-%d" % i for i in range(50000)]
+        put_keys("bench_cache", keys)
+        return {"get": get_keys("bench_cache", keys[::10])}
+
+def bench_iblockcache():
+        return _bench_cache()
+
+def bench_keycache():
+        return _bench_cache(keycache = True)
+
+#
+# Reporting
+#
+
+def compare(results, baseline, tolerance):
+        regressions = []
+        for workload, ops in results.items():
+                for op, stats in ops.items():
+                        base = baseline.get(workload, {}).get(op)
+                        if not base:
+                                continue
+                        if stats["throughput"] <\
+                                        base["throughput"] * (1 - tolerance):
+                                regressions.append((workload, op,
+                                        "throughput", base["throughput"],
+                                        stats["throughput"]))
+                        for p in ["p50", "p99", "p999"]:
+                                if stats[p] > base[p] * (1 + tolerance):
+                                        regressions.append((workload, op, p,
+                                                base[p], stats[p]))
+        return regressions
+
+workloads = sorted([f[6:] for f in globals().keys() if f.startswith("bench_")])
+
+if __name__ == "__main__":
+        parser = optparse.OptionParser(usage = "%prog ringogw-host "
+                "[options] [workload ...]\nWorkloads: " + " ".join(workloads))
+        parser.add_option("-o", "--output", default = "benchmark.json",
+                help = "save results to this file")
+        parser.add_option("-b", "--baseline",
+                help = "compare results to this file")
+        parser.add_option("-t", "--tolerance", type = "float", default = 0.2,
+                help = "allowed slowdown relative to the baseline")
+        opts, args = parser.parse_args()
+        if not args:
+                parser.error("ringogw host missing")
+
+        ringo = system_test.ringo = ringogw.Ringo(args[0])
+
+        results = {}
+        for name in args[1:] or workloads:
+                print "*** Running", name
+                res = globals()["bench_" + name]()
+                results[name] = dict((op, lat.stats())
+                        for op, lat in res.items())
+                for op, stats in sorted(results[name].items()):
+                        print "%s: %d ops, %.1f ops/s, p50 %.2fms, "\
+                                "p99 %.2fms, p999 %.2fms" % (op, stats["n"],
+                                stats["throughput"], stats["p50"],
+                                stats["p99"], stats["p999"])
+        system_test.kill_node("ringotest")
+
+        f = file(opts.output, "w")
+        json.dump(results, f, indent = 1, sort_keys = True)
+        f.close()
+        print "Results saved to", opts.output
+
+        if opts.baseline:
+                regressions = compare(results, json.load(
+                        file(opts.baseline)), opts.tolerance)
+                for workload, op, metric, base, now in regressions:
+                        print "REGRESSION %s/%s %s: %.2f -> %.2f" %\
+                                (workload, op, metric, base, now)
+                if regressions:
+                        sys.exit(1)
+                print "No regressions compared to", opts.baseline
@@ -1,4 +1,5 @@
 import tempfile, os, os.path, subprocess, md5, time, sys, random, threading
+import glob, shutil
 import ringogw
 
 home_dir = tempfile.mkdtemp("", "ringotest-") + '/'
@@ -866,6 +867,317 @@ def test23_resyncfull():
         os.environ['DOMAIN_CHUNK_MAX'] = orig_max
         return True
 
+# Test that RingoMulti performs many concurrent puts and gets correctly
+def test24_multiclient():
+        if not _test_ring(5):
+                return False
+        node, domainid = ringo.create("multiclient", 5)
+        multi = ringogw.RingoMulti(sys.argv[1], max_connections = 32,
+                max_per_host = 16)
+        N = 10000
+        print "Putting %d items concurrently" % N
+        t = time.time()
+        reqs = [multi.put("multiclient", "abc-%d" % (i % 1000),
+                "def-%d" % i, retries = 10) for i in range(N)]
+        multi.perform()
+        for req in reqs:
+                req.result()
+        print "Put took %dms" % ((time.time() - t) * 1000)
+
+        print "Getting 1000 keys concurrently"
+        t = time.time()
+        reqs = [multi.get("multiclient", "abc-%d" % i, retries = 10)
+                for i in range(1000)]
+        multi.perform()
+        print "Get took %dms" % ((time.time() - t) * 1000)
+        for i, req in enumerate(reqs):
+                r = req.result()
+                c = ["def-%d" % j for j in range(i, N, 1000)]
+                if sorted(r) != sorted(c):
+                        print "Invalid reply to key abc-%d: %s" % (i, r)
+                        return False
+        print "Results ok"
+        return True
+
+# Put_many over several chunks: Chunks become full in the middle of batches,
+# so the remaining entries of a batch must be moved to the next chunk.
+def test25_putmany():
+        chunk_size = 500 * 1024
+        N = (chunk_size / len("abc-0def-0")) * 2
+        orig_max = os.environ['DOMAIN_CHUNK_MAX']
+        os.environ['DOMAIN_CHUNK_MAX'] = str(chunk_size)
+        if not _test_ring(1):
+                return False
+        node, domainid = ringo.create("putmany", 5)
+        
+        print "Putting %d items in batches of 10000" % N
+        t = time.time()
+        for i in range(0, N, 10000):
+                pairs = [("abc-%d" % j, "def-%d" % j)
+                        for j in range(i, min(i + 10000, N))]
+                for r in ringo.put_many("putmany", pairs):
+                        if r[0] != "ok":
+                                print "Put failed", r
+                                return False
+        print "Put took %dms" % ((time.time() - t) * 1000)
+
+        if not _wait_until("/mon/domains/node?name=" + node,
+                lambda x: _check_chunks(x, 12), 30):
+                print "Couldn't find 12 chunks"
+                return False
+        
+        print "Got a correct number of chunks"
+        single_get_check("putmany", N)
+        os.environ['DOMAIN_CHUNK_MAX'] = orig_max
+        return True
+
+# Get_many over several chunks: Values of a key are spread over all the
+# chunks, so results must be collected from every chunk.
+def test26_getmany():
+        chunk_size = 500 * 1024
+        N = (chunk_size / len("abc-0def-0")) * 2
+        orig_max = os.environ['DOMAIN_CHUNK_MAX']
+        os.environ['DOMAIN_CHUNK_MAX'] = str(chunk_size)
+        if not _test_ring(1):
+                return False
+        node, domainid = ringo.create("getmany", 5)
+        
+        print "Putting %d items" % N
+        for i in range(0, N, 10000):
+                ringo.put_many("getmany", [("abc-%d" % (j % 1000),
+                        "def-%d" % j) for j in range(i, min(i + 10000, N))])
+
+        if not _wait_until("/mon/domains/node?name=" + node,
+                lambda x: _check_chunks(x, 12), 30):
+                print "Couldn't find 12 chunks"
+                return False
+
+        keys = ["abc-%d" % i for i in range(200)] + ["nonexistent"]
+        t = time.time()
+        res = ringo.get_many("getmany", keys, retries = 10)
+        print "Get_many took %dms" % ((time.time() - t) * 1000)
+        for i in range(200):
+                c = ["def-%d" % j for j in range(i, N, 1000)]
+                # Values are returned in chunk order
+                if res["abc-%d" % i] != c:
+                        print "Invalid reply to key abc-%d" % i
+                        return False
+        if res["nonexistent"]:
+                print "Values found for a nonexistent key"
+                return False
+        os.environ['DOMAIN_CHUNK_MAX'] = orig_max
+        return True
+
+# Iter_get on a key with a large number of values. Values should stream in
+# the order they were put.
+def test27_iterget():
+        if not _test_ring(1):
+                return False
+        node, domainid = ringo.create("iterget", 5)
+        N = 100000
+        print "Putting %d values to a single key" % N
+        for i in range(0, N, 10000):
+                ringo.put_many("iterget", [("bigkey", "value-%d" % j)
+                        for j in range(i, i + 10000)])
+
+        t = time.time()
+        n = 0
+        for i, v in enumerate(ringo.iter_get("iterget", "bigkey")):
+                if v != "value-%d" % i:
+                        print "Invalid value", i, v
+                        return False
+                n += 1
+        print "Iter_get took %dms" % ((time.time() - t) * 1000)
+        if n != N:
+                print "Got %d values, expected %d" % (n, N)
+                return False
+        return True
+
+# Client-side cache: Cached gets must not reach the cluster and our own puts
+# must invalidate the cached results.
+def test28_clientcache():
+        if not _test_ring(1):
+                return False
+        node, domainid = ringo.create("clientcache", 5)
+        cache = ringogw.ResultCache(1024**2, {"clientcache": None})
+        r = ringogw.Ringo(sys.argv[1], cache = cache)
+        for i in range(1000):
+                r.put("clientcache", "key-%d" % i, "value-%d" % i)
+        for j in range(10):
+                for i in range(1000):
+                        if r.get("clientcache", "key-%d" % i) !=\
+                                        ["value-%d" % i]:
+                                print "Invalid value for key-%d" % i
+                                return False
+        stats = cache.stats()
+        print "Cache stats", stats
+        if stats["hits"] != 9000 or stats["misses"] != 1000:
+                return False
+        r.put("clientcache", "key-0", "value-x")
+        if r.get("clientcache", "key-0") != ["value-0", "value-x"]:
+                print "Put didn't invalidate the cached result"
+                return False
+        return True
+
+# Large values are uploaded from a file and downloaded to a file. They
+# should be streamed to the owner in parts by the gateway, copied to the
+# replicas, and streamed back in chunks by the index.
+def test29_largevalue():
+        if not _test_ring(3):
+                return False
+        node, domainid = ringo.create("largevalue", 3)
+        src = tempfile.TemporaryFile()
+        for i in range(8):
+                src.write(os.urandom(1024**2))
+        src.seek(0)
+        ringo.put_file("largevalue", "big", src)
+        ringo.put("largevalue", "big", "small")
+        src.seek(0)
+        orig = md5.md5(src.read()).hexdigest()
+        
+        dst = tempfile.TemporaryFile()
+        t = time.time()
+        size = ringo.get_to_file("largevalue", "big", dst)
+        print "Get_to_file took %dms" % ((time.time() - t) * 1000)
+        dst.seek(0)
+        if size != 8 * 1024**2 or md5.md5(dst.read()).hexdigest() != orig:
+                print "Invalid value from get_to_file"
+                return False
+
+        values = list(ringo.iter_get("largevalue", "big"))
+        if len(values) != 2 or md5.md5(values[0]).hexdigest() != orig or\
+                        values[1] != "small":
+                print "Invalid values from iter_get"
+                return False
+
+        if not _wait_until("/mon/domains/domain?id=0x" + domainid,
+                        lambda x: check_entries(x, 3, 2, False), 30):
+                return False
+        replicas = [n['node'].split('-')[1].split('@')[0] for n in\
+                ringo.request("/mon/domains/domain?id=0x" + domainid)[1][3]]
+        for repl in replicas:
+                path = "%s/%s/rdomain-%s/" % (home_dir, repl, domainid)
+                if not _wait_until("/mon/ring/nodes",
+                        lambda x: _check_extfiles(repl, domainid, 1), 30):
+                        print "Value not copied to node", repl
+                        return False
+                f = [f for f in os.listdir(path) if f.startswith("value")][0]
+                if md5.md5(file(path + f).read()).hexdigest() != orig:
+                        print "Invalid value on node", repl
+                        return False
+        return True
+
+# Merkle trees computed offline by ringosync should match the ones that the
+# replicas report, and a replica that has lost entries should be detected.
+def test30_replicadiff():
+        import ringosync
+        if not _test_repl("replicadiff", 3, 3, 1000):
+                return False
+        domainid = domain_id("replicadiff", 0)
+        r = ringo.request("/mon/domains/domain?id=0x" + domainid)
+        roots = dict((n['node'].split('-')[1].split('@')[0],
+                n["synctree_root"][0][1]) for n in r[1][3])
+        paths = ["%s/%s/rdomain-%s/" % (home_dir, node, domainid)
+                for node in sorted(roots)]
+        res = ringosync.diff_replicas(paths)
+        for node, rep in zip(sorted(roots), res):
+                if rep["root"] != roots[node] or rep["missing"] or\
+                                rep["entries"] != 1000:
+                        print "Invalid diff for node %s: root %d (should be "\
+                                "%d), %d entries, %d missing" % (node,
+                                rep["root"], roots[node], rep["entries"],
+                                len(rep["missing"]))
+                        return False
+        print "Offline Merkle trees match"
+
+        kill_node(sorted(roots)[0])
+        db = ringosync.db_file(paths[0])
+        size = os.stat(db).st_size
+        f = file(db, "r+")
+        f.truncate(size / 2)
+        f.close()
+        res = ringosync.diff_replicas(paths)
+        if not res[0]["missing"] or res[0]["entries"] +\
+                        len(res[0]["missing"]) != 1000 or\
+                        [x for x in res[1:] if x["missing"]]:
+                print "Missing entries not found", [(x["entries"],
+                        len(x["missing"])) for x in res]
+                return False
+        print "%d missing entries found" % len(res[0]["missing"])
+        return True
+
+# Replica reads: Many gets in a row with ?read=any and ?read=hedged on the
+# same gateway. Finished and cancelled attempts must not take the gateway
+# down, and each value must be returned exactly once.
+def _check_replicaread(mode):
+        t = time.time()
+        for j in range(5):
+                for i in range(100):
+                        r = ringo.get("replicaread", "item-%d" % i,
+                                read = mode)
+                        if r != ["testitem-%d" % i]:
+                                print "Invalid reply with read=%s" % mode, r
+                                return False
+        print "500 gets with read=%s took %dms" %\
+                (mode, (time.time() - t) * 1000)
+        keys = ["item-%d" % i for i in range(100)]
+        res = ringo.get_many("replicaread", keys, read = mode)
+        for i in range(100):
+                if res["item-%d" % i] != ["testitem-%d" % i]:
+                        print "Invalid get_many reply with read=%s" % mode
+                        return False
+        return True
+
+# Replica reads, also when a node that the gateway believes to have the chunk
+# has lost it. The node must reply invalid_domain, so that the next replica is
+# tried.
+def test31_replicaread():
+        did = domain_id("replicaread", 0)
+        # the first node is the owner, the others are replicas
+        ids = [make_domain_id(int(did, 16) + i) for i in range(1, 4)]
+        if not _test_ring(0, 3, ids):
+                return False
+        if not _test_repl("replicaread", 3, 3, 100, create_ring = False):
+                return False
+        for mode in ["any", "hedged"]:
+                if not _check_replicaread(mode):
+                        return False
+
+        print "Replica", ids[2], "loses the chunk"
+        kill_node(ids[2])
+        time.sleep(1)
+        for d in glob.glob("%s/%s/rdomain-*" % (home_dir, ids[2])):
+                shutil.rmtree(d)
+        new_node(ids[2])
+        if not _wait_until("/mon/ring/nodes",
+                lambda x: _check_results(x, 3), 30):
+                print "Ring didn't converge"
+                return False
+        for mode in ["any", "hedged"]:
+                if not _check_replicaread(mode):
+                        return False
+        return True
+
+# Open many domains with keycache on a single node. Each open domain has
+# its own ets tables, so this exceeds the default ets table limit of Erlang.
+def test32_manydomains():
+        N = 500
+        if not _test_ring(1):
+                return False
+        print "Creating %d domains.." % N
+        t = time.time()
+        for i in range(N):
+                ringo.create("manydomains-%d" % i, 1, keycache = True)
+                ringo.put("manydomains-%d" % i, "item", "testitem-%d" % i)
+        print "Domains created in %dms" % ((time.time() - t) * 1000)
+        for i in range(N):
+                r = ringo.get("manydomains-%d" % i, "item")
+                if r != ["testitem-%d" % i]:
+                        print "Invalid reply from domain", i, r
+                        return False
+        return _wait_until("/mon/ring/nodes",
+                lambda x: _check_results(x, 1), 10)
+
 # X put, exceed chunk limit, check that new chunk is created. Check get.
 # X put with replicas, exceed chunk limit, wait to converge, check that sizes
 #   match
@@ -873,31 +1185,30 @@ def test23_resyncfull():
 #   created, kill node, put 50%, check that two chunks exist (big values too)
         
         
-tests = sorted([f for f in globals().keys() if f.startswith("test")])
-
-if len(sys.argv) > 2 and sys.argv[2] == '?':
-        print "Available tests:\n", "\n".join([t[7:] for t in tests])
-        sys.exit(1)
-
-ringo = ringogw.Ringo(sys.argv[1])
-
-for f in tests:
-        prefix, testname = f.split("_", 1)
-        if len(sys.argv) > 2 and testname not in sys.argv[2:]:
-                continue
+def reset_ring():
         kill_node("ringotest")
         ringo.request("/mon/ring/reset")
         ringo.request("/mon/domains/reset")
         time.sleep(1)
-        print "*** Starting", testname
-        if globals()[f]():
-                print "+++ Test", testname, "successful"
-        else:
-                print "--- Test", testname, "failed"
-                sys.exit(1)
-
-
 
+# The harness above is also used by benchmark.py, which sets ringo itself
+if __name__ == "__main__":
+        tests = sorted([f for f in globals().keys() if f.startswith("test")])
 
+        if len(sys.argv) > 2 and sys.argv[2] == '?':
+                print "Available tests:\n", "\n".join([t[7:] for t in tests])
+                sys.exit(1)
 
+        ringo = ringogw.Ringo(sys.argv[1])
 
+        for f in tests:
+                prefix, testname = f.split("_", 1)
+                if len(sys.argv) > 2 and testname not in sys.argv[2:]:
+                        continue
+                reset_ring()
+                print "*** Starting", testname
+                if globals()[f]():
+                        print "+++ Test", testname, "successful"
+                else:
+                        print "--- Test", testname, "failed"
+                        sys.exit(1)
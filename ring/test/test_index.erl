@@ -1,6 +1,6 @@
 -module(test_index).
 -export([buildindex_test/1, serialize_test/1, kv_test/0, indexuse_test/1]).
--export([lrucache_test/0]).
+-export([lrucache_test/0, bloomfilter_test/1]).
 
 write_data(NumKeys) ->
         S = now(),
@@ -33,7 +33,7 @@ buildindex_test(Keys) ->
                 [round(timer:now_diff(now(), S) / 1000)]),
         io:fwrite("Process takes ~bK memory. Index takes ~bK.~n",
                 [Mem div 1024, iolist_size(Ser) div 1024]),
-        io:fwrite("~b keys in the index~n", [gb_trees:size(Dex)]),
+        io:fwrite("~b keys in the index~n", [ets:info(Dex, size)]),
         halt().
 
 
@@ -48,14 +48,19 @@ serialize_test(Keys) ->
         io:fwrite("Serialization took ~bms~n",
                 [round(timer:now_diff(now(), S) / 1000)]),
         io:fwrite("Serialized index takes ~bK~n", [iolist_size(Ser) div 1024]),
-        io:fwrite("~b keys in the index~n", [gb_trees:size(Dex)]),
+        io:fwrite("~b keys in the index~n", [ets:info(Dex, size)]),
         S2 = now(),
         lists:foreach(fun(ID) ->
                 %io:fwrite("ID ~b~n", [ID]),
                 {ID, [_|_]} = ringo_index:find_key(ID, Ser)
-        end, gb_trees:keys(Dex)),
+        end, ringo_index:dex_keys(Dex)),
         io:fwrite("All keys found ok in ~bms~n",
                 [round(timer:now_diff(now(), S2) / 1000)]),
+        lists:foreach(fun(ID) ->
+                R = ringo_index:find_key(ID, Ser),
+                R = ringo_index:find_key(ID, Dex)
+        end, ringo_index:dex_keys(Dex) ++ lists:seq(1, 1000)),
+        io:fwrite("Active and serialized index agree~n", []),
         halt().
 
 kv_test() ->
@@ -106,6 +111,27 @@ lrucache_test() ->
         io:fwrite("Random access works~n", []),
         halt().
 
+bloomfilter_test(NumKeys) when is_list(NumKeys) ->
+        bloomfilter_test(list_to_integer(lists:flatten(NumKeys)));
+bloomfilter_test(NumKeys) ->
+        write_data(NumKeys),
+        {_, Dex, _} = ringo_index:build_index("test_data/indexdata", 0, inf),
+        Ser = iolist_to_binary(ringo_index:serialize(Dex)),
+        Hashes = ringo_index:key_hashes(Ser),
+        true = lists:sort(Hashes) == ringo_index:dex_keys(Dex),
+        S = now(),
+        Filter = bloomfilter:new(Hashes, 10),
+        io:fwrite("Building filter took ~bms~n",
+                [round(timer:now_diff(now(), S) / 1000)]),
+        true = lists:all(fun(H) -> bloomfilter:member(H, Filter) end, Hashes),
+        io:fwrite("No false negatives~n", []),
+        FP = length([X || X <- lists:seq(1, 10000),
+                not ets:member(Dex, X),
+                bloomfilter:member(X, Filter)]),
+        io:fwrite("~b false positives in 10000 lookups~n", [FP]),
+        true = FP < 300,
+        halt().
+
 indexuse_test(NumKeys) when is_list(NumKeys) -> 
         indexuse_test(list_to_integer(lists:flatten(NumKeys)));
 indexuse_test(NumKeys) ->
@@ -0,0 +1,154 @@
+# Unit tests for RingoMulti in ringogw.py. Requests are made to a stub HTTP
+# server that runs in a thread, so no ring is needed.
+#
+# Usage: PYTHONPATH=../../ringogw/py python test_ringogw.py
+
+import unittest, threading, time, cjson, urlparse
+import BaseHTTPServer, SocketServer
+import ringogw
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+        def __init__(self):
+                BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                        StubHandler)
+                self.lock = threading.Lock()
+                # host -> number of requests being served
+                self.active = {}
+                self.max_active = 0
+                self.max_per_host = {}
+                # key -> number of requests
+                self.attempts = {}
+
+        def enter(self, host, key):
+                self.lock.acquire()
+                self.active[host] = self.active.get(host, 0) + 1
+                self.max_per_host[host] = max(self.max_per_host.get(host, 0),
+                        self.active[host])
+                self.max_active = max(self.max_active,
+                        sum(self.active.values()))
+                self.attempts[key] = self.attempts.get(key, 0) + 1
+                n = self.attempts[key]
+                self.lock.release()
+                return n
+
+        def leave(self, host):
+                self.lock.acquire()
+                self.active[host] -= 1
+                self.lock.release()
+
+# Keys control the reply: "slow-*" replies after 0.2s, "timeout<N>-*"
+# replies 408 to the first N requests, "error-*" replies an error. Otherwise
+# the key is returned as the entry ID.
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                path = urlparse.urlsplit(self.path)[2]
+                key = path.split("/")[-1]
+                host = self.headers.get("Host")
+                n = self.server.enter(host, key)
+                try:
+                        if key.startswith("slow"):
+                                time.sleep(0.2)
+                        code, reply = 200, ["ok", "node", "domain", key]
+                        if key.startswith("timeout") and\
+                                        n <= int(key[7:].split("-")[0]):
+                                code, reply = 408, ["error", "timeout"]
+                        elif key.startswith("error"):
+                                reply = ["error", "invalid"]
+                        body = cjson.encode(reply)
+                        self.send_response(code)
+                        self.send_header("Content-Length", str(len(body)))
+                        self.end_headers()
+                        self.wfile.write(body)
+                finally:
+                        self.server.leave(host)
+
+        def log_message(self, *args):
+                pass
+
+class RingoMultiTest(unittest.TestCase):
+        def setUp(self):
+                self.server = StubServer()
+                self.port = self.server.server_address[1]
+                self.thread = threading.Thread(
+                        target = self.server.serve_forever)
+                self.thread.setDaemon(True)
+                self.thread.start()
+                self.clients = []
+
+        # Closes kept-alive connections, so that the handler threads exit
+        def tearDown(self):
+                for ringo in self.clients:
+                        for curl in ringo.free:
+                                curl.close()
+                        ringo.multi.close()
+                self.server.shutdown()
+                self.server.server_close()
+
+        def client(self, **kwargs):
+                ringo = ringogw.RingoMulti("127.0.0.1:%d" % self.port,
+                        **kwargs)
+                self.clients.append(ringo)
+                return ringo
+
+        def url(self, host, key):
+                return "http://%s:%d/mon/data/test/%s" % (host, self.port, key)
+
+        def test_pool_limits(self):
+                ringo = self.client(max_connections = 4, max_per_host = 3)
+                reqs = []
+                for i in range(8):
+                        for host in ["127.0.0.1", "localhost"]:
+                                reqs.append(ringo.call(self.url(host,
+                                        "slow-%d" % i), "x",
+                                        ringo.check_reply))
+                t = time.time()
+                ringo.perform()
+                # 16 requests of 0.2s, 4 at a time
+                self.assert_(time.time() - t >= 0.8)
+                self.assertEqual(self.server.max_active, 4)
+                self.assertEqual(max(self.server.max_per_host.values()), 3)
+                self.assertEqual([r.result()[2] for r in reqs],
+                        ["slow-%d" % (i / 2) for i in range(16)])
+
+        def test_retries(self):
+                ringo = self.client()
+                ok = ringo.put("test", "timeout2-a", "x", retries = 2)
+                fail = ringo.put("test", "timeout2-b", "x", retries = 1)
+                ringo.perform()
+                self.assertEqual(ok.result(), ["node", "domain",
+                        "timeout2-a"])
+                self.assertEqual(ok.num_retries, 2)
+                self.assertEqual(self.server.attempts["timeout2-a"], 3)
+                try:
+                        fail.result()
+                        self.fail("No exception for a timed out request")
+                except ringogw.ReplyException, x:
+                        self.assertEqual(x.retcode, 408)
+                self.assertEqual(fail.num_retries, 1)
+                self.assertEqual(self.server.attempts["timeout2-b"], 2)
+
+        def test_results_and_callbacks(self):
+                ringo = self.client()
+                order = []
+                cb = lambda req: order.append(req)
+                slow = ringo.put("test", "slow-1", "x", callback = cb)
+                error = ringo.put("test", "error-1", "x", callback = cb)
+                fast = ringo.put("test", "fast-1", "x", callback = cb)
+                cached = ringo.cached_result(["value"], callback = cb)
+                self.assertEqual(order, [cached])
+                ringo.perform()
+                self.assertEqual(len(order), 4)
+                self.assertEqual(order[-1], slow)
+                self.assertEqual(set(order), set([slow, error, fast, cached]))
+                self.assertEqual(slow.result(), ["node", "domain", "slow-1"])
+                self.assertEqual(fast.result(), ["node", "domain", "fast-1"])
+                self.assertEqual(cached.result(), ["value"])
+                self.assertRaises(ringogw.ReplyException, error.result)
+
+if __name__ == "__main__":
+        unittest.main()
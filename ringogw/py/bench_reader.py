@@ -0,0 +1,35 @@
+
+# Compares throughput of ringodisco.ringo_reader and ringo_reader_mmap on
+# the given DB file and checks that both return the same entries.
+#
+# Usage: python bench_reader.py path/to/rdomain-XXX/data [rounds]
+
+import sys, os, time
+import ringodisco
+
+def run(reader, fname):
+        t = time.time()
+        out = [(str(k), str(v)) for k, v in reader(file(fname), 0, fname)]
+        return out, time.time() - t
+
+fname = sys.argv[1]
+rounds = 3
+if len(sys.argv) > 2:
+        rounds = int(sys.argv[2])
+mb = os.stat(fname).st_size / 1024.0**2
+
+res = {}
+for reader in [ringodisco.ringo_reader, ringodisco.ringo_reader_mmap]:
+        best = None
+        for i in range(rounds):
+                out, t = run(reader, fname)
+                if best == None or t < best:
+                        best = t
+        res[reader.__name__] = out
+        print "%s: %d entries in %dms (%.1fMB/s)" % (reader.__name__,
+                len(out), best * 1000, mb / max(best, 1e-6))
+
+if res["ringo_reader"] != res["ringo_reader_mmap"]:
+        print "Readers returned different entries!"
+        sys.exit(1)
+print "Results match"
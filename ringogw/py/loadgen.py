@@ -0,0 +1,271 @@
+
+# Load generator for Ringo. Requests are made concurrently by RingoMulti,
+# either in a closed loop, where each of the clients makes a new request as
+# soon as the previous one has finished, or in an open loop, where requests
+# arrive at a fixed average rate regardless of how fast they are served. In
+# the open-loop mode latencies are measured from the arrival time, so that
+# queueing delays are included.
+#
+# Keys are chosen from a uniform, Zipfian or sliding hot set distribution.
+# Throughput, errors and latency percentiles are reported for each interval,
+# and optionally saved as JSON lines.
+#
+# Usage: python loadgen.py ringogw-host domain [options]
+#
+# Examples:
+#
+# Closed loop, 32 clients, Zipfian keys with skew 1.1, 90% gets:
+#   python loadgen.py localhost:15000 test -c 32 -k zipf:1.1 -g 0.9
+#
+# Open loop, 500 req/s, 10% of keys get 90% of requests, hot set moving
+# 100 keys per second, values around the 4KB internal/external boundary:
+#   python loadgen.py localhost:15000 test -r 500 -k hot:0.1:0.9:100\
+#       -s 1000:0.4,4000:0.3,5000:0.3
+
+import sys, time, random, bisect, json, optparse
+import ringogw
+
+#
+# Key distributions
+#
+# Each distribution is a function that returns a key index in [0, nkeys[
+# given the current time relative to the start of the run.
+
+def uniform_keys(nkeys):
+        return lambda t: random.randrange(nkeys)
+
+# Key i is chosen with a probability proportional to 1 / (i + 1)^skew
+def zipf_keys(nkeys, skew):
+        cdf = []
+        c = 0.0
+        for i in range(nkeys):
+                c += 1.0 / (i + 1) ** skew
+                cdf.append(c)
+        return lambda t: bisect.bisect_left(cdf, random.random() * c)
+
+# A hot set of hot * nkeys keys gets prob of the requests. The hot set moves
+# forward by drift keys per second. If all the keys are hot, every request
+# goes to the hot set.
+def hot_keys(nkeys, hot, prob, drift):
+        nhot = min(nkeys, max(1, int(hot * nkeys)))
+        def key(t):
+                offs = int(t * drift)
+                if nhot == nkeys or random.random() < prob:
+                        return (offs + random.randrange(nhot)) % nkeys
+                return (offs + nhot + random.randrange(nkeys - nhot)) % nkeys
+        return key
+
+def parse_keys(spec, nkeys):
+        x = spec.split(":")
+        if x[0] == "uniform":
+                return uniform_keys(nkeys)
+        elif x[0] == "zipf":
+                return zipf_keys(nkeys, float(x[1]))
+        elif x[0] == "hot":
+                hot, prob = float(x[1]), float(x[2])
+                if not (0.0 < hot <= 1.0):
+                        raise ValueError("Hot set fraction must be in "
+                                "]0, 1]: %s" % spec)
+                if not (0.0 <= prob <= 1.0):
+                        raise ValueError("Hot set probability must be in "
+                                "[0, 1]: %s" % spec)
+                return hot_keys(nkeys, hot, prob, float(x[3]))
+        raise ValueError("Unknown key distribution: %s" % spec)
+
+# "1000:0.4,5000:0.6" -> function that returns value sizes with the given
+# weights
+def parse_sizes(spec):
+        sizes = []
+        cdf = []
+        c = 0.0
+        for x in spec.split(","):
+                size, weight = x.split(":")
+                c += float(weight)
+                sizes.append(int(size))
+                cdf.append(c)
+        return lambda: sizes[bisect.bisect_left(cdf, random.random() * c)]
+
+#
+# Results
+#
+
+class Interval:
+        def __init__(self, start):
+                self.start = start
+                # op -> list of latencies
+                self.lat = {}
+                self.errors = {}
+
+        def add(self, op, latency, error):
+                if error:
+                        self.errors[op] = self.errors.get(op, 0) + 1
+                else:
+                        self.lat.setdefault(op, []).append(latency)
+
+        def report(self, length):
+                res = {"time": self.start, "ops": {}}
+                for op in set(self.lat.keys() + self.errors.keys()):
+                        lat = sorted(self.lat.get(op, []))
+                        r = {"throughput": len(lat) / length,
+                                "errors": self.errors.get(op, 0)}
+                        if lat:
+                                for p, q in [("p50", 0.5), ("p99", 0.99),
+                                                ("p999", 0.999)]:
+                                        r[p] = lat[min(len(lat) - 1,
+                                                int(q * len(lat)))] * 1000
+                        res["ops"][op] = r
+                return res
+
+class LoadGen:
+        def __init__(self, ringo, domain, keys, sizes, get_ratio,
+                        interval = 1.0, output = None):
+                self.ringo = ringo
+                self.domain = domain
+                self.keys = keys
+                self.sizes = sizes
+                self.get_ratio = get_ratio
+                self.interval = interval
+                self.output = output
+                self.results = []
+                self.values = {}
+
+        def value(self, size):
+                if size not in self.values:
+                        self.values[size] = "x" * size
+                return self.values[size]
+
+        # Makes a request that arrived at the given time. Done is called
+        # when the request finishes.
+        def request(self, arrival, done = None):
+                key = "key-%d" % self.keys(arrival - self.started)
+                if random.random() < self.get_ratio:
+                        op = "get"
+                        req = self.ringo.get(self.domain, key, single = True,
+                                callback = lambda r: self.finished(op,
+                                        arrival, r, done))
+                else:
+                        op = "put"
+                        req = self.ringo.put(self.domain, key,
+                                self.value(self.sizes()),
+                                callback = lambda r: self.finished(op,
+                                        arrival, r, done))
+
+        def finished(self, op, arrival, req, done):
+                now = time.time()
+                # A missing key is not an error in the load test
+                error = req.error and\
+                        getattr(req.error, "retcode", None) != 404
+                self.current(now).add(op, now - arrival, error)
+                if done:
+                        done()
+
+        def current(self, now):
+                while now >= self.cur.start + self.interval:
+                        self.report(self.cur)
+                        self.cur = Interval(self.cur.start + self.interval)
+                return self.cur
+
+        def report(self, interval):
+                res = interval.report(self.interval)
+                res["time"] -= self.started
+                self.results.append(res)
+                print "%6.1fs" % res["time"], " ".join(
+                        "%s: %.1f/s err %d p50 %.1fms p99 %.1fms" %
+                        (op, r["throughput"], r["errors"], r.get("p50", 0),
+                                r.get("p99", 0))
+                        for op, r in sorted(res["ops"].items()))
+                if self.output:
+                        self.output.write(json.dumps(res) + "\n")
+                        self.output.flush()
+
+        def start(self):
+                self.started = time.time()
+                self.cur = Interval(self.started)
+
+        def finish(self):
+                self.ringo.perform()
+                self.report(self.cur)
+
+        def closed_loop(self, clients, duration):
+                self.start()
+                end = self.started + duration
+                def next():
+                        now = time.time()
+                        if now < end:
+                                self.request(now, next)
+                for i in range(clients):
+                        next()
+                while time.time() < end:
+                        self.ringo.poll()
+                        self.current(time.time())
+                self.finish()
+
+        def open_loop(self, rate, duration):
+                self.start()
+                end = self.started + duration
+                # Poisson arrivals
+                arrival = self.started + random.expovariate(rate)
+                while arrival < end:
+                        now = time.time()
+                        while arrival <= now:
+                                self.request(arrival)
+                                arrival += random.expovariate(rate)
+                        self.ringo.poll(max(0, min(0.1, arrival - now)))
+                        if arrival > now and not self.ringo.num_active:
+                                time.sleep(max(0, arrival - time.time()))
+                        self.current(time.time())
+                self.finish()
+
+def prefill(ringo, domain, nkeys, sizes):
+        print "Putting %d keys" % nkeys
+        for i in range(0, nkeys, 1000):
+                ringo.put_many(domain, [("key-%d" % j, "x" * sizes())
+                        for j in range(i, min(i + 1000, nkeys))])
+
+if __name__ == "__main__":
+        parser = optparse.OptionParser(
+                usage = "%prog ringogw-host domain [options]")
+        parser.add_option("-c", "--clients", type = "int", default = 16,
+                help = "number of concurrent connections")
+        parser.add_option("-r", "--rate", type = "float",
+                help = "open loop with this many requests per second "
+                        "(default: closed loop)")
+        parser.add_option("-d", "--duration", type = "float", default = 60,
+                help = "length of the run in seconds")
+        parser.add_option("-n", "--keys", type = "int", default = 100000,
+                help = "number of distinct keys")
+        parser.add_option("-k", "--distribution", default = "uniform",
+                help = "uniform, zipf:SKEW or hot:FRACTION:PROB:DRIFT")
+        parser.add_option("-g", "--get-ratio", type = "float", default = 0.9,
+                help = "fraction of requests that are gets")
+        parser.add_option("-s", "--sizes", default = "100:1",
+                help = "value sizes and their weights, SIZE:WEIGHT,...")
+        parser.add_option("-i", "--interval", type = "float", default = 1.0,
+                help = "reporting interval in seconds")
+        parser.add_option("-o", "--output",
+                help = "save results to this file as JSON lines")
+        parser.add_option("--create", type = "int", metavar = "NREPL",
+                help = "create the domain with NREPL replicas")
+        parser.add_option("--prefill", action = "store_true",
+                help = "put all the keys before the run")
+        opts, args = parser.parse_args()
+        if len(args) != 2:
+                parser.error("ringogw host or domain missing")
+        host, domain = args
+
+        sizes = parse_sizes(opts.sizes)
+        if opts.create:
+                ringogw.Ringo(host).create(domain, opts.create)
+        if opts.prefill:
+                prefill(ringogw.Ringo(host), domain, opts.keys, sizes)
+
+        output = None
+        if opts.output:
+                output = file(opts.output, "w")
+        gen = LoadGen(ringogw.RingoMulti(host, max_connections =
+                opts.clients), domain, parse_keys(opts.distribution,
+                opts.keys), sizes, opts.get_ratio, opts.interval, output)
+        if opts.rate:
+                gen.open_loop(opts.rate, opts.duration)
+        else:
+                gen.closed_loop(opts.clients, opts.duration)
@@ -0,0 +1,547 @@
+
+# Direct access to Ringo's DB files. See ringo_writer.erl and ringo_reader.erl
+# for the reference implementation of the on-disk format:
+#
+# MAGIC_HEAD HeadCRC | Time EntryID Flags KeyCRC KeyLen ValCRC ValLen |
+# Key Value MAGIC_TAIL
+#
+# All integers are 32-bit little-endian. HeadCRC covers the seven fields
+# between the bars.
+#
+# The DB file is memory-mapped and keys and values are returned as buffer
+# objects that point directly to the mapping, so no bytes are copied per
+# entry. Use str() to get a private copy of a buffer. Note that buffers
+# become invalid when the mapping is closed.
+
+import mmap, struct, zlib, os, time, array, bisect, heapq, multiprocessing
+
+MAGIC_HEAD = 0x47da66b5
+MAGIC_TAIL = 0xacc50f5d
+MAGIC_HEAD_B = struct.pack("<I", MAGIC_HEAD)
+MAGIC_TAIL_B = struct.pack("<I", MAGIC_TAIL)
+
+EXT_FLAG = 1
+IBLOCK_FLAG = 2
+
+KEY_MAX = 4096
+VAL_INTERNAL_MAX = 4096
+
+HEAD_SIZE = 9 * 4
+# Keys and internal values are smaller than their limits and external values
+# are stored as short links, which bounds the size of any entry in a DB file.
+ENTRY_MAX = HEAD_SIZE + KEY_MAX + VAL_INTERNAL_MAX + 4
+
+# Ranges smaller than this are not worth a separate process
+SPLIT_MIN = 1024**2
+
+head_struct = struct.Struct("<IIIIIIIII")
+# External link: CRC of the value (big-endian) followed by the file name,
+# see ringo_writer:make_entry
+extlink_struct = struct.Struct(">I")
+
+EXT_BUFFER_SIZE = 65536
+
+class CorruptedValue(Exception):
+        pass
+
+def crc32(buf):
+        # zlib.crc32 returns a signed integer on Python 2
+        return zlib.crc32(buf) & 0xffffffff
+
+def open_db(fd):
+        # Returns None for an empty file, which can't be mapped.
+        if isinstance(fd, basestring):
+                fd = file(fd)
+        fd.seek(0, 2)
+        if fd.tell() == 0:
+                return None
+        return mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ)
+
+# Decode_entry decodes the entry that starts at pos. It returns None if there
+# isn't a valid entry at pos, otherwise a tuple
+#
+# (EndPos, Time, EntryID, Flags, Key, Value)
+def decode_entry(db, pos):
+        size = len(db)
+        if pos + HEAD_SIZE > size:
+                return None
+        magic, head_crc, time, entryid, flags, keycrc,\
+                keylen, valcrc, vallen = head_struct.unpack_from(db, pos)
+        body = pos + HEAD_SIZE
+        tail = body + keylen + vallen
+        if magic != MAGIC_HEAD or tail + 4 > size or\
+                crc32(buffer(db, pos + 8, HEAD_SIZE - 8)) != head_crc:
+                return None
+        key = buffer(db, body, keylen)
+        val = buffer(db, body + keylen, vallen)
+        if crc32(key) != keycrc or crc32(val) != valcrc or\
+                db[tail:tail + 4] != MAGIC_TAIL_B:
+                return None
+        return tail + 4, time, entryid, flags, key, val
+
+# Scan_entries yields all valid entries, including iblocks and duplicates,
+# that start in the range [start, end[ as tuples
+#
+# (Pos, Time, EntryID, Flags, Key, Value)
+#
+# Corrupted and partially written entries are skipped by searching for the
+# next MAGIC_HEAD after the failed head, as ringo_reader:seek_magic does.
+#
+# If match is given, it is called with each key, as a string, before the
+# value is read. Entries whose key doesn't match are yielded with None as the
+# key and value, without checking the CRC of the value. The CRC of the key
+# and MAGIC_TAIL are still checked, so a corrupted length can't make the
+# scanner skip over valid entries. See key_predicate.
+def scan_entries(db, start = 0, end = None, match = None):
+        if db == None:
+                return
+        size = len(db)
+        if end == None or end > size:
+                end = size
+        find = db.find
+        unpack = head_struct.unpack_from
+        pos = start
+        while pos < end:
+                # The magic head must start before end, but it may
+                # continue after it.
+                pos = find(MAGIC_HEAD_B, pos, min(end + 3, size))
+                if pos == -1:
+                        return
+                # Same as decode_entry(), inlined for speed
+                if pos + HEAD_SIZE > size:
+                        return
+                magic, head_crc, time, entryid, flags, keycrc,\
+                        keylen, valcrc, vallen = unpack(db, pos)
+                body = pos + HEAD_SIZE
+                tail = body + keylen + vallen
+                if crc32(buffer(db, pos + 8, HEAD_SIZE - 8)) != head_crc or\
+                        tail + 4 > size:
+                        pos += 1
+                        continue
+                if match != None:
+                        k = db[body:body + keylen]
+                        if crc32(k) != keycrc or\
+                                db[tail:tail + 4] != MAGIC_TAIL_B:
+                                pos += 1
+                                continue
+                        if not match(k):
+                                yield pos, time, entryid, flags, None, None
+                                pos = tail + 4
+                                continue
+                key = buffer(db, body, keylen)
+                val = buffer(db, body + keylen, vallen)
+                if crc32(key) != keycrc or crc32(val) != valcrc or\
+                        db[tail:tail + 4] != MAGIC_TAIL_B:
+                        pos += 1
+                        continue
+                yield pos, time, entryid, flags, key, val
+                pos = tail + 4
+
+# Returns a predicate for scan_entries that matches the given keys, keys
+# with the given prefix, or both
+def key_predicate(keys = None, prefix = None):
+        if prefix == None:
+                return frozenset(keys).__contains__
+        if keys == None:
+                return lambda key: key.startswith(prefix)
+        keys = frozenset(keys)
+        return lambda key: key in keys or key.startswith(prefix)
+
+# Read_entries yields (key, value) pairs as ringodisco.ringo_reader does:
+# Iblocks are skipped, as well as consequent entries with an equal EntryID.
+# Prev_id is the EntryID of the entry preceding start, if known.
+#
+# External values are skipped, unless home, the domain directory that
+# contains the DB file, is given. In this case an ExternalValue is returned
+# in place of the value.
+#
+# If dedup, a SyncIDSet, is given, entries whose SyncID is already in the
+# set are skipped as well, and SyncIDs of yielded entries are added to it.
+# The same set can be shared by several calls to remove duplicates across
+# replicas.
+#
+# If match is given, only entries whose key matches are yielded, and values
+# of the other entries are not read at all. See scan_entries.
+def read_entries(db, start = 0, end = None, prev_id = None, home = None,
+                dedup = None, match = None):
+        for pos, time, entryid, flags, key, val in\
+                        scan_entries(db, start, end, match):
+                if flags & IBLOCK_FLAG:
+                        continue
+                if flags & EXT_FLAG and home == None:
+                        continue
+                if entryid == prev_id:
+                        continue
+                # A skipped entry counts as the previous one, as it would
+                # without the predicate
+                prev_id = entryid
+                if key == None:
+                        continue
+                if flags & EXT_FLAG:
+                        val = ExternalValue(home, val)
+                if dedup != None and not dedup.add(time << 32 | entryid):
+                        continue
+                yield key, val
+
+#
+# Global de-duplication
+#
+# Resync and redirected puts may append an entry far from its previous copy,
+# so comparing consequent EntryIDs doesn't catch all duplicates. Entries are
+# identified globally by their SyncID, Time << 32 | EntryID, as in ringo_sync.
+#
+# SyncIDSet keeps SyncIDs as unboxed integers in sorted arrays, eight bytes
+# each on 64-bit platforms. New IDs are first collected to a small set which
+# is sorted into a new array when it fills up, and arrays of similar size are
+# merged, so there are at most log(N) arrays to search.
+#
+# The set is exact but its memory is bounded by max_bytes. A quarter of it is
+# reserved for a Bloom filter of spilled IDs, and merging two arrays may
+# temporarily double the rest, so when the arrays and the pending set exceed
+# 3/8 of max_bytes, they are merged to a temporary file in spill_dir. The file
+# is memory-mapped and searched in place. The Bloom filter keeps most lookups
+# of new IDs off the disk. A false positive only costs a search in the spilled
+# runs, it never drops an entry.
+
+DEDUP_MAX_BYTES = 256 * 1024**2
+DEDUP_PENDING = 65536
+# Approximate cost of an ID in the pending set, including the int object
+PENDING_ITEM_BYTES = 64
+BLOOM_HASHES = 7
+MASK64 = 0xffffffffffffffff
+
+# Splitmix64 finalizer: every bit of the output depends on all the bits of
+# the 64-bit SyncID, so both the Time and EntryID halves are used.
+def mix64(x):
+        x = (x + 0x9e3779b97f4a7c15) & MASK64
+        x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & MASK64
+        x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & MASK64
+        return x ^ (x >> 31)
+
+# A sorted run of SyncIDs in a temporary file. Supports len() and indexing,
+# so it can be searched with bisect as the in-memory arrays.
+class SpilledRun:
+        def __init__(self, ids, typecode, spill_dir = None):
+                import tempfile
+                f = tempfile.TemporaryFile(dir = spill_dir)
+                buf = array.array(typecode)
+                self.itemsize = buf.itemsize
+                self.num = 0
+                for syncid in ids:
+                        buf.append(syncid)
+                        if len(buf) >= DEDUP_PENDING:
+                                buf.tofile(f)
+                                self.num += len(buf)
+                                buf = array.array(typecode)
+                buf.tofile(f)
+                self.num += len(buf)
+                f.flush()
+                self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+                # The mapping keeps the file alive
+                f.close()
+                self.unpack = struct.Struct(typecode).unpack_from
+
+        def __len__(self):
+                return self.num
+
+        def __getitem__(self, i):
+                if i >= self.num:
+                        raise IndexError(i)
+                return self.unpack(self.map, i * self.itemsize)[0]
+
+class SyncIDSet:
+        def __init__(self, max_bytes = DEDUP_MAX_BYTES, spill_dir = None):
+                self.max_bytes = max_bytes
+                self.spill_dir = spill_dir
+                self.mem_max = max_bytes * 3 / 8
+                self.pending = set()
+                self.runs = []
+                self.run_bytes = 0
+                self.spilled = []
+                self.bloom = None
+                self.nbits = max(64, (max_bytes / 4) * 8)
+                self.num_ids = 0
+
+        def __contains__(self, syncid):
+                if syncid in self.pending:
+                        return True
+                for run in self.runs:
+                        if self.run_contains(run, syncid):
+                                return True
+                if self.spilled and self.bloom_contains(syncid):
+                        for run in self.spilled:
+                                if self.run_contains(run, syncid):
+                                        return True
+                return False
+
+        def run_contains(self, run, syncid):
+                i = bisect.bisect_left(run, syncid)
+                return i < len(run) and run[i] == syncid
+
+        # Adds syncid to the set. Returns False if it was already there.
+        def add(self, syncid):
+                if syncid in self:
+                        return False
+                self.num_ids += 1
+                self.pending.add(syncid)
+                if len(self.pending) >= DEDUP_PENDING or\
+                                self.memory() > self.mem_max:
+                        self.flush()
+                return True
+
+        # Bytes used by the arrays and the pending set
+        def memory(self):
+                return self.run_bytes + len(self.pending) * PENDING_ITEM_BYTES
+
+        def flush(self):
+                run = array.array("L", sorted(self.pending))
+                self.pending = set()
+                self.runs.append(run)
+                self.run_bytes += len(run) * run.itemsize
+                if self.memory() > self.mem_max:
+                        self.spill()
+                        return
+                # Merge runs of similar size, largest first, as in a
+                # binary counter
+                while len(self.runs) > 1 and\
+                                len(self.runs[-2]) <= len(self.runs[-1]):
+                        run = self.runs.pop()
+                        self.runs.append(merge_runs(self.runs.pop(), run))
+
+        def spill(self):
+                if self.bloom == None:
+                        self.bloom = bytearray(self.nbits / 8)
+                def ids():
+                        for syncid in heapq.merge(*self.runs):
+                                self.bloom_add(syncid)
+                                yield syncid
+                self.spilled.append(SpilledRun(ids(), "L", self.spill_dir))
+                self.runs = []
+                self.run_bytes = 0
+                # Spilled runs are merged as the arrays, so there are at most
+                # log(N) files to search
+                while len(self.spilled) > 1 and\
+                                len(self.spilled[-2]) <= len(self.spilled[-1]):
+                        run = self.spilled.pop()
+                        self.spilled.append(SpilledRun(heapq.merge(
+                                self.spilled.pop(), run), "L", self.spill_dir))
+
+        # Double hashing (Kirsch and Mitzenmacher) on the two halves of the
+        # mixed ID
+        def bloom_bits(self, syncid):
+                h = mix64(syncid)
+                h1 = h & 0xffffffff
+                h2 = (h >> 32) | 1
+                return [(h1 + i * h2) % self.nbits
+                        for i in range(BLOOM_HASHES)]
+
+        def bloom_add(self, syncid):
+                for b in self.bloom_bits(syncid):
+                        self.bloom[b >> 3] |= 1 << (b & 7)
+
+        def bloom_contains(self, syncid):
+                for b in self.bloom_bits(syncid):
+                        if not self.bloom[b >> 3] & (1 << (b & 7)):
+                                return False
+                return True
+
+# Merges two sorted arrays into a new array, which is allocated at once
+def merge_runs(a, b):
+        run = array.array(a.typecode, [0]) * (len(a) + len(b))
+        for i, syncid in enumerate(heapq.merge(a, b)):
+                run[i] = syncid
+        return run
+
+# Read_files yields (key, value) pairs from several DB files, typically
+# replicas of the same chunk, with duplicates removed across the files. Home
+# is resolved for each file, so external values are returned if external is
+# true. See SyncIDSet for max_bytes and spill_dir, and scan_entries for match.
+def read_files(fnames, external = False, max_bytes = DEDUP_MAX_BYTES,
+                match = None, spill_dir = None):
+        dedup = SyncIDSet(max_bytes, spill_dir)
+        for fname in fnames:
+                home = None
+                if external:
+                        home = os.path.dirname(os.path.abspath(fname))
+                for key, val in read_entries(open_db(fname), home = home,
+                                dedup = dedup, match = match):
+                        yield key, val
+
+#
+# Tailing
+#
+# A DB file only grows by appending, so a reader can resume from the end of
+# the last entry it has seen. The checkpoint is the position after the last
+# yielded entry and its EntryID, which is needed to skip a duplicate that
+# follows it. Iblocks and duplicates that are skipped don't move the
+# checkpoint, so they may be scanned again when a reader resumes, but they
+# are never yielded twice.
+#
+# An entry that is being written fails its checks until it is complete.
+# Since the checkpoint never moves past an entry that hasn't been yielded,
+# a partially written tail is simply scanned again on the next poll.
+
+# Follow_entries yields (key, value, pos, entryid) tuples for entries that
+# start at or after pos, as read_entries does, and waits for new entries
+# to be appended. Pos and entryid form the checkpoint from which to continue
+# after the yielded entry.
+#
+# Following stops when the domain directory contains the closed file and all
+# the entries have been read, or when no new entries have appeared in
+# timeout seconds, if a timeout is given.
+def follow_entries(fname, pos = 0, prev_id = None, home = None,
+                poll = 1.0, timeout = None):
+        closed = os.path.join(os.path.dirname(fname), "closed")
+        idle = time.time()
+        size = 0
+        while True:
+                # The closed file is created after the last entry has been
+                # written, so a pass that starts after it has been seen
+                # reads the remaining entries.
+                is_closed = os.path.exists(closed)
+                if os.path.exists(fname):
+                        size = os.stat(fname).st_size
+                if size > pos:
+                        for p, t, entryid, flags, key, val in\
+                                        scan_entries(open_db(fname), pos):
+                                end = p + HEAD_SIZE + len(key) + len(val) + 4
+                                if flags & IBLOCK_FLAG:
+                                        continue
+                                if flags & EXT_FLAG:
+                                        if home == None:
+                                                continue
+                                        val = ExternalValue(home, val)
+                                if entryid == prev_id:
+                                        continue
+                                prev_id = entryid
+                                pos = end
+                                idle = time.time()
+                                yield key, val, pos, entryid
+                if is_closed:
+                        return
+                if timeout != None and time.time() - idle > timeout:
+                        return
+                time.sleep(poll)
+
+#
+# External values
+#
+# Values larger than VAL_INTERNAL_MAX are stored in separate files in the
+# domain directory. ExternalValue resolves the link lazily: Nothing is read
+# until the value is opened, and the value is never read to memory as a
+# whole. The CRC is checked incrementally while the value is being read.
+
+class ExternalValue:
+        def __init__(self, home, link):
+                self.crc = extlink_struct.unpack_from(link, 0)[0]
+                self.fname = str(link[extlink_struct.size:])
+                self.path = os.path.join(home, self.fname)
+
+        def size(self):
+                return os.stat(self.path).st_size
+
+        # Returns a file-like object that raises CorruptedValue when
+        # the end of a value is reached that doesn't match its CRC.
+        def open(self):
+                return ExternalFile(self.path, self.crc)
+
+        # Returns a read-only mmap of the value. The CRC is checked only
+        # if verify is true, which reads the whole file.
+        def mmap(self, verify = False):
+                fd = file(self.path)
+                try:
+                        m = open_db(fd)
+                finally:
+                        fd.close()
+                if m == None:
+                        m = ""
+                if verify:
+                        c = 0
+                        for i in range(0, len(m), EXT_BUFFER_SIZE):
+                                c = zlib.crc32(buffer(m, i,
+                                        EXT_BUFFER_SIZE), c)
+                        if c & 0xffffffff != self.crc:
+                                raise CorruptedValue(self.path)
+                return m
+
+class ExternalFile:
+        def __init__(self, path, crc):
+                self.fd = file(path)
+                self.path = path
+                self.crc = crc
+                self.c = 0
+
+        def read(self, size = -1):
+                data = self.fd.read(size)
+                self.c = zlib.crc32(data, self.c)
+                # A short read means that the end of the file was reached
+                if (size < 0 or len(data) < size) and\
+                        self.c & 0xffffffff != self.crc:
+                        raise CorruptedValue(self.path)
+                return data
+
+        def __iter__(self):
+                while True:
+                        data = self.read(EXT_BUFFER_SIZE)
+                        if not data:
+                                break
+                        yield data
+
+        def close(self):
+                self.fd.close()
+
+#
+# Parallel scanning
+#
+# A DB file can be split to byte ranges that are scanned independently. Each
+# range owns the entries that start in it: Scan_entries seeks forward to the
+# first valid entry head in the range, and the last entry of a range may
+# extend over its end. Since entries carry their own checksums, a range that
+# starts in the middle of an entry re-synchronizes safely.
+
+def split_ranges(fname, n):
+        size = os.stat(fname).st_size
+        n = max(1, min(n, size / SPLIT_MIN))
+        step = size / n + 1
+        return [(i, min(i + step, size)) for i in range(0, size, step)]
+
+# Returns the EntryID of the last entry that read_entries would yield before
+# pos. Only the preceding ENTRY_MAX bytes need to be scanned, which makes it
+# possible to skip duplicate entries over range boundaries.
+def prev_entryid(db, pos):
+        prev_id = None
+        for p, time, entryid, flags, key, val in\
+                        scan_entries(db, max(0, pos - ENTRY_MAX), pos):
+                if not (flags & EXT_FLAG or flags & IBLOCK_FLAG):
+                        prev_id = entryid
+        return prev_id
+
+def scan_range(fname, start, end, fun):
+        db = open_db(fname)
+        if start > 0:
+                prev_id = prev_entryid(db, start)
+        else:
+                prev_id = None
+        return fun(read_entries(db, start, end, prev_id))
+
+def _scan_task(args):
+        return scan_range(*args)
+
+# Scan_files splits the given DB files to ranges and scans them in a pool of
+# nproc processes. Fun is called with a (key, value) iterator for each range
+# and its results are returned in an arbitrary order. Fun must be a module-
+# level function and it must return a picklable value, as required by
+# multiprocessing.
+def scan_files(fnames, fun, nproc = None, splits = None):
+        if nproc == None:
+                nproc = multiprocessing.cpu_count()
+        if splits == None:
+                splits = nproc
+        tasks = [(fname, start, end, fun) for fname in fnames
+                        for start, end in split_ranges(fname, splits)]
+        pool = multiprocessing.Pool(nproc)
+        try:
+                for res in pool.imap_unordered(_scan_task, tasks):
+                        yield res
+        finally:
+                pool.terminate()
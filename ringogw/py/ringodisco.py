@@ -1,10 +1,12 @@
-import ringogw
+import ringogw, os
 
 
 def ringo_reader(fd, sze, fname):
         import struct, zlib
         MAGIC_HEAD = (0x47da66b5,)
         MAGIC_TAIL = (0xacc50f5d,)
+        # zlib.crc32 returns a signed integer on Python 2
+        crc32 = lambda x: zlib.crc32(x) & 0xffffffff
         def read_really(s):
                 t = 0
                 buf = ""
@@ -25,7 +27,7 @@ def ringo_reader(fd, sze, fname):
                         return False, head_body + body
                 key = body[:keylen]
                 val = body[keylen:-4]
-                if zlib.crc32(key) != keycrc or zlib.crc32(val) != valcrc or\
+                if crc32(key) != keycrc or crc32(val) != valcrc or\
                         struct.unpack("<I", body[-4:]) != MAGIC_TAIL:
                         return False, head_body + body
                 else:
@@ -41,7 +43,7 @@ def ringo_reader(fd, sze, fname):
                                         return None
                                 head_crc = struct.unpack("<I", head[4:8])[0]
                                 head_body = head[8:36]
-                                if zlib.crc32(head_body) == head_crc:
+                                if crc32(head_body) == head_crc:
                                         ok, cont = check_body(head_body)
                                         if ok:
                                                 return cont
@@ -65,6 +67,30 @@ def ringo_reader(fd, sze, fname):
                 prev_id = entryid
                 yield key, val
 
+# Same as ringo_reader above but the DB file is memory-mapped and scanned with
+# ringodb, which is considerably faster. Keys and values are yielded as buffer
+# objects that point to the mapping. Ringodb must be available on the Disco
+# nodes.
+def ringo_reader_mmap(fd, sze, fname):
+        import ringodb
+        return ringodb.read_entries(ringodb.open_db(fd))
+
+# Same as ringo_reader_mmap but external values are included, as
+# ringodb.ExternalValue objects that are resolved against the directory of
+# the DB file. Fd must be a local file.
+def ringo_reader_ext(fd, sze, fname):
+        import ringodb, os
+        home = os.path.dirname(os.path.abspath(fd.name))
+        return ringodb.read_entries(ringodb.open_db(fd), home = home)
+
+# Same as ringo_reader_mmap but duplicates are removed across the whole DB
+# file by their SyncIDs, not only consequent ones. See ringodb.SyncIDSet
+# for the memory bound.
+def ringo_reader_dedup(fd, sze, fname):
+        import ringodb
+        return ringodb.read_entries(ringodb.open_db(fd),
+                dedup = ringodb.SyncIDSet())
+
 
 def input_domain(ringo_host, name):
         ringo = ringogw.Ringo(ringo_host)
@@ -78,6 +104,102 @@ def input_domain(ringo_host, name):
                         % (node, nodename[6:], domainid))
         return urls
 
+# Returns paths to the local DB files of the domain's chunks, one replica for
+# each chunk, for direct scanning with ringodb.scan_files(). Root is the
+# directory where node homes are mounted, i.e. where /_ringo points to in
+# the Disco URLs above.
+def domain_files(ringo_host, name, root):
+        ringo = ringogw.Ringo(ringo_host)
+        code, res = ringo.request("/mon/domains/domain?name=" + name)
+        if code != 200:
+                return []
+        files = {}
+        for domainid, name, nodeid, chunk, owner, nrepl in res:
+                nodename, node = nodeid.split('@')
+                path = os.path.join(root, nodename[6:],
+                        "rdomain-" + domainid, "data")
+                if chunk not in files and os.path.exists(path):
+                        files[chunk] = path
+        return [path for chunk, path in sorted(files.items())]
+
+# Returns the directory name of the given chunk of the domain, see
+# ringo_util:domain_id
+def chunk_dir(name, chunk):
+        import hashlib
+        return "rdomain-%X" % int(hashlib.md5("%d %s" % (chunk, name)).\
+                hexdigest(), 16)
+
+# Returns the path to a local DB file of the given chunk under root, or None
+# if the chunk doesn't exist (yet).
+def chunk_file(root, name, chunk):
+        import glob
+        paths = sorted(glob.glob(os.path.join(root, "*",
+                chunk_dir(name, chunk), "data")))
+        if paths:
+                return paths[0]
+        return None
+
+# Follow_domain yields (key, value, checkpoint) for entries of the domain in
+# chunk order, starting from the given checkpoint, and waits for new entries
+# as ringodb.follow_entries does. When a chunk becomes full, following
+# continues from the next chunk. The checkpoint is a tuple
+#
+# (Chunk, FileName, Pos, EntryID)
+#
+# which can be saved with save_checkpoint. Offsets differ between replicas,
+# so the same DB file is used until the chunk is full. External values are
+# returned as ringodb.ExternalValue objects if external is true, otherwise
+# they are skipped.
+#
+# Following stops if no new entries have appeared in timeout seconds, if a
+# timeout is given.
+def follow_domain(root, name, checkpoint = None, external = False,
+                poll = 1.0, timeout = None):
+        import ringodb, time
+        if checkpoint == None:
+                checkpoint = (0, None, 0, None)
+        chunk, fname, pos, prev_id = checkpoint
+        started = time.time()
+        while True:
+                if fname == None:
+                        fname = chunk_file(root, name, chunk)
+                        if fname == None:
+                                if timeout != None and\
+                                        time.time() - started > timeout:
+                                        return
+                                time.sleep(poll)
+                                continue
+                        pos = 0
+                        prev_id = None
+                home = None
+                if external:
+                        home = os.path.dirname(os.path.abspath(fname))
+                for key, val, pos, prev_id in ringodb.follow_entries(fname,
+                                pos, prev_id, home, poll, timeout):
+                        yield key, val, (chunk, fname, pos, prev_id)
+                if not os.path.exists(os.path.join(os.path.dirname(fname),
+                                "closed")):
+                        # Timeout
+                        return
+                chunk += 1
+                fname = None
+                started = time.time()
+
+def load_checkpoint(fname):
+        import json
+        if not os.path.exists(fname):
+                return None
+        return tuple(json.load(file(fname)))
+
+# The checkpoint is written to a temporary file first, so that a crash
+# never leaves a partial checkpoint behind.
+def save_checkpoint(fname, checkpoint):
+        import json
+        f = file(fname + ".partial", "w")
+        json.dump(list(checkpoint), f)
+        f.close()
+        os.rename(fname + ".partial", fname)
+
 if __name__ == "__main__":
         import sys
         print "\n".join(input_domain(sys.argv[1], sys.argv[2]))
@@ -1,7 +1,6 @@
 
-import cjson, pycurl, cStringIO, time, re
-
-multi_head_re = re.compile("(\d+) (.*?) ")
+import cjson, pycurl, cStringIO, time, collections, urlparse, struct, os
+import bisect
 
 class ReplyException(Exception):
         pass
@@ -23,55 +22,386 @@ class DecodeJson:
                 return cjson.decode(self.buf.getvalue())
                 self.host = host
 
+# DecodeFile writes the reply to a file as it is received, starting at
+# position start. The file is truncated to start when the decoder is
+# created, so that a re-tried request overwrites a partial reply of the
+# previous attempt. Output is the number of bytes written.
+class DecodeFile:
+        def __init__(self, fileobj, start):
+                self.fileobj = fileobj
+                fileobj.seek(start)
+                fileobj.truncate()
+                self.size = 0
+        def write(self, data):
+                self.fileobj.write(data)
+                self.size += len(data)
+        def output(self):
+                return self.size
+
+# Upload is a value that is read from a file while it is being sent. Size
+# bytes are sent starting from the current position of the file.
+class Upload:
+        def __init__(self, fileobj, size = None):
+                self.fileobj = fileobj
+                self.start = fileobj.tell()
+                if size == None:
+                        size = os.fstat(fileobj.fileno()).st_size - self.start
+                self.size = size
+
+        def read(self, n):
+                return self.fileobj.read(min(n, self.start + self.size -
+                        self.fileobj.tell()))
+
+# Sets the request method and body
+def set_data(curl, data):
+        if data == None:
+                curl.setopt(curl.HTTPGET, 1)
+        elif isinstance(data, Upload):
+                data.fileobj.seek(data.start)
+                curl.setopt(curl.POST, 1)
+                curl.setopt(curl.READFUNCTION, data.read)
+                curl.setopt(curl.POSTFIELDSIZE_LARGE, data.size)
+                curl.setopt(curl.HTTPHEADER, ["Expect:"])
+        else:
+                curl.setopt(curl.POST, 1)
+                curl.setopt(curl.POSTFIELDS, data)
+                curl.setopt(curl.HTTPHEADER, ["Expect:"])
+
+# DecodeMulti decodes a stream of length-prefixed values. Incoming data is
+# appended to a bytearray and entries are decoded at a read cursor, so that
+# each byte is copied only a constant number of times. Consumed bytes are
+# dropped when they make up half of the buffer.
 class DecodeMulti:
         def __init__(self, cb = None):
                 if not cb:
                         cb = lambda e, out: out.append(e)
                 self.cb = cb
-                self.buf = ""
+                self.buf = bytearray()
+                self.pos = 0
                 self.ret = "ok"
                 self.out = []
+                self.code = None
                 self.entrylen = None
 
+        def entry(self, code, data):
+                if code != 'ok':
+                        self.ret = code
+                self.cb(data, self.out)
+
         def write(self, data):
-                self.buf += data
+                buf = self.buf
+                buf.extend(data)
+                pos = self.pos
                 while True:
                         # State 1: Read header, if available
                         if self.entrylen == None:
-                                m = multi_head_re.match(self.buf)
-                                if m:
-                                        sze, ret = m.groups()
-                                        self.entrylen = int(sze)
-                                        if ret != 'ok':
-                                                self.ret = ret
-                                        self.buf = self.buf[m.end():]
-                                else:
+                                i = buf.find(" ", pos)
+                                j = buf.find(" ", i + 1)
+                                if i == -1 or j == -1:
                                         # Wait for more data
                                         break
+                                self.entrylen = int(buf[pos:i])
+                                self.code = str(buf[i + 1:j])
+                                pos = j + 1
                         # State 2: Read body, if available
-                        elif len(self.buf) >= self.entrylen:
-                                r = self.cb(self.buf[:self.entrylen], self.out)
-                                self.buf = self.buf[self.entrylen:]
+                        elif len(buf) - pos >= self.entrylen:
+                                end = pos + self.entrylen
+                                self.entry(self.code, str(buf[pos:end]))
+                                pos = end
                                 self.entrylen = None
                         else:
                                 # Wait for more data
                                 break
+                if pos > len(buf) / 2:
+                        del buf[:pos]
+                        pos = 0
+                self.pos = pos
 
         def output(self):
-                if self.buf:
+                extra = len(self.buf) - self.pos
+                if extra:
                         raise ReplyException("%d extra bytes in the stream" %
-                                len(self.buf))
+                                extra)
                 else:
                         return self.ret, self.out
 
+# DecodeKeyed decodes replies to get_many, where each value is preceded by
+# its key. Output is a dictionary that maps keys to lists of values.
+class DecodeKeyed(DecodeMulti):
+        def __init__(self):
+                DecodeMulti.__init__(self)
+                self.out = {}
+                self.key = None
+
+        def entry(self, code, data):
+                if code == 'key':
+                        self.key = data
+                elif code == 'ok':
+                        self.out.setdefault(self.key, []).append(data)
+                else:
+                        self.ret = code
+
+# ResultCache keeps results of get requests in memory. Only domains that have
+# a policy are cached. The policy is the time in seconds that a cached result
+# is valid, or None if it never expires, which is safe for domains whose keys
+# are written only once. Least recently used results are evicted when the
+# total size of cached keys and values exceeds max_bytes.
+#
+# Empty results are not cached, since a key that doesn't exist yet may be
+# written by another client at any time. Puts invalidate only the results
+# cached by the same client.
+class ResultCache:
+        def __init__(self, max_bytes, policies = {}):
+                self.max_bytes = max_bytes
+                self.policies = dict(policies)
+                # (domain, key, single) -> (value, size, expires)
+                self.entries = collections.OrderedDict()
+                self.size = 0
+                self.hits = 0
+                self.misses = 0
+                self.evictions = 0
+
+        def set_policy(self, domain, ttl = None):
+                self.policies[domain] = ttl
+
+        def cached(self, domain):
+                return domain in self.policies
+
+        # Returns None if the result is not cached
+        def get(self, domain, key, single):
+                e = self.entries.pop((domain, key, single), None)
+                if e == None:
+                        self.misses += 1
+                        return None
+                value, size, expires = e
+                if expires != None and expires < time.time():
+                        self.size -= size
+                        self.misses += 1
+                        return None
+                self.entries[(domain, key, single)] = e
+                self.hits += 1
+                if single:
+                        return value
+                return list(value)
+
+        def put(self, domain, key, single, value):
+                self.remove(domain, key, single)
+                # With single, a missing key is an error, not a result
+                if not single and not value:
+                        return
+                if single:
+                        size = len(key) + len(value)
+                else:
+                        value = list(value)
+                        size = len(key) + sum(len(v) for v in value)
+                if size > self.max_bytes:
+                        return
+                ttl = self.policies[domain]
+                if ttl == None:
+                        expires = None
+                else:
+                        expires = time.time() + ttl
+                self.entries[(domain, key, single)] = (value, size, expires)
+                self.size += size
+                while self.size > self.max_bytes:
+                        k, (v, sze, x) = self.entries.popitem(last = False)
+                        self.size -= sze
+                        self.evictions += 1
+
+        def remove(self, domain, key, single):
+                e = self.entries.pop((domain, key, single), None)
+                if e != None:
+                        self.size -= e[1]
+
+        def invalidate(self, domain, key):
+                self.remove(domain, key, True)
+                self.remove(domain, key, False)
+
+        def stats(self):
+                return {"hits": self.hits, "misses": self.misses,
+                        "evictions": self.evictions,
+                        "entries": len(self.entries), "bytes": self.size}
+
+# Metrics records the timing breakdown of each request that a Ringo object
+# makes. Requests are classified by operation and domain, based on the URL,
+# and for each (operation, domain) pair, as well as for each operation over
+# all domains (domain None), the following are recorded:
+#
+# - histograms of the times reported by curl: namelookup, connect,
+#   pretransfer, starttransfer and total (in seconds). Time to connect
+#   includes the name lookup and so on, so the differences tell which phase
+#   is slow: Pretransfer - connect is the time to send the request and
+#   starttransfer - pretransfer the time the gateway took to respond.
+# - number of requests, errors (curl errors and other codes than 200 and
+#   404) and 408 retries
+# - bytes sent and received
+#
+# Hooks are called with a dictionary that contains the above for each
+# finished request, which makes it possible to export them elsewhere.
+# Recording a request costs less than 20us, and totals over all domains
+# are computed only when they are requested.
+
+TIMINGS = [("namelookup", pycurl.NAMELOOKUP_TIME),
+           ("connect", pycurl.CONNECT_TIME),
+           ("pretransfer", pycurl.PRETRANSFER_TIME),
+           ("starttransfer", pycurl.STARTTRANSFER_TIME),
+           ("total", pycurl.TOTAL_TIME)]
+
+# Histogram bucket bounds in seconds, from 10us to 100s
+BUCKETS = [1e-5 * 10 ** (i / 8.0) for i in range(57)]
+
+class Histogram:
+        def __init__(self):
+                self.counts = [0] * (len(BUCKETS) + 1)
+                self.count = 0
+                self.sum = 0.0
+
+        def add(self, x):
+                self.counts[bisect.bisect_left(BUCKETS, x)] += 1
+                self.count += 1
+                self.sum += x
+
+        # Returns the upper bound of the bucket that contains the q'th
+        # quantile
+        def percentile(self, q):
+                n = q * self.count
+                c = 0
+                for i, x in enumerate(self.counts):
+                        c += x
+                        if c >= n and x:
+                                return BUCKETS[min(i, len(BUCKETS) - 1)]
+                return 0.0
+
+        def merge(self, other):
+                self.counts = [x + y for x, y in
+                        zip(self.counts, other.counts)]
+                self.count += other.count
+                self.sum += other.sum
+
+        def stats(self):
+                if not self.count:
+                        return {"count": 0}
+                return {"count": self.count, "mean": self.sum / self.count,
+                        "p50": self.percentile(0.5),
+                        "p99": self.percentile(0.99),
+                        "p999": self.percentile(0.999)}
+
+class OpStats:
+        def __init__(self):
+                self.hist = dict((name, Histogram()) for name, x in TIMINGS)
+                self.requests = 0
+                self.errors = 0
+                self.retries = 0
+                self.bytes_in = 0
+                self.bytes_out = 0
+
+        def add(self, sample):
+                for name, x in TIMINGS:
+                        self.hist[name].add(sample[name])
+                self.requests += 1
+                if sample["error"]:
+                        self.errors += 1
+                self.retries += sample["retries"]
+                self.bytes_in += sample["bytes_in"]
+                self.bytes_out += sample["bytes_out"]
+
+        def merge(self, other):
+                for name, x in TIMINGS:
+                        self.hist[name].merge(other.hist[name])
+                self.requests += other.requests
+                self.errors += other.errors
+                self.retries += other.retries
+                self.bytes_in += other.bytes_in
+                self.bytes_out += other.bytes_out
+
+        def stats(self):
+                return {"requests": self.requests, "errors": self.errors,
+                        "retries": self.retries, "bytes_in": self.bytes_in,
+                        "bytes_out": self.bytes_out,
+                        "timings": dict((name, h.stats())
+                                for name, h in self.hist.items())}
+
+# Returns (operation, domain) for a request
+def request_op(url, data):
+        scheme, host, path, query, x = urlparse.urlsplit(url)
+        p = path.split("/", 4)
+        if len(p) < 4 or p[1] != "mon" or p[2] != "data":
+                return "mon", None
+        if len(p) == 4:
+                for op in ["create", "get_many"]:
+                        if op in query:
+                                return op, p[3]
+                return "put_many", p[3]
+        if data != None:
+                return "put", p[3]
+        elif "single" in query:
+                return "get_single", p[3]
+        return "get", p[3]
+
+class Metrics:
+        def __init__(self, hooks = []):
+                self.hooks = list(hooks)
+                # (op, domain) -> OpStats
+                self.ops = {}
+
+        def add_hook(self, hook):
+                self.hooks.append(hook)
+
+        def record(self, curl, url, data, code, error, retries):
+                op, domain = request_op(url, data)
+                sample = {"op": op, "domain": domain, "code": code,
+                        "error": error != None or
+                                code not in (200, 404),
+                        "retries": retries,
+                        "bytes_in": int(curl.getinfo(curl.SIZE_DOWNLOAD)),
+                        "bytes_out": int(curl.getinfo(curl.SIZE_UPLOAD))}
+                for name, info in TIMINGS:
+                        sample[name] = curl.getinfo(info)
+                key = (op, domain)
+                if key not in self.ops:
+                        self.ops[key] = OpStats()
+                self.ops[key].add(sample)
+                for hook in self.hooks:
+                        hook(sample)
+
+        # Returns OpStats for the operation on the domain, or over all
+        # domains if domain is None
+        def get(self, op, domain = None):
+                if domain != None:
+                        return self.ops.get((op, domain))
+                res = OpStats()
+                for (o, d), s in self.ops.items():
+                        if o == op:
+                                res.merge(s)
+                return res
+
+        # Returns statistics as a list of dictionaries, one for each
+        # (operation, domain) pair and for each operation over all domains.
+        def stats(self):
+                res = []
+                keys = self.ops.keys() + list(set((op, None)
+                        for op, domain in self.ops))
+                for op, domain in sorted(keys):
+                        x = self.get(op, domain).stats()
+                        x["op"] = op
+                        x["domain"] = domain
+                        res.append(x)
+                return res
+
+        def reset(self):
+                self.ops = {}
+
 class Ringo:
-        def __init__(self, host, keep_alive = True):
+        def __init__(self, host, keep_alive = True, cache = None,
+                        metrics = None):
                 if not host.startswith("http://"):
                         host = "http://" + host
                 self.host = host
                 if keep_alive:
                         self.curl = pycurl.Curl()
                 self.keep_alive = keep_alive
+                self.cache = cache
+                self.metrics = metrics
 
         def request(self, url, data = None, verbose = False,
                         retries = 0, decoder = DecodeJson):
@@ -86,33 +416,41 @@ class Ringo:
                 else:
                         purl = self.host + url
 
-                curl.setopt(curl.URL, purl)
-                if data == None:
-                        curl.setopt(curl.HTTPGET, 1)
-                else:
-                        curl.setopt(curl.POST, 1)
-                        curl.setopt(curl.POSTFIELDS, data)
-                        curl.setopt(curl.HTTPHEADER, ["Expect:"])
-                dec = decoder()
-                curl.setopt(curl.WRITEFUNCTION, dec.write)
-                try:
-                        curl.perform()
-                except pycurl.error, x:
-                        if verbose:
-                                print "Pycurl.error:", x
-                        return x
+                num_retries = 0
+                while True:
+                        # A previously set POSTFIELDS can't be unset, and
+                        # it would be used instead of the file
+                        if isinstance(data, Upload):
+                                curl.reset()
+                        curl.setopt(curl.URL, purl)
+                        set_data(curl, data)
+                        dec = decoder()
+                        curl.setopt(curl.WRITEFUNCTION, dec.write)
+                        try:
+                                curl.perform()
+                        except pycurl.error, x:
+                                if verbose:
+                                        print "Pycurl.error:", x
+                                if self.metrics:
+                                        self.metrics.record(curl, purl, data,
+                                                None, x, num_retries)
+                                return x
 
-                code = curl.getinfo(curl.HTTP_CODE)
-                if verbose:
-                        print "Request took %.2fms" %\
-                                (curl.getinfo(curl.TOTAL_TIME) * 1000.0)
+                        code = curl.getinfo(curl.HTTP_CODE)
+                        if verbose:
+                                print "Request took %.2fms" %\
+                                        (curl.getinfo(curl.TOTAL_TIME) *
+                                                1000.0)
 
-                # Request timeout
-                if code == 408 and retries > 0:
-                        time.sleep(0.1)
-                        return self.request(url, data, verbose,
-                                        retries - 1, decoder)
-                else: 
+                        # Request timeout
+                        if code == 408 and retries > 0:
+                                retries -= 1
+                                num_retries += 1
+                                time.sleep(0.1)
+                                continue
+                        if self.metrics:
+                                self.metrics.record(curl, purl, data, code,
+                                        None, num_retries)
                         return code, dec.output()
 
 
@@ -125,6 +463,24 @@ class Ringo:
                         raise e 
                 return reply[1][1:]
 
+        def check_single(self, reply):
+                code, val = reply
+                if code != 200:
+                        e = ReplyException("Invalid reply (code: %d)" % code)
+                        e.retcode = code
+                        raise e
+                return val
+
+        # All operations below go through call(), which makes the request
+        # and passes its reply to finish(). RingoMulti overrides this.
+        def call(self, url, data, finish, **kwargs):
+                return finish(self.request(url, data, **kwargs))
+
+        # Returns a result that was found in the cache as call() would
+        # return it.
+        def cached_result(self, value, **kwargs):
+                return value
+
         def create(self, domain, nrepl, **kwargs):
                 kwargs['decoder'] = DecodeJson
                 url = "/mon/data/%s?create&nrepl=%d" % (domain, nrepl)
@@ -134,26 +490,57 @@ class Ringo:
                 if 'keycache' in kwargs:
                         url += "&keycache=1"
                         del kwargs['keycache']
-                return self.check_reply(self.request(url, "", **kwargs))[0]
+                return self.call(url, "",
+                        lambda r: self.check_reply(r)[0], **kwargs)
 
         def put(self, domain, key, value, **kwargs):
+                if self.cache:
+                        self.cache.invalidate(domain, key)
+                kwargs['decoder'] = DecodeJson
+                return self.call("/mon/data/%s/%s" % (domain, key), value,
+                        self.check_reply, **kwargs)
+
+        # Put_file puts a value that is read from fileobj while it is
+        # being sent. By default, the rest of the file is sent.
+        def put_file(self, domain, key, fileobj, size = None, **kwargs):
+                return self.put(domain, key, Upload(fileobj, size), **kwargs)
+
+        # Puts a sequence of (key, value) pairs with a single request.
+        # Returns a list that contains the put result for each pair in the
+        # same order, either ['ok', Node, DomainID, EntryID] or ['error',
+        # Reason].
+        def put_many(self, domain, pairs, **kwargs):
+                # Pairs may be a generator, which can be iterated only once
+                pairs = list(pairs)
+                if self.cache:
+                        for k, v in pairs:
+                                self.cache.invalidate(domain, k)
                 kwargs['decoder'] = DecodeJson
-                return self.check_reply(self.request("/mon/data/%s/%s" %\
-                        (domain, key), value, **kwargs))
+                data = "".join(struct.pack(">II", len(k), len(v)) + k + v
+                        for k, v in pairs)
+                return self.call("/mon/data/%s?many" % domain, data,
+                        lambda r: self.check_reply(r)[0], **kwargs)
                 
+        # Read can be "owner" (default), "any" or "hedged", see the
+        # parameter ?read in the documentation.
         def get(self, domain, key, **kwargs):
                 url = "/mon/data/%s/%s" % (domain, key)
-                kwargs['data'] = None
-                if 'single' in kwargs:
+                query = []
+                single = 'single' in kwargs
+                # Results of entry callbacks can't be cached
+                cache = self.cache
+                if not (cache and cache.cached(domain)) or\
+                                'entry_callback' in kwargs:
+                        cache = None
+                if cache:
+                        value = cache.get(domain, key, single)
+                        if value != None:
+                                return self.cached_result(value, **kwargs)
+                if single:
                         kwargs['decoder'] = DecodeRaw
                         del kwargs['single']
-                        code, val = self.request(url + "?single", **kwargs)
-                        if code != 200:
-                                e = ReplyException("Invalid reply (code: %d)"\
-                                        % code)
-                                e.retcode = code
-                                raise e
-                        return val
+                        query.append("single")
+                        check = self.check_single
                 else:
                         if 'entry_callback' in kwargs:
                                 cb = kwargs['entry_callback']
@@ -161,4 +548,265 @@ class Ringo:
                                 del kwargs['entry_callback']
                         else:
                                 kwargs['decoder'] = DecodeMulti
-                        return self.check_reply(self.request(url, **kwargs))[0]
+                        check = lambda r: self.check_reply(r)[0]
+                if 'read' in kwargs:
+                        query.append("read=" + kwargs.pop('read'))
+                if query:
+                        url += "?" + "&".join(query)
+                def finish(reply):
+                        value = check(reply)
+                        if cache:
+                                cache.put(domain, key, single, value)
+                        return value
+                return self.call(url, None, finish, **kwargs)
+
+        # Get_to_file writes a single value for the key to fileobj as it is
+        # received. Returns the size of the value. Contents of the file are
+        # undefined if an exception is raised.
+        def get_to_file(self, domain, key, fileobj, **kwargs):
+                start = fileobj.tell()
+                kwargs['decoder'] = lambda: DecodeFile(fileobj, start)
+                return self.call("/mon/data/%s/%s?single" % (domain, key),
+                        None, self.check_single, **kwargs)
+
+        # Iter_get yields values for the key as they are received, without
+        # collecting them to a list first. Values that were received before
+        # an error are yielded before the corresponding exception is raised.
+        def iter_get(self, domain, key, timeout = None):
+                dec = DecodeMulti()
+                curl = pycurl.Curl()
+                url = "%s/mon/data/%s/%s" % (self.host, domain, key)
+                curl.setopt(curl.URL, url)
+                curl.setopt(curl.WRITEFUNCTION, dec.write)
+                if timeout:
+                        curl.setopt(curl.TIMEOUT, timeout)
+                multi = pycurl.CurlMulti()
+                multi.add_handle(curl)
+                try:
+                        while True:
+                                while True:
+                                        ret, num = multi.perform()
+                                        if ret != pycurl.E_CALL_MULTI_PERFORM:
+                                                break
+                                code = curl.getinfo(curl.HTTP_CODE)
+                                if code and code != 200:
+                                        e = ReplyException(
+                                                "Invalid reply (code: %d)" %
+                                                        code)
+                                        e.retcode = code
+                                        raise e
+                                out = dec.out
+                                dec.out = []
+                                for value in out:
+                                        yield value
+                                if not num:
+                                        break
+                                multi.select(1.0)
+                        num, ok_list, err_list = multi.info_read()
+                        for c, errno, errmsg in err_list:
+                                error = pycurl.error(errno, errmsg)
+                                if self.metrics:
+                                        self.metrics.record(curl, url, None,
+                                                None, error, 0)
+                                raise error
+                        if self.metrics:
+                                self.metrics.record(curl, url, None,
+                                        curl.getinfo(curl.HTTP_CODE), None, 0)
+                        ret, out = dec.output()
+                        for value in out:
+                                yield value
+                        if ret != 'ok':
+                                raise ReplyException("Invalid reply: %s" % ret)
+                finally:
+                        multi.remove_handle(curl)
+                        curl.close()
+
+        # Gets the values of many keys with a single request. Returns a
+        # dictionary that maps each key to a list of its values.
+        def get_many(self, domain, keys, **kwargs):
+                kwargs['decoder'] = DecodeKeyed
+                data = "".join(struct.pack(">I", len(k)) + k for k in keys)
+                def finish(reply):
+                        res = self.check_reply(reply)[0]
+                        for key in keys:
+                                res.setdefault(key, [])
+                        return res
+                url = "/mon/data/%s?get_many" % domain
+                if 'read' in kwargs:
+                        url += "&read=" + kwargs.pop('read')
+                return self.call(url, data, finish, **kwargs)
+
+# RingoMulti makes many requests concurrently from a single thread using
+# pycurl's multi interface. Operations return a Request object instead of the
+# result. Requests are queued and processed when perform() is called, which
+# returns when all queued requests have finished. Request.result() returns the
+# result of a finished request, or raises the exception that the
+# corresponding Ringo operation would have raised. Results that are found in
+# the cache are returned as finished requests.
+#
+# At most max_connections requests, and at most max_per_host requests to a
+# single host, are active at any time. Curl handles are re-used, so their
+# connections are kept alive between requests.
+class RingoMulti(Ringo):
+        def __init__(self, host, max_connections = 16, max_per_host = None,
+                        timeout = None, cache = None, metrics = None):
+                Ringo.__init__(self, host, keep_alive = False, cache = cache,
+                        metrics = metrics)
+                if max_per_host == None:
+                        max_per_host = max_connections
+                self.max_per_host = max_per_host
+                self.timeout = timeout
+                self.multi = pycurl.CurlMulti()
+                self.free = [pycurl.Curl() for i in range(max_connections)]
+                # host -> deque of pending requests
+                self.pending = {}
+                self.num_pending = 0
+                # host -> number of active requests
+                self.active = {}
+                self.num_active = 0
+                # requests waiting for a re-try
+                self.delayed = []
+
+        def call(self, url, data, finish, verbose = False, retries = 0,
+                        decoder = DecodeJson, callback = None):
+                if not url.startswith("http://"):
+                        url = self.host + url
+                req = Request(url, data, finish, verbose, retries, decoder,
+                        callback)
+                self.enqueue(req)
+                return req
+
+        def cached_result(self, value, callback = None, **kwargs):
+                req = Request(None, None, None, False, 0, None, callback)
+                req.done(value = value)
+                return req
+
+        def enqueue(self, req):
+                host = urlparse.urlsplit(req.url)[1]
+                self.pending.setdefault(host,
+                        collections.deque()).append(req)
+                self.num_pending += 1
+
+        def perform(self):
+                while self.num_pending or self.num_active or self.delayed:
+                        self.poll()
+
+        # Poll makes progress with the queued requests and waits for at most
+        # timeout seconds. It can be used instead of perform() to process
+        # requests while new ones are being queued.
+        def poll(self, timeout = 0.1):
+                self.start_requests()
+                while True:
+                        ret, num = self.multi.perform()
+                        if ret != pycurl.E_CALL_MULTI_PERFORM:
+                                break
+                self.finish_requests()
+                if self.num_active:
+                        self.multi.select(timeout)
+                elif not self.num_pending and self.delayed:
+                        time.sleep(max(0, min(timeout, min(r.not_before
+                                for r in self.delayed) - time.time())))
+
+        def start_requests(self):
+                if self.delayed:
+                        now = time.time()
+                        for req in [r for r in self.delayed
+                                        if r.not_before <= now]:
+                                self.delayed.remove(req)
+                                self.enqueue(req)
+                for host, queue in self.pending.items():
+                        while queue and self.free and\
+                                self.active.get(host, 0) < self.max_per_host:
+                                self.start(host, queue.popleft())
+                        if not queue:
+                                del self.pending[host]
+
+        def start(self, host, req):
+                curl = self.free.pop()
+                if isinstance(req.data, Upload):
+                        curl.reset()
+                curl.setopt(curl.URL, req.url)
+                set_data(curl, req.data)
+                if self.timeout:
+                        curl.setopt(curl.TIMEOUT, self.timeout)
+                req.dec = req.decoder()
+                curl.setopt(curl.WRITEFUNCTION, req.dec.write)
+                curl.req = req
+                req.host = host
+                self.multi.add_handle(curl)
+                self.active[host] = self.active.get(host, 0) + 1
+                self.num_active += 1
+                self.num_pending -= 1
+
+        def finish_requests(self):
+                while True:
+                        num, ok_list, err_list = self.multi.info_read()
+                        for curl in ok_list:
+                                self.finish(curl, None)
+                        for curl, errno, errmsg in err_list:
+                                self.finish(curl, pycurl.error(errno, errmsg))
+                        if num == 0:
+                                break
+
+        def finish(self, curl, error):
+                req = curl.req
+                curl.req = None
+                self.multi.remove_handle(curl)
+                self.free.append(curl)
+                self.active[req.host] -= 1
+                self.num_active -= 1
+                if error:
+                        if req.verbose:
+                                print "Pycurl.error:", error
+                        if self.metrics:
+                                self.metrics.record(curl, req.url, req.data,
+                                        None, error, req.num_retries)
+                        req.done(error = error)
+                        return
+                code = curl.getinfo(curl.HTTP_CODE)
+                if req.verbose:
+                        print "Request took %.2fms" %\
+                                (curl.getinfo(curl.TOTAL_TIME) * 1000.0)
+                # Request timeout
+                if code == 408 and req.retries > 0:
+                        req.retries -= 1
+                        req.num_retries += 1
+                        req.not_before = time.time() + 0.1
+                        self.delayed.append(req)
+                        return
+                if self.metrics:
+                        self.metrics.record(curl, req.url, req.data, code,
+                                None, req.num_retries)
+                try:
+                        req.done(value = req.finish((code, req.dec.output())))
+                except Exception, x:
+                        req.done(error = x)
+
+class Request:
+        def __init__(self, url, data, finish, verbose, retries, decoder,
+                        callback):
+                self.url = url
+                self.data = data
+                self.finish = finish
+                self.verbose = verbose
+                self.retries = retries
+                self.num_retries = 0
+                self.decoder = decoder
+                self.callback = callback
+                self.finished = False
+                self.value = None
+                self.error = None
+
+        def done(self, value = None, error = None):
+                self.finished = True
+                self.value = value
+                self.error = error
+                if self.callback:
+                        self.callback(self)
+
+        def result(self):
+                if not self.finished:
+                        raise ReplyException("Request not finished")
+                if self.error:
+                        raise self.error
+                return self.value
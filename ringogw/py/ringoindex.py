@@ -0,0 +1,327 @@
+
+# Key lookups on a DB file without the gateway. Index is built from the
+# iblocks that ringo_indexdomain has saved to the DB, and the entries after
+# the last iblock are indexed in memory, as ringo_indexdomain:initialize does.
+#
+# Iblocks are kept in their serialized form (see ringo_index:serialize) and
+# searched directly, which keeps the index as compact as the iblock cache in
+# ringo_indexdomain:
+#
+# SingleSegSize:32 MultiSegSize:32 OffsetSize:32 SingleSeg MultiSeg Offsets
+#
+# SingleSeg maps key hashes with a single position to the position, MultiSeg
+# maps them to a bit offset in Offsets, where an Elias-gamma coded delta list
+# of positions, terminated by 1, starts. See bin_util:encode_kvsegment for
+# the segment format. All integers are big-endian.
+
+import os, sys, struct, binascii, hashlib, mmap, bisect
+import ringodb
+
+iblock_head_struct = struct.Struct(">III")
+
+def dexhash(key):
+        return struct.unpack(">I", hashlib.md5(key).digest()[:4])[0]
+
+def getbits(data, off, n):
+        if n == 0:
+                return 0
+        start = off >> 3
+        end = (off + n + 7) >> 3
+        x = int(binascii.hexlify(data[start:end]), 16)
+        return (x >> ((end << 3) - off - n)) & ((1 << n) - 1)
+
+# Binary search, see bin_util:find_kv
+def find_kv(key, seg):
+        if not seg:
+                return None
+        n = getbits(seg, 0, 32)
+        b = getbits(seg, 32, 5)
+        lo = 0
+        hi = n
+        while lo < hi:
+                mid = (lo + hi) / 2
+                off = 37 + mid * (32 + b)
+                k = getbits(seg, off, 32)
+                if k < key:
+                        lo = mid + 1
+                elif k > key:
+                        hi = mid
+                else:
+                        return getbits(seg, off + 32, b)
+        return None
+
+# See ringo_index:decode_poslist
+def decode_poslist(data, off):
+        pos = getbits(data, off, 32)
+        off += 32
+        lst = [pos]
+        while True:
+                z = 0
+                while not getbits(data, off + z, 1):
+                        z += 1
+                d = getbits(data, off + z, z + 1)
+                off += 2 * z + 1
+                if d == 1:
+                        return lst
+                pos += d
+                lst.append(pos)
+
+# Returns a list of (KeyHash, Pos) pairs for the entries that start at or
+# after start, and the EntryID of the last entry. Iblocks and consequent
+# duplicate entries are skipped, as in ringo_reader:fold.
+def index_entries(db, start = 0, prev_id = None):
+        entries = []
+        for pos, time, entryid, flags, key, val in\
+                        ringodb.scan_entries(db, start):
+                if entryid != prev_id and not flags & ringodb.IBLOCK_FLAG:
+                        entries.append((dexhash(key), pos))
+                prev_id = entryid
+        return entries, prev_id
+
+class Iblock:
+        def __init__(self, data):
+                s1, s2, s3 = iblock_head_struct.unpack_from(data, 0)
+                o = iblock_head_struct.size
+                self.single = data[o:o + s1]
+                self.multi = data[o + s1:o + s1 + s2]
+                self.offsets = data[o + s1 + s2:o + s1 + s2 + s3]
+
+        def find(self, hash):
+                pos = find_kv(hash, self.single)
+                if pos != None:
+                        return [pos]
+                offs = find_kv(hash, self.multi)
+                if offs != None:
+                        return decode_poslist(self.offsets, offs)
+                return []
+
+class Index:
+        def __init__(self, fname):
+                self.home = os.path.dirname(os.path.abspath(fname))
+                self.db = ringodb.open_db(fname)
+                self.iblocks = []
+                self.tail = {}
+                self.tail_start = self.load_iblocks()
+                self.index_tail()
+
+        # Loads iblocks that cover the DB without holes, starting from the
+        # beginning of the DB. Returns the position where the coverage ends.
+        def load_iblocks(self):
+                cands = {}
+                for pos, time, entryid, flags, key, val in\
+                                ringodb.scan_entries(self.db):
+                        if flags & ringodb.IBLOCK_FLAG:
+                                x, start, end = str(key).split("-")
+                                cands.setdefault(int(start), (int(end),
+                                        ringodb.ExternalValue(self.home, val)))
+                pos = 0
+                while pos in cands:
+                        end, ext = cands[pos]
+                        try:
+                                f = ext.open()
+                                iblock = Iblock(f.read())
+                                f.close()
+                        except (IOError, ringodb.CorruptedValue):
+                                break
+                        self.iblocks.append(iblock)
+                        pos = end
+                return pos
+
+        # Indexes the entries after the last iblock
+        def index_tail(self, prev_id = None):
+                entries, prev_id = index_entries(self.db, self.tail_start,
+                        prev_id)
+                for hash, pos in entries:
+                        self.tail.setdefault(hash, []).append(pos)
+
+        def offsets(self, key):
+                hash = dexhash(key)
+                offs = []
+                for iblock in self.iblocks:
+                        offs += iblock.find(hash)
+                return offs + self.tail.get(hash, [])
+
+        # Returns all values for the key in the order they were put, as
+        # ringo_indexdomain does. External values are returned as
+        # ringodb.ExternalValue objects.
+        def lookup(self, key):
+                res = []
+                for pos in self.offsets(key):
+                        e = ringodb.decode_entry(self.db, pos)
+                        # Ignore hash collisions and corrupted entries
+                        if e == None or str(e[4]) != key:
+                                continue
+                        end, time, entryid, flags, k, val = e
+                        if flags & ringodb.EXT_FLAG:
+                                val = ringodb.ExternalValue(self.home, val)
+                        res.append(val)
+                return res
+
+#
+# Sidecar index
+#
+# A chunk that has become full doesn't receive new entries, except possibly
+# a few by resyncing, so its index can be built once and saved next to the
+# DB file. The sidecar index is a flat file that is used through mmap
+# without loading it, so opening it takes constant time:
+#
+# Header | Hashes | Starts | Fences | Offsets
+#
+# Hashes is the sorted array of distinct key hashes (uint32). The positions
+# of the entries for Hashes[i] are Offsets[Starts[i]:Starts[i + 1]] (uint32
+# and uint64, respectively). Fences contains every fence_step'th hash, so a
+# lookup needs a binary search on Fences and a single block of Hashes, which
+# is fence_step * 4 bytes, i.e. one page by default. All integers are
+# little-endian.
+#
+# The header records the size of the DB file when the index was built.
+# Entries written after it are indexed in memory when the sidecar is opened.
+
+SIDECAR_MAGIC = "RSX1"
+# Magic FenceStep NumHashes NumOffsets LastID HasLastID DBSize
+sidecar_head_struct = struct.Struct("<4sIIIIIQ")
+FENCE_STEP = 1024
+# Number of array items that are packed at once
+PACK_SIZE = 65536
+
+def sidecar_name(dbname):
+        return dbname + ".sidx"
+
+def _write_array(f, fmt, items):
+        for i in range(0, len(items), PACK_SIZE):
+                x = items[i:i + PACK_SIZE]
+                f.write(struct.pack("<%d%s" % (len(x), fmt), *x))
+
+# Builds a sidecar index for the DB file dbname. Returns the name of the
+# sidecar file.
+def build_sidecar(dbname, fname = None, fence_step = FENCE_STEP):
+        if fname == None:
+                fname = sidecar_name(dbname)
+        db = ringodb.open_db(dbname)
+        size = 0
+        if db != None:
+                size = len(db)
+        entries, prev_id = index_entries(db)
+        entries.sort()
+        hashes = []
+        starts = []
+        for i, (hash, pos) in enumerate(entries):
+                if not hashes or hashes[-1] != hash:
+                        hashes.append(hash)
+                        starts.append(i)
+        starts.append(len(entries))
+        fences = hashes[::fence_step]
+
+        # Write to a temporary file first, so that a partial index is never
+        # used
+        tmp = fname + ".partial"
+        f = file(tmp, "w")
+        f.write(sidecar_head_struct.pack(SIDECAR_MAGIC, fence_step,
+                len(hashes), len(entries), prev_id or 0, prev_id != None,
+                size))
+        _write_array(f, "I", hashes)
+        _write_array(f, "I", starts)
+        _write_array(f, "I", fences)
+        # Align Offsets to 8 bytes
+        if f.tell() % 8:
+                f.write("\0" * (8 - f.tell() % 8))
+        _write_array(f, "Q", [pos for hash, pos in entries])
+        f.close()
+        os.rename(tmp, fname)
+        return fname
+
+class SidecarIndex(Index):
+        def __init__(self, dbname, fname = None):
+                if fname == None:
+                        fname = sidecar_name(dbname)
+                self.home = os.path.dirname(os.path.abspath(dbname))
+                self.db = ringodb.open_db(dbname)
+                f = file(fname)
+                self.sidecar = mmap.mmap(f.fileno(), 0,
+                        access = mmap.ACCESS_READ)
+                f.close()
+                magic, self.fence_step, self.num_hashes, num_offsets,\
+                        last_id, has_last_id, self.tail_start =\
+                                sidecar_head_struct.unpack_from(
+                                        self.sidecar, 0)
+                if magic != SIDECAR_MAGIC:
+                        raise ValueError("%s is not a sidecar index" % fname)
+                self.hashes = sidecar_head_struct.size
+                self.starts = self.hashes + self.num_hashes * 4
+                self.fences = self.starts + (self.num_hashes + 1) * 4
+                self.num_fences = (self.num_hashes + self.fence_step - 1) /\
+                        self.fence_step
+                self.offs = self.fences + self.num_fences * 4
+                self.offs += -self.offs % 8
+                self.tail = {}
+                if self.db != None and len(self.db) > self.tail_start:
+                        if not has_last_id:
+                                last_id = None
+                        self.index_tail(last_id)
+
+        def uint32(self, base, i):
+                return struct.unpack_from("<I", self.sidecar, base + i * 4)[0]
+
+        # Returns the index of hash in Hashes, or None
+        def find(self, hash):
+                # Find the last fence that is not larger than hash
+                lo = 0
+                hi = self.num_fences
+                while lo < hi:
+                        mid = (lo + hi) / 2
+                        if self.uint32(self.fences, mid) > hash:
+                                hi = mid
+                        else:
+                                lo = mid + 1
+                if lo == 0:
+                        return None
+                start = (lo - 1) * self.fence_step
+                n = min(self.fence_step, self.num_hashes - start)
+                block = struct.unpack_from("<%dI" % n, self.sidecar,
+                        self.hashes + start * 4)
+                i = bisect.bisect_left(block, hash)
+                if i < n and block[i] == hash:
+                        return start + i
+                return None
+
+        def offsets(self, key):
+                hash = dexhash(key)
+                offs = []
+                i = self.find(hash)
+                if i != None:
+                        s = self.uint32(self.starts, i)
+                        e = self.uint32(self.starts, i + 1)
+                        offs = list(struct.unpack_from("<%dQ" % (e - s),
+                                self.sidecar, self.offs + s * 8))
+                return offs + self.tail.get(hash, [])
+
+# Usage:
+# python ringoindex.py build path/to/rdomain-XXX/data [sidecar]
+# python ringoindex.py lookup path/to/rdomain-XXX/data key
+if __name__ == "__main__":
+        if len(sys.argv) > 2 and sys.argv[1] == "build":
+                dbname = sys.argv[2]
+                if not os.path.exists(os.path.join(
+                                os.path.dirname(dbname), "closed")):
+                        print >> sys.stderr, "Warning: %s is not closed. "\
+                                "New entries will be indexed in memory "\
+                                "when the index is opened." % dbname
+                fname = None
+                if len(sys.argv) > 3:
+                        fname = sys.argv[3]
+                print "Sidecar index saved to", build_sidecar(dbname, fname)
+        elif len(sys.argv) > 3 and sys.argv[1] == "lookup":
+                dbname = sys.argv[2]
+                if os.path.exists(sidecar_name(dbname)):
+                        index = SidecarIndex(dbname)
+                else:
+                        index = Index(dbname)
+                for val in index.lookup(sys.argv[3]):
+                        if isinstance(val, ringodb.ExternalValue):
+                                print "<external %s>" % val.path
+                        else:
+                                print str(val)
+        else:
+                print >> sys.stderr, "Usage: python ringoindex.py "\
+                        "build dbfile [sidecar] | lookup dbfile key"
+                sys.exit(1)
@@ -0,0 +1,197 @@
+
+# Offline Merkle trees and replica diffs. The leaf hashes and the tree are
+# computed from a DB file exactly as ringo_sync does for resync, so the root
+# hash matches synctree_root that /mon/domains/domain reports for a replica
+# whose inbox is empty.
+#
+# Each entry is identified by its SyncID, (Time, EntryID). The entry belongs
+# to leaf EntryID & (NUM_MERKLE_LEAVES - 1) and the leaf hash is the XOR of
+# its EntryIDs. Each level of the tree is built from the level below by
+# hashing pairs of nodes with CRC32. Entries are read as ringo_reader:fold
+# reads them: Iblocks are skipped, as well as consequent entries with an
+# equal EntryID. External entries are included.
+#
+# Since XOR is commutative, a DB file can be split to ranges that are scanned
+# in parallel, see ringodb.scan_files, and the leaf hashes of the ranges are
+# combined afterwards. Replicas are diffed as ringo_syncdomain does: Only
+# SyncIDs in the leaves whose hashes differ are collected, in a second pass.
+#
+# Usage: python ringosync.py [options] replica1 replica2 ...
+#
+# where replicas are domain directories (rdomain-XXX) or DB files of the same
+# chunk on different nodes.
+
+import os, sys, struct, zlib, multiprocessing, optparse
+import ringodb
+
+NUM_MERKLE_LEAVES = 8192
+
+# Returns the EntryID of the entry preceding pos, as ringo_reader:fold sees
+# it, or None. Unlike ringodb.prev_entryid, all entries count.
+def prev_entryid(db, pos):
+        prev_id = None
+        for p, time, entryid, flags, key, val in\
+                        ringodb.scan_entries(db, max(0, pos - ringodb.ENTRY_MAX),
+                                pos):
+                prev_id = entryid
+        return prev_id
+
+# Yields (Time, EntryID) for the entries that start in [start, end[
+def sync_ids(db, start = 0, end = None, prev_id = None):
+        for pos, time, entryid, flags, key, val in\
+                        ringodb.scan_entries(db, start, end):
+                if entryid != prev_id and not flags & ringodb.IBLOCK_FLAG:
+                        yield time, entryid
+                prev_id = entryid
+
+def sync_id_slot(entryid):
+        return entryid & (NUM_MERKLE_LEAVES - 1)
+
+# Returns (LeafHashes, NumEntries) for the given SyncIDs
+def leaf_hashes(ids):
+        leaves = [0] * NUM_MERKLE_LEAVES
+        n = 0
+        mask = NUM_MERKLE_LEAVES - 1
+        for time, entryid in ids:
+                leaves[entryid & mask] ^= entryid
+                n += 1
+        return leaves, n
+
+def combine_leaf_hashes(results):
+        leaves = [0] * NUM_MERKLE_LEAVES
+        n = 0
+        for l, c in results:
+                leaves = [x ^ y for x, y in zip(leaves, l)]
+                n += c
+        return leaves, n
+
+# Returns the tree as a list of levels from the root to the leaves, as
+# ringo_sync:build_merkle_tree does
+def build_merkle_tree(leaves):
+        tree = [leaves]
+        level = leaves
+        while len(level) > 1:
+                level = [zlib.crc32(struct.pack(">II", level[i],
+                        level[i + 1])) & 0xffffffff
+                                for i in range(0, len(level), 2)]
+                tree.insert(0, level)
+        return tree
+
+# Returns the indices of the leaves that differ between any of the trees.
+# The trees are compared top-down, as ringo_syncdomain:merkle_sync does, so
+# identical subtrees are skipped.
+def diff_leaves(trees):
+        diff = [0]
+        for h in range(len(trees[0])):
+                cands = []
+                for n in diff:
+                        if h > 0:
+                                cands += [2 * n, 2 * n + 1]
+                        else:
+                                cands.append(n)
+                diff = [n for n in cands if len(set(t[h][n]
+                        for t in trees)) > 1]
+                if not diff:
+                        break
+        return diff
+
+#
+# Scanning
+#
+# Scan tasks are module-level functions, as required by multiprocessing.
+# Each task scans a range of a DB file.
+
+def _leaf_task(args):
+        fname, start, end = args
+        db = ringodb.open_db(fname)
+        prev_id = None
+        if start > 0:
+                prev_id = prev_entryid(db, start)
+        return fname, leaf_hashes(sync_ids(db, start, end, prev_id))
+
+def _collect_task(args):
+        fname, start, end, leaves = args
+        db = ringodb.open_db(fname)
+        prev_id = None
+        if start > 0:
+                prev_id = prev_entryid(db, start)
+        return fname, [(time, entryid) for time, entryid in
+                sync_ids(db, start, end, prev_id)
+                        if sync_id_slot(entryid) in leaves]
+
+def _run(pool, task, fnames, splits, *args):
+        tasks = [(fname, start, end) + args for fname in fnames
+                for start, end in ringodb.split_ranges(fname, splits)]
+        res = dict((fname, []) for fname in fnames)
+        for fname, r in pool.imap_unordered(task, tasks):
+                res[fname].append(r)
+        return res
+
+def db_file(path):
+        if os.path.isdir(path):
+                return os.path.join(path, "data")
+        return path
+
+# Computes Merkle trees for the given replicas and collects SyncIDs in the
+# leaves that differ. Returns a list of dictionaries, one for each replica,
+# with keys
+#
+# file: the DB file
+# entries: number of entries
+# root: root hash of the Merkle tree
+# missing: sorted list of SyncIDs that exist on some other replica but not
+# on this one
+def diff_replicas(paths, nproc = None, splits = None):
+        fnames = [db_file(p) for p in paths]
+        if nproc == None:
+                nproc = multiprocessing.cpu_count()
+        if splits == None:
+                splits = max(1, nproc / len(fnames))
+        pool = multiprocessing.Pool(nproc)
+        try:
+                res = _run(pool, _leaf_task, fnames, splits)
+                replicas = []
+                for fname in fnames:
+                        leaves, n = combine_leaf_hashes(res[fname])
+                        replicas.append({"file": fname, "entries": n,
+                                "tree": build_merkle_tree(leaves)})
+                diff = frozenset(diff_leaves([r["tree"]
+                        for r in replicas]))
+                ids = dict((fname, set()) for fname in fnames)
+                if diff:
+                        res = _run(pool, _collect_task, fnames, splits, diff)
+                        for fname, lst in res.items():
+                                for x in lst:
+                                        ids[fname].update(x)
+        finally:
+                pool.terminate()
+        all_ids = set()
+        for x in ids.values():
+                all_ids |= x
+        for r in replicas:
+                tree = r.pop("tree")
+                r["root"] = tree[0][0]
+                r["missing"] = sorted(all_ids - ids[r["file"]])
+        return replicas
+
+if __name__ == "__main__":
+        parser = optparse.OptionParser(usage =
+                "%prog [options] replica1 replica2 ...")
+        parser.add_option("-p", "--processes", type = "int",
+                help = "number of processes (default: number of CPUs)")
+        parser.add_option("-q", "--quiet", action = "store_true",
+                help = "don't list missing entries")
+        opts, args = parser.parse_args()
+        if not args:
+                parser.error("no replicas given")
+
+        replicas = diff_replicas(args, opts.processes)
+        for r in replicas:
+                print "%s: %d entries, root %d, %d missing" % (r["file"],
+                        r["entries"], r["root"], len(r["missing"]))
+                if not opts.quiet:
+                        for time, entryid in r["missing"]:
+                                print "  missing time %d entryid %d" %\
+                                        (time, entryid)
+        if [r for r in replicas if r["missing"]]:
+                sys.exit(1)
@@ -1,5 +1,6 @@
 -module(handle_data).
--export([op/2, op/3, start_active_node_updater/0, start_chunk_cache/0]).
+-export([op/2, op/3, start_active_node_updater/0, start_chunk_cache/0,
+         start_get_latency/0]).
 
 -include("ringo_store.hrl").
 
@@ -11,7 +12,16 @@
 
 -define(PUT_DEFAULTS, [{i, "timeout", "10000"}]).
 -define(PUT_FLAGS, []).
--define(GET_DEFAULTS, [{i, "timeout", "30000"}, {b, "single", false}]).
+-define(PUT_MANY_BATCH, 1000).
+-define(UPLOAD_PART, 65536).
+-define(UPLOAD_WINDOW, 8).
+-define(GET_DEFAULTS, [{i, "timeout", "30000"}, {b, "single", false},
+        {s, "read", "owner"}]).
+-define(GET_MANY_DEFAULTS, [{i, "timeout", "30000"}, {s, "read", "owner"}]).
+-define(HEDGE_PERCENTILE, 0.95).
+-define(HEDGE_SAMPLES, 1000).
+-define(HEDGE_DEFAULT_DELAY, 50). % milliseconds
+-define(HEDGE_MIN_DELAY, 2). % milliseconds
 -define(GET_FLAGS, []).
 
 % FIXME: What happens when we send a request to a node that doesn't have a 
@@ -21,13 +31,72 @@
 % CREATE: /gw/data/domain_name?num_repl=3
 % GET: /gw/data/domain_name/key_name
 % PUT: /gw/data/domain_name/key_name
+% PUT MANY: /gw/data/domain_name?many
+% GET MANY: /gw/data/domain_name?get_many
 
 %op(Script, Params, Data) ->
         %spawn(fun update_active_nodes/0),
 %        op1(Script, Params, Data).
 
+% Large POST bodies are not read to memory by the dispatcher, see
+% ringogw_util:post_data. Only a single PUT streams its value, the other
+% requests need the whole body.
+op([C|_] = Domain, Params, {stream, _, _} = Data) when is_integer(C) ->
+        op(Domain, Params, ringogw_util:recv_body(Data));
+
+% CREATE, PUT MANY or GET MANY
+op([C|_] = Domain, Params, Data) when is_integer(C) ->
+        Many = proplists:is_defined("many", Params),
+        GetMany = proplists:is_defined("get_many", Params),
+        if Many ->
+                put_many(Domain, Params, Data);
+        GetMany ->
+                get_many(Domain, Params, Data);
+        true ->
+                create(Domain, Params)
+        end;
+
+% PUT
+op([_Domain, Key], _Params, _Value) when length(Key) > ?KEY_MAX ->
+        throw({http_error, 400, <<"Key too large">>});
+
+% Streamed PUT: The value is sent to the owner in parts as it is received,
+% see Streamed put in ringo_domain
+op([Domain, Key], Params, {stream, Size, Recv}) ->
+        PParams = parse_params(Params, ?PUT_DEFAULTS),
+        Flags = parse_flags(PParams, ?PUT_FLAGS),
+        T = proplists:get_value(timeout, PParams),
+        Msg = {put_stream, list_to_binary(Key), Size, Flags, self()},
+        chunk_put(Domain, Msg, fun(Writer) ->
+                upload(Writer, Size, Recv, T, 0)
+        end, T, 0);
+
+op([Domain, Key], Params, Value) ->
+        PParams = parse_params(Params, ?PUT_DEFAULTS),
+        Flags = parse_flags(PParams, ?PUT_FLAGS),
+        Msg = {put, list_to_binary(Key), Value, Flags, self()},
+        chunk_put(Domain, Msg, none, proplists:get_value(timeout, PParams), 0);
+
+
+op(_, _, _) ->
+        throw({http_error, 400, <<"Invalid request">>}).
+
+% PUT MANY
+% POST-data contains a sequence of key-value pairs, each encoded as
+% <<KeyLen:32, ValueLen:32, Key:KeyLen/binary, Value:ValueLen/binary>>.
+% Pairs are sent to the domain in batches of ?PUT_MANY_BATCH entries, which
+% saves a round-trip per entry. The reply contains a result for each pair in
+% the same order as in the request.
+put_many(Domain, Params, Data) ->
+        PParams = parse_params(Params, ?PUT_DEFAULTS),
+        Flags = parse_flags(PParams, ?PUT_FLAGS),
+        T = proplists:get_value(timeout, PParams),
+        Replies = lists:append([chunk_put_many(Domain, Batch, Flags, T, 0, [])
+                || Batch <- split_batches(decode_pairs(Data, []), [])]),
+        {json, {ok, Replies}}.
+
 % CREATE
-op([C|_] = Domain, Params, _Data) when is_integer(C) ->
+create(Domain, Params) ->
         PParams = parse_params(Params, ?CREATE_DEFAULTS),
         Flags = parse_flags(PParams, ?CREATE_FLAGS),
         %error_logger:info_report({"CREATE", Domain, "WITH", PParams}),
@@ -49,21 +118,7 @@ op([C|_] = Domain, Params, _Data) when is_integer(C) ->
                 end;
         true ->
                 throw({http_error, 400, <<"Create flag missing">>})
-        end;
-
-% PUT
-op([_Domain, Key], _Params, _Value) when length(Key) > ?KEY_MAX ->
-        throw({http_error, 400, <<"Key too large">>});
-
-op([Domain, Key], Params, Value) ->
-        PParams = parse_params(Params, ?PUT_DEFAULTS),
-        Flags = parse_flags(PParams, ?PUT_FLAGS),
-        Msg = {put, list_to_binary(Key), Value, Flags, self()},
-        chunk_put(Domain, Msg, proplists:get_value(timeout, PParams), 0);
-
-
-op(_, _, _) ->
-        throw({http_error, 400, <<"Invalid request">>}).
+        end.
 
 %op(Script, Params) ->
         %spawn(fun update_active_nodes/0),
@@ -76,16 +131,32 @@ op(_, _, _) ->
 % specified, only the first value is sent to the requester without the length
 % prefix, which makes it possible to view the value directly in the browser.
 % (Consider supporting different mime-types, given a proper parameter).
+%
+% The request is sent to all the chunks that are known in the chunk cache at
+% once, as in GET MANY. Replies are collected by a relay process that follows
+% the domain to new chunks that are not in the cache yet, and passes them on
+% in chunk order, so the gateway process sees a single stream of values
+% ending with one done. With ?single, the first value of the lowest chunk
+% that has the key is returned.
+%
+% Parameter ?read chooses which nodes serve the request, see Replica reads
+% below.
 op([Domain, Key], Params) ->
-        Msg =  {get, list_to_binary(Key), self()},
-        Req = fun(Chunk) ->
-                DomainID = ringo_util:domain_id(Domain, Chunk),
-                ok = ringo_send(DomainID, Msg)
-        end,
-        Req(0),
         PParams = parse_params(Params, ?GET_DEFAULTS),
         Single = proplists:get_value(single, PParams),
         T = proplists:get_value(timeout, PParams),
+        ReadGet = read_get(proplists:get_value(read, PParams), Domain, T),
+        BKey = list_to_binary(Key),
+        Get = fun(C, From) -> ReadGet(BKey, C, From) end,
+        {Chunk, _} = chunk_id(Domain),
+        Self = self(),
+        Relay = spawn_link(fun() ->
+                relay_get(fun(E) -> Self ! {ringo_get, E} end,
+                        Get, Domain, Chunk, T)
+        end),
+        [ok = Get(C, chunk_forwarder(Relay, C)) || C <- lists:seq(0, Chunk)],
+        % The relay never forwards full replies, so Req is not needed
+        Req = fun(_) -> ok end,
         if Single ->
                 ringo_receive_chunked(single, Req, 0, T);
         true ->
@@ -95,14 +166,344 @@ op([Domain, Key], Params) ->
 op(_, _) ->
         throw({http_error, 400, <<"Invalid request">>}).
 
+% GET MANY
+% POST-data contains a sequence of keys, each encoded as
+% <<KeyLen:32, Key:KeyLen/binary>>. Get requests for all the keys are sent to
+% all the known chunks of the domain at once, instead of waiting for a chunk
+% to reply before the next one is requested. Values are sent as with GET,
+% each value preceded by its key as <<"KeyLen key Key">>.
+get_many(Domain, Params, Data) ->
+        PParams = parse_params(Params, ?GET_MANY_DEFAULTS),
+        T = proplists:get_value(timeout, PParams),
+        ReadGet = read_get(proplists:get_value(read, PParams), Domain, T),
+        Keys = lists:usort(decode_keys(Data, [])),
+        {Chunk, _} = chunk_id(Domain),
+        Self = self(),
+        lists:foreach(fun(Key) ->
+                Get = fun(C, From) -> ReadGet(Key, C, From) end,
+                Relay = spawn_link(fun() ->
+                        relay_get(fun(E) -> Self ! {ringo_get_many, Key, E} end,
+                                Get, Domain, Chunk, T)
+                end),
+                [ok = Get(C, chunk_forwarder(Relay, C)) ||
+                        C <- lists:seq(0, Chunk)]
+        end, Keys),
+        ringo_receive_many(length(Keys), T).
+
+% Relay_get collects replies to the get requests of a single key and passes
+% them to Forward, e.g. to tag them with the key. Get(Chunk, From) requests
+% the key from a chunk. Each chunk replies through its own forwarder, see
+% chunk_forwarder, so that the replies can be told apart.
+%
+% Replies are passed on in chunk order, so values come in the order they
+% were put, as if the chunks had been requested one by one. Replies of the
+% chunk Next are forwarded as they arrive. Replies of the later chunks are
+% buffered in Bufs until all the preceding chunks are done, except for the
+% parts of large values, which are left in the mailbox. A chunk sends a
+% limited number of parts until they are acknowledged, and nothing else
+% before all of them are, so the parts stay in order and memory use is
+% bounded (see ringo_indexdomain:send_replies).
+%
+% The next chunk is requested if the last requested one is full, as
+% ringo_receive_chunked does, so chunks that are missing from the chunk cache
+% are found too. Full replies from the other chunks are ignored, since the
+% next chunk has been requested already. Forward(done) is called once all the
+% chunks have replied.
+relay_get(Forward, Get, Domain, MaxChunk, Timeout) ->
+        relay_get(Forward, Get, Domain, MaxChunk, 0, gb_trees:empty(),
+                Timeout).
+
+relay_get(Forward, _Get, _Domain, MaxChunk, Next, _Bufs, _Timeout)
+        when Next > MaxChunk ->
+        Forward(done);
+
+relay_get(Forward, Get, Domain, MaxChunk, Next, Bufs, Timeout) ->
+        receive
+                {forwarded, {chunk, MaxChunk}, {ringo_get, full, MaxChunk}} ->
+                        chunk_seen(Domain, MaxChunk),
+                        F = chunk_forwarder(self(), MaxChunk + 1),
+                        case catch Get(MaxChunk + 1, F) of
+                                ok -> relay_get(Forward, Get, Domain,
+                                        MaxChunk + 1, Next, Bufs, Timeout);
+                                _ ->
+                                        stop_forwarder(F),
+                                        relay_get(Forward, Get, Domain,
+                                                MaxChunk, Next, Bufs, Timeout)
+                        end;
+                {forwarded, _, {ringo_get, full, _}} ->
+                        relay_get(Forward, Get, Domain, MaxChunk, Next, Bufs,
+                                Timeout);
+                {forwarded, {chunk, Next}, {ringo_get, E}}
+                        when E == done; E == invalid_domain ->
+                        relay_next(Forward, Get, Domain, MaxChunk, Next + 1,
+                                Bufs, Timeout);
+                {forwarded, {chunk, Next}, {ringo_get, E}} ->
+                        Forward(E),
+                        relay_get(Forward, Get, Domain, MaxChunk, Next, Bufs,
+                                Timeout);
+                {forwarded, {chunk, C}, {ringo_get, E}}
+                        when not is_tuple(E); element(1, E) =/= entry_part ->
+                        L = case gb_trees:lookup(C, Bufs) of
+                                none -> [];
+                                {value, V} -> V
+                        end,
+                        relay_get(Forward, Get, Domain, MaxChunk, Next,
+                                gb_trees:enter(C, [E|L], Bufs), Timeout)
+        after Timeout -> ok
+        end.
+
+% Forwards the buffered replies of the chunk Next, which is now the lowest
+% chunk that isn't done
+relay_next(Forward, Get, Domain, MaxChunk, Next, Bufs, Timeout) ->
+        case gb_trees:lookup(Next, Bufs) of
+                none ->
+                        relay_get(Forward, Get, Domain, MaxChunk, Next, Bufs,
+                                Timeout);
+                {value, L} ->
+                        Bufs0 = gb_trees:delete(Next, Bufs),
+                        case relay_buffered(Forward, lists:reverse(L)) of
+                                done -> relay_next(Forward, Get, Domain,
+                                        MaxChunk, Next + 1, Bufs0, Timeout);
+                                more -> relay_get(Forward, Get, Domain,
+                                        MaxChunk, Next, Bufs0, Timeout)
+                        end
+        end.
+
+relay_buffered(_Forward, []) -> more;
+relay_buffered(_Forward, [E|_]) when E == done; E == invalid_domain -> done;
+relay_buffered(Forward, [E|L]) ->
+        Forward(E),
+        relay_buffered(Forward, L).
+
+chunk_forwarder(Reader, Chunk) ->
+        spawn(fun() -> forwarder(Reader, {chunk, Chunk}) end).
+
+% Forwarder passes all messages to Reader, tagged with Tag, until it is
+% stopped or Reader goes away. Forwarders are not linked, since a failed
+% forwarder shouldn't take the reader down.
+forwarder(Reader, Tag) ->
+        erlang:monitor(process, Reader),
+        forwarder_loop(Reader, Tag).
+
+forwarder_loop(Reader, Tag) ->
+        receive
+                {stop_forwarder, Reader} -> ok;
+                {'DOWN', _, process, Reader, _} -> ok;
+                Msg ->
+                        Reader ! {forwarded, Tag, Msg},
+                        forwarder_loop(Reader, Tag)
+        end.
+
+stop_forwarder(F) ->
+        F ! {stop_forwarder, self()}.
+
+%%%
+%%% Replica reads
+%%%
+%%% All the replicas of a chunk have the same entries, once they are in sync,
+%%% so any of them can serve gets. Parameter ?read chooses between
+%%%
+%%% owner:  Only the owner serves gets (default). The owner redirects the
+%%%         request to a replica if it has fewer entries than the replicas.
+%%% any:    A random node that has the chunk serves the request. Values
+%%%         that haven't been resynced to the node yet may be missing.
+%%% hedged: As any, but if the node hasn't replied in a delay, the request
+%%%         is sent to another node too. The delay is the HEDGE_PERCENTILE
+%%%         of recent reply latencies, so about 5% of the requests are
+%%%         hedged.
+%%%
+%%% In the latter modes, each request is made through a forwarder process,
+%%% which tags the replies with its pid. The first request that replies wins,
+%%% the other forwarders are stopped and their replies are dropped, so values
+%%% are never doubled. If a node doesn't have the chunk, it replies
+%%% invalid_domain and the next one is tried. The owner is always the last
+%%% candidate. Nodes that have the chunk are found in the infopack_cache of
+%%% handle_domains.
+%%%
+
+read_get("owner", Domain, _) ->
+        fun(Key, C, From) ->
+                ringo_send(ringo_util:domain_id(Domain, C), {get, Key, From})
+        end;
+
+read_get(Mode, Domain, T) when Mode == "any"; Mode == "hedged" ->
+        {A1, A2, A3} = now(),
+        random:seed(A1, A2, A3),
+        Active = get_active_nodes(),
+        fun(Key, C, From) ->
+                ChunkID = ringo_util:domain_id(Domain, C),
+                Nodes = [N || {_, N} <- lists:sort([{random:uniform(), N} ||
+                        N <- replica_nodes(ChunkID), lists:member(N, Active)])],
+                Delay = if Mode == "hedged" -> hedge_delay();
+                        true -> T
+                end,
+                spawn_link(fun() ->
+                        replica_get(From, ChunkID, Key, Nodes ++ [owner],
+                                [], Delay, T)
+                end),
+                ok
+        end;
+
+read_get(_, _, _) ->
+        throw({http_error, 400, <<"Invalid read mode">>}).
+
+replica_nodes(ChunkID) ->
+        case catch ets:lookup(infopack_cache, {id, ChunkID}) of
+                L when is_list(L) -> [Node || {_, {_, Node, _}} <- L];
+                _ -> []
+        end.
+
+% Sends the request to the next candidate, through a new forwarder
+replica_get(Parent, ChunkID, Key, [Cand|Cands], Attempts, Delay, T) ->
+        Self = self(),
+        F = spawn(fun() -> forwarder(Self, self()) end),
+        case Cand of
+                owner -> catch ringo_send(ChunkID, {get, Key, F});
+                Node -> gen_server:cast({ringo_node, Node}, {{domain, ChunkID},
+                                {get_replica, Key, F}})
+        end,
+        replica_wait(Parent, ChunkID, Key, Cands, [{F, now()}|Attempts],
+                Delay, T).
+
+% A new candidate is tried if the current ones reply invalid_domain, or if
+% the only outstanding attempt hasn't replied in Delay. At most two attempts
+% are outstanding at a time, so a request is hedged again if one of them
+% fails, but a slow ring doesn't get a request for every replica.
+replica_wait(Parent, _, _, [], [], _, _) ->
+        Parent ! {ringo_get, invalid_domain};
+
+replica_wait(Parent, ChunkID, Key, Cands, Attempts, Delay, T) ->
+        Hedge = (Cands =/= []) and (length(Attempts) < 2),
+        After = if Hedge -> Delay; true -> T end,
+        receive
+                {forwarded, F, {ringo_get, invalid_domain}} ->
+                        stop_forwarder(F),
+                        Left = lists:keydelete(F, 1, Attempts),
+                        if Cands == [] ->
+                                replica_wait(Parent, ChunkID, Key, Cands,
+                                        Left, Delay, T);
+                        true ->
+                                replica_get(Parent, ChunkID, Key, Cands,
+                                        Left, Delay, T)
+                        end;
+                {forwarded, F, Msg} ->
+                        case lists:keysearch(F, 1, Attempts) of
+                                {value, {_, Started}} ->
+                                        record_latency(timer:now_diff(now(),
+                                                Started) div 1000),
+                                        [stop_forwarder(X) ||
+                                                {X, _} <- Attempts, X =/= F],
+                                        replica_forward(Parent, F, Msg, T);
+                                % a stopped forwarder
+                                false ->
+                                        replica_wait(Parent, ChunkID, Key,
+                                                Cands, Attempts, Delay, T)
+                        end
+        after After ->
+                if Hedge ->
+                        replica_get(Parent, ChunkID, Key, Cands, Attempts,
+                                Delay, T);
+                true ->
+                        [stop_forwarder(X) || {X, _} <- Attempts]
+                end
+        end.
+
+replica_forward(Parent, F, Msg, T) ->
+        Parent ! Msg,
+        case Msg of
+                {ringo_get, done} -> stop_forwarder(F);
+                {ringo_get, invalid_domain} -> stop_forwarder(F);
+                _ -> replica_committed(Parent, F, T)
+        end.
+
+% Replies from the other forwarders may have been queued before they were
+% stopped
+replica_committed(Parent, F, T) ->
+        receive
+                {forwarded, F, Msg} -> replica_forward(Parent, F, Msg, T);
+                {forwarded, _, _} -> replica_committed(Parent, F, T)
+        after T -> stop_forwarder(F)
+        end.
+
+% Reply latencies of replica reads are kept in a ring buffer of
+% HEDGE_SAMPLES items. The hedging delay is re-computed from the buffer on
+% every 100th sample.
+record_latency(Ms) ->
+        case catch ets:update_counter(get_latency, n, 1) of
+                N when is_integer(N) ->
+                        ets:insert(get_latency, {N rem ?HEDGE_SAMPLES, Ms}),
+                        if N rem 100 == 0 -> update_hedge_delay();
+                        true -> ok
+                        end;
+                _ -> ok
+        end.
+
+update_hedge_delay() ->
+        L = lists:sort([X || {I, X} <- ets:tab2list(get_latency),
+                is_integer(I)]),
+        P = lists:nth(lists:max([1, round(?HEDGE_PERCENTILE * length(L))]), L),
+        ets:insert(get_latency, {delay, lists:max([?HEDGE_MIN_DELAY, P])}).
+
+hedge_delay() ->
+        case catch ets:lookup(get_latency, delay) of
+                [{_, Delay}] -> Delay;
+                _ -> ?HEDGE_DEFAULT_DELAY
+        end.
+
+start_get_latency() ->
+        {ok, spawn_link(fun() ->
+                ets:new(get_latency, [named_table, public]),
+                ets:insert(get_latency, [{n, 0},
+                        {delay, ?HEDGE_DEFAULT_DELAY}]),
+                receive _ -> ok end
+        end)}.
+
+ringo_receive_many(NumKeys, Timeout) when Timeout > 60000 ->
+        ringo_receive_many(NumKeys, 60000);
+
+ringo_receive_many(0, _) ->
+        {chunked, fun(_) -> done end};
+
+ringo_receive_many(NumKeys, Timeout) ->
+        % N is the number of keys that are done
+        {chunked, fun(N) ->
+                receive
+                        {ringo_get_many, Key, {entry, E}} -> {entry, Key, E};
+                        {ringo_get_many, Key, {entry_head, Src, Size}} ->
+                                {entry_stream, Key, Size, fun() ->
+                                        receive
+                                                {ringo_get_many, _,
+                                                 {entry_part, Src, B}} ->
+                                                        Src ! {entry_ack,
+                                                                self()},
+                                                        B
+                                        after Timeout -> timeout
+                                        end
+                                end};
+                        {ringo_get_many, _, done} when N + 1 == NumKeys -> done;
+                        {ringo_get_many, _, done} -> {next, N + 1}
+                after Timeout -> timeout
+                end
+        end}.
+
 %%%
 %%% Chunked put
 %%%
 
-chunk_put(Domain, Msg, T, NumTries) ->
+% Upload is called with the writer process if the domain replies that it is
+% ready to receive a streamed value, after which the actual reply follows.
+chunk_put(Domain, Msg, Upload, T, NumTries) ->
         {Chunk, DomainID} = chunk_id(Domain),
         ok = ringo_send(DomainID, Msg),
+        chunk_put_reply(Domain, Chunk, DomainID, Msg, Upload, T, NumTries).
+
+chunk_put_reply(Domain, Chunk, DomainID, Msg, Upload, T, NumTries) ->
         case ringo_receive(DomainID, T) of
+                % Streamed put: send the value
+                {upload, Writer} when Upload =/= none ->
+                        Upload(Writer),
+                        chunk_put_reply(Domain, Chunk, DomainID, Msg, none,
+                                T, NumTries);
                 % Entry put ok
                 {ok, {Node, EntryID}} ->
                         {json, {ok, Node, formatid(DomainID),
@@ -117,29 +518,109 @@ chunk_put(Domain, Msg, T, NumTries) ->
                 % domain_full reply will create the chunk correctly.
                 {error, invalid_domain} when NumTries == 0 ->
                         chunk_reset(Domain),
-                        chunk_put(Domain, Msg, T, 1);
+                        chunk_put(Domain, Msg, Upload, T, 1);
                 % Resetting didn't help. Hopeless.
                 {error, invalid_domain} ->
                         throw({'EXIT', "Broken domain"});
                 % Chunk is full. Try the next chunk.
                 {error, domain_full, Chunk, Flags} ->
-                        {NChunk, ChunkID} = chunk_full(Domain, Chunk),
-                        % Try to create the next chunk -- it may well exist
-                        % already
-                        ok = ringo_send(ChunkID,
-                                {new_domain, Domain, NChunk, self(), Flags}),
-                        case ringo_receive(ChunkID, T) of
-                                {ok, _} -> ok;
-                                {error, eexist} -> ok;
-                                Error -> throw({'EXIT', Error})
-                        end,
-                        chunk_put(Domain, Msg, T, 0);
+                        next_chunk(Domain, Chunk, Flags, T),
+                        chunk_put(Domain, Msg, Upload, T, 0);
                 Error ->
                         error_logger:warning_report(
                                 {"Unknown put reply", Error}),
                         throw({'EXIT', Error})
         end.
 
+% Upload sends Size bytes, received with Recv(Bytes), to Writer in parts of
+% UPLOAD_PART bytes. At most UPLOAD_WINDOW parts are unacknowledged at any
+% time, which bounds the memory that a streamed put takes both here and on
+% the writer's node.
+upload(_Writer, 0, _Recv, _T, 0) -> ok;
+upload(Writer, Size, Recv, T, InFlight)
+        when Size == 0; InFlight >= ?UPLOAD_WINDOW ->
+        receive
+                {upload_ack, Writer} ->
+                        upload(Writer, Size, Recv, T, InFlight - 1)
+        after T ->
+                throw({'EXIT', "Upload timeout"})
+        end;
+upload(Writer, Size, Recv, T, InFlight) ->
+        {ok, B} = Recv(lists:min([Size, ?UPLOAD_PART])),
+        Writer ! {upload_part, self(), B},
+        upload(Writer, Size - size(B), Recv, T, InFlight + 1).
+
+% Chunk_put_many works as chunk_put above, except that a chunk may become
+% full in the middle of a batch. In this case the domain replies with the
+% results for the entries that it wrote, and the rest are sent to the next
+% chunk.
+chunk_put_many(_Domain, [], _Flags, _T, _NumTries, Replies) -> Replies;
+chunk_put_many(Domain, Items, Flags, T, NumTries, Replies) ->
+        {Chunk, DomainID} = chunk_id(Domain),
+        ok = ringo_send(DomainID, {put_many, Items, Flags, self()}),
+        case ringo_receive(DomainID, T) of
+                {many, R} ->
+                        Replies ++ format_many(DomainID, R);
+                {many, R, {error, domain_full, Chunk, CFlags}} ->
+                        next_chunk(Domain, Chunk, CFlags, T),
+                        chunk_put_many(Domain, lists:nthtail(length(R), Items),
+                                Flags, T, 0,
+                                Replies ++ format_many(DomainID, R));
+                {error, invalid_domain} when Chunk == 0 ->
+                        Replies ++ [{error, <<"Domain doesn't exist">>}
+                                || _ <- Items];
+                {error, invalid_domain} when NumTries == 0 ->
+                        chunk_reset(Domain),
+                        chunk_put_many(Domain, Items, Flags, T, 1, Replies);
+                {error, invalid_domain} ->
+                        throw({'EXIT', "Broken domain"});
+                {error, domain_full, Chunk, CFlags} ->
+                        next_chunk(Domain, Chunk, CFlags, T),
+                        chunk_put_many(Domain, Items, Flags, T, 0, Replies);
+                Error ->
+                        error_logger:warning_report(
+                                {"Unknown put_many reply", Error}),
+                        throw({'EXIT', Error})
+        end.
+
+format_many(DomainID, Replies) ->
+        lists:map(fun
+                ({ok, {Node, EntryID}}) ->
+                        {ok, Node, formatid(DomainID), formatid(EntryID)};
+                ({error, invalid_request}) ->
+                        {error, <<"Invalid request">>}
+        end, Replies).
+
+next_chunk(Domain, Chunk, Flags, T) ->
+        {NChunk, ChunkID} = chunk_full(Domain, Chunk),
+        % Try to create the next chunk -- it may well exist already
+        ok = ringo_send(ChunkID, {new_domain, Domain, NChunk, self(), Flags}),
+        case ringo_receive(ChunkID, T) of
+                {ok, _} -> ok;
+                {error, eexist} -> ok;
+                Error -> throw({'EXIT', Error})
+        end.
+
+decode_pairs(<<>>, Pairs) -> lists:reverse(Pairs);
+decode_pairs(<<KeyLen:32, ValueLen:32, Key:KeyLen/binary,
+        Value:ValueLen/binary, Rest/binary>>, Pairs) ->
+        decode_pairs(Rest, [{Key, Value}|Pairs]);
+decode_pairs(_, _) ->
+        throw({http_error, 400, <<"Invalid key-value pairs">>}).
+
+decode_keys(<<>>, Keys) -> lists:reverse(Keys);
+decode_keys(<<KeyLen:32, Key:KeyLen/binary, Rest/binary>>, Keys) ->
+        decode_keys(Rest, [Key|Keys]);
+decode_keys(_, _) ->
+        throw({http_error, 400, <<"Invalid keys">>}).
+
+split_batches([], Batches) -> lists:reverse(Batches);
+split_batches(Items, Batches) when length(Items) > ?PUT_MANY_BATCH ->
+        {Batch, Rest} = lists:split(?PUT_MANY_BATCH, Items),
+        split_batches(Rest, [Batch|Batches]);
+split_batches(Items, Batches) ->
+        lists:reverse([Items|Batches]).
+
 %%%
 %%% Ringo communication
 %%%
@@ -161,6 +642,8 @@ ringo_receive_chunked(single, Req, N, Timeout) ->
         receive
                 {ringo_get, {entry, E}} ->
                         {data, E};
+                {ringo_get, {entry_head, Src, Size}} ->
+                        {stream, Size, receive_parts(Src, Timeout)};
                 {ringo_get, done} when N == 0 ->
                         throw({http_error, 404, <<"Key not found">>});
                 {ringo_get, done}  ->
@@ -182,6 +665,9 @@ ringo_receive_chunked(many, Req, _, Timeout) ->
         {chunked, fun(N) ->
                 receive 
                         {ringo_get, {entry, _} = E} -> E;
+                        {ringo_get, {entry_head, Src, Size}} ->
+                                {entry_stream, Size,
+                                        receive_parts(Src, Timeout)};
                         {ringo_get, done} when N == 0 -> done;
                         {ringo_get, done} -> {next, N - 1};
                         {ringo_get, full, Chunk} ->
@@ -193,6 +679,19 @@ ringo_receive_chunked(many, Req, _, Timeout) ->
                 end
         end}.
 
+% Returns a function that receives the next chunk of an external value that
+% is being sent by Src. Each chunk is acknowledged once it has been received,
+% which lets Src send more. See ringo_indexdomain:send_external.
+receive_parts(Src, Timeout) ->
+        fun() ->
+                receive
+                        {ringo_get, {entry_part, Src, B}} ->
+                                Src ! {entry_ack, self()},
+                                B
+                after Timeout -> timeout
+                end
+        end.
+
 ringo_receive(DomainID, Timeout) when Timeout > 60000 ->
         ringo_receive(DomainID, 60000);
 
@@ -278,6 +777,20 @@ chunk_full(Domain, Chunk) ->
         ets:insert(chunk_cache, {DomainID, NChunk, ChunkID}),
         {NChunk, ChunkID}.
 
+% A get found that Chunk exists and it is full. Puts would find this out
+% themselves, but the cache is updated here too, so that the next gets can be
+% sent to all the chunks at once on a gateway that only serves gets. Only
+% existing chunks are recorded, so that puts are never sent to a chunk that
+% hasn't been created yet.
+chunk_seen(Domain, Chunk) ->
+        case chunk_id(Domain) of
+                {C, _} when C < Chunk ->
+                        DomainID = ringo_util:domain_id(Domain, 0),
+                        ets:insert(chunk_cache, {DomainID, Chunk,
+                                ringo_util:domain_id(Domain, Chunk)});
+                _ -> ok
+        end.
+
 chunk_reset(Domain) ->
         DomainID = ringo_util:domain_id(Domain, 0),
         ets:delete(chunk_cache, DomainID).
@@ -1,12 +1,11 @@
 -module(mochi_dispatch).
 -export([request/1]).
 
-% MAX_RECV_BODY can't be larger than 16M due to a gen_tcp:recv restriction in
-% raw mode:
+% POST bodies are read with Req:recv, in parts if they are large, see
+% ringogw_util:post_data. Req:recv_body would read the body at once, which
+% is limited to 16M due to a gen_tcp:recv restriction in raw mode:
 % http://www.erlang.org/pipermail/erlang-questions/2006-September/022907.html
 
--define(MAX_RECV_BODY, (10 * 1024 * 1024)).
-
 request(Req) ->
         {ok, Dyn} = application:get_env(dynroot),
         {ok, Doc} = application:get_env(docroot),
@@ -28,10 +27,22 @@ serve_dynamic(Req, N, Script) ->
         Q = Req:parse_qs(),
         case Req:get(method) of 
                 'GET' -> catch_op(Req, Mod, [Script, Q]);
-                'POST' -> catch_op(Req, Mod, [Script, Q,
-                                Req:recv_body(?MAX_RECV_BODY)])
+                'POST' -> catch_op(Req, Mod, [Script, Q, post_data(Req)])
         end.
 
+post_data(Req) ->
+        % Req:recv_body does this too
+        case Req:get_header_value("expect") of
+                "100-continue" -> Req:start_raw_response({100,
+                        gb_trees:empty()});
+                _ -> ok
+        end,
+        CLen = case Req:get_header_value("content-length") of
+                undefined -> 0;
+                L -> list_to_integer(L)
+        end,
+        ringogw_util:post_data(CLen, fun(N) -> {ok, Req:recv(N)} end).
+
 catch_op(Req, Mod, Args) ->
         case catch apply(Mod, op, Args) of
                 {http_error, Code, Error} ->
@@ -50,6 +61,14 @@ catch_op(Req, Mod, Args) ->
 			Req:ok({proplists:get_value("mime", 
 				Params, "application/octet-stream"), Res});
 
+                {stream, Size, Next} ->
+			[_, Params] = Args,
+                        Req:start_response_length({200, [{"Content-Type",
+                                proplists:get_value("mime", Params,
+                                        "application/octet-stream")}], Size}),
+                        ringogw_util:stream_reply(
+                                fun(B) -> Req:send(B) end, Size, Next);
+
                 {chunked, ReplyGen} ->
                         Req:respond({200, [{"Content-type",
                                 "application/octet-stream"}], chunked}),
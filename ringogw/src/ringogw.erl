@@ -12,6 +12,9 @@
                  {chunk_cache, {handle_data,
                         start_chunk_cache, []},
                         permanent, 10, worker, dynamic},
+                 {get_latency, {handle_data,
+                        start_get_latency, []},
+                        permanent, 10, worker, dynamic},
                  {check_domains, {handle_domains,
                         start_check_domains, []},
                         permanent, 10, worker, dynamic},
@@ -1,5 +1,10 @@
 -module(ringogw_util).
--export([chunked_reply/2, flush_inbox/0]).
+-export([chunked_reply/2, stream_reply/3, flush_inbox/0]).
+-export([post_data/2, recv_body/1]).
+
+% POST bodies larger than this are streamed, see post_data
+-define(STREAM_BODY_MIN, 1048576).
+-define(RECV_PART, 1048576).
 
 chunked_reply(Sender, ReplyGen) -> chunked_reply(Sender, ReplyGen, 0).
 chunked_reply(Sender, ReplyGen, N) ->
@@ -7,6 +12,17 @@ chunked_reply(Sender, ReplyGen, N) ->
                 {entry, Entry} ->
                         Sender(encode_chunk(Entry, <<"ok">>)),
                         chunked_reply(Sender, ReplyGen, N);
+                {entry, Key, Entry} ->
+                        Sender(encode_chunk(Key, <<"key">>)),
+                        Sender(encode_chunk(Entry, <<"ok">>)),
+                        chunked_reply(Sender, ReplyGen, N);
+                {entry_stream, Size, Next} ->
+                        Sender(encode_head(Size, <<"ok">>)),
+                        chunked_stream(Sender, ReplyGen, N, Size, Next);
+                {entry_stream, Key, Size, Next} ->
+                        Sender(encode_chunk(Key, <<"key">>)),
+                        Sender(encode_head(Size, <<"ok">>)),
+                        chunked_stream(Sender, ReplyGen, N, Size, Next);
                 {next, N0} ->
                         chunked_reply(Sender, ReplyGen, N0);
                 done ->
@@ -24,11 +40,65 @@ chunked_reply(Sender, ReplyGen, N) ->
                         Sender(encode_chunk(done))
         end.
 
+% A large value is sent in parts, as they are received by Next(). If the
+% value can't be received completely, the reply is terminated, which the
+% client detects as an incomplete entry.
+chunked_stream(Sender, ReplyGen, N, Size, _) when Size =< 0 ->
+        chunked_reply(Sender, ReplyGen, N);
+chunked_stream(Sender, ReplyGen, N, Size, Next) ->
+        case Next() of
+                timeout ->
+                        Sender(encode_chunk(done));
+                B ->
+                        Sender(encode_raw(B)),
+                        chunked_stream(Sender, ReplyGen, N,
+                                Size - size(B), Next)
+        end.
+
+% Stream_reply sends a value of Size bytes as is, as it is received by
+% Next().
+stream_reply(_, Size, _) when Size =< 0 -> ok;
+stream_reply(Sender, Size, Next) ->
+        case Next() of
+                timeout -> timeout;
+                B ->
+                        Sender(B),
+                        stream_reply(Sender, Size - size(B), Next)
+        end.
+
 % last chunk
 encode_chunk(done) -> <<"0\r\n\r\n">>.
 encode_chunk(Data, Code) ->
         Prefixed = [io_lib:format("~b ", [size(Data)]), Code, " ", Data],
-        [io_lib:format("~.16b\r\n", [iolist_size(Prefixed)]),  Prefixed, "\r\n"].
+        encode_raw(Prefixed).
+
+encode_head(Size, Code) ->
+        encode_raw([io_lib:format("~b ", [Size]), Code, " "]).
+
+encode_raw(Data) ->
+        [io_lib:format("~.16b\r\n", [iolist_size(Data)]),  Data, "\r\n"].
+
+% Post_data returns the body of a POST request of CLen bytes, which is read
+% with Recv(Bytes) -> {ok, Binary}. Bodies larger than STREAM_BODY_MIN bytes
+% are not read to memory here. Instead {stream, CLen, Recv} is returned, so
+% that the handler can consume the body in parts.
+post_data(CLen, Recv) when CLen > ?STREAM_BODY_MIN ->
+        {stream, CLen, Recv};
+post_data(CLen, Recv) when CLen > 0 ->
+        {ok, Data} = Recv(CLen),
+        Data;
+post_data(_, _) -> <<>>.
+
+% Reads a streamed body to memory. Gen_tcp:recv can't receive more than 16MB
+% at once in raw mode, so the body is received in parts.
+recv_body({stream, Size, Recv}) ->
+        list_to_binary(recv_parts(Size, Recv));
+recv_body(Data) -> Data.
+
+recv_parts(0, _) -> [];
+recv_parts(Size, Recv) ->
+        {ok, B} = Recv(lists:min([Size, ?RECV_PART])),
+        [B|recv_parts(Size - size(B), Recv)].
 
 flush_inbox() ->
         receive
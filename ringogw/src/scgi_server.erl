@@ -98,6 +98,11 @@ handle_request(Socket, Msg) ->
                 {data, Res} ->
                         gen_tcp:send(Socket, [?HTTP_HEADER(
                                 "application/octet-stream"), Res]);
+                {stream, Size, Next} ->
+                        gen_tcp:send(Socket, [?HTTP_HEADER(
+                                "application/octet-stream")]),
+                        ringogw_util:stream_reply(fun(B) ->
+                                gen_tcp:send(Socket, B) end, Size, Next);
                 {chunked, ReplyGen} ->
                         % FIXME: Check how Lighttpd handles chunked output
                         gen_tcp:send(Socket, [?HTTP_HEADER(
@@ -133,11 +138,9 @@ dispatch_request(Socket, Msg) ->
         CLen = list_to_integer(CLenStr),
         
         if Method == "POST" ->
-                if CLen > 0 ->
-                        {ok, PostData} = gen_tcp:recv(Socket, CLen, 30000);
-                true ->
-                        PostData = <<>>
-                end,
+                PostData = ringogw_util:post_data(CLen, fun(N) ->
+                        gen_tcp:recv(Socket, N, 30000)
+                end),
                 Mod:op(Script, httpd:parse_query(Query), PostData);
         true ->
                 Mod:op(Script, httpd:parse_query(Query))